@@ -37,6 +37,7 @@ def create_app(config_class=Config):
             "origins": app.config['CORS_ORIGINS'],
             "methods": app.config['CORS_METHODS'],
             "allow_headers": app.config['CORS_HEADERS'],
+            "expose_headers": app.config['CORS_EXPOSE_HEADERS'],
             "supports_credentials": True # Если нужны куки или Authorization header
         }
     })
@@ -51,6 +52,9 @@ def create_app(config_class=Config):
              database.init_db(app.config['DATABASE_URL'])  # <--- ИСПРАВЛЕНИЕ ЗДЕСЬ
              # Вызываем init_app ПОСЛЕ init_db, чтобы зарегистрировать teardown
              database.init_app(app)
+             # Индексация для поиска сообщений, созданных до появления полнотекстового индекса
+             from app.services import search_service
+             search_service.start_indexer(app.config['DATABASE_URL'])
          except Exception as e:
               logger.critical(f"Не удалось инициализировать базу данных при старте: {e}", exc_info=True)
               # Решите, должно ли приложение падать, если БД недоступна
@@ -60,11 +64,25 @@ def create_app(config_class=Config):
     from app.routes import chat_routes
     from app.routes import auth_routes
     from app.routes import misc_routes
+    from app.routes import search_routes
     app.register_blueprint(auth_routes.auth_bp)
     app.register_blueprint(chat_routes.chat_bp)
     app.register_blueprint(misc_routes.misc_bp)
+    app.register_blueprint(search_routes.search_bp)
     logger.info("Blueprints зарегистрированы.")
 
+    @app.cli.command('backfill-html')
+    def backfill_html_command():
+        """Собирает HTML для ответов бота, сохраненных без него или старой версией рендерера."""
+        import click
+        from app.services.chat_service import backfill_message_html
+        updated = backfill_message_html()
+        click.echo(f"Обновлено сообщений: {updated}")
+
+    if app.config.get('METRICS_ENABLED'):
+        from app.utils import metrics
+        metrics.init_app(app)
+
     # Регистрация обработчиков запросов/ответов и ошибок на уровне приложения
 
     @app.before_request
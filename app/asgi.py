@@ -0,0 +1,216 @@
+# app/asgi.py
+"""
+ASGI-точка входа.
+
+POST /api/chats/<id>/messages обслуживается нативно на asyncio: открытый SSE-поток
+ожидает токены от Gemini, не занимая поток воркера. Все остальные маршруты
+передаются в обычное Flask-приложение через адаптер WsgiToAsgi.
+
+Запуск: uvicorn asgi:app --host 0.0.0.0 --port 8000
+"""
+import asyncio
+import json
+import logging
+import re
+from time import perf_counter
+from asgiref.wsgi import WsgiToAsgi
+from . import create_app
+from .services import chat_service, gemini_service
+from .services.auth_service import verify_auth_token, InvalidTokenError, AuthServiceError
+from .services.chat_service import ChatNotFoundError, InvalidInputError, ChatServiceError
+from .services.gemini_service import GeminiServiceError, ChatInstanceError
+from .utils.sse import format_sse, error_payload, coalesce_events_async
+from .utils import metrics
+
+logger = logging.getLogger(__name__)
+
+MESSAGES_PATH_RE = re.compile(r'/api/chats/(\d+)/messages')
+MESSAGES_ROUTE = '/api/chats/<int:chat_id>/messages' # Метка маршрута в метриках, как у Flask
+
+
+class _RequestError(Exception):
+    """Ошибка подготовки запроса, возвращаемая клиенту как JSON с кодом статуса."""
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _prepare_message(token, body: bytes, chat_id: int):
+    """
+    Синхронная часть обработки (выполняется в пуле потоков в контексте приложения):
+    проверка токена, валидация, проверка доступа к чату и сохранение сообщения пользователя.
+    """
+    if not token:
+        raise _RequestError(401, 'Токен авторизации отсутствует')
+    try:
+        user = verify_auth_token(token)
+    except InvalidTokenError as e:
+        raise _RequestError(401, str(e))
+    except AuthServiceError as e:
+        logger.error(f"Сервисная ошибка при проверке токена (ASGI): {e}")
+        raise _RequestError(500, 'Ошибка сервера при проверке авторизации')
+
+    try:
+        data = json.loads(body or b'{}') or {}
+    except ValueError:
+        data = {}
+    content = data.get('content') if isinstance(data, dict) else None
+    if not content or not content.strip():
+        raise _RequestError(400, 'Сообщение не может быть пустым')
+
+    try:
+        chat_service._check_chat_access(chat_id, user['id'])
+        user_msg = chat_service.add_user_message(chat_id, user['id'], content.strip())
+        logger.info(f"Сообщение пользователя {user_msg['id']} сохранено в чат {chat_id}")
+    except ChatNotFoundError as e:
+        logger.warning(f"Действие с чатом {chat_id} запрещено/не найдено для user {user['id']}: {e}")
+        raise _RequestError(404, str(e))
+    except InvalidInputError as e:
+        raise _RequestError(400, str(e))
+    except ChatServiceError as e:
+        logger.error(f"Ошибка сервиса чата при обработке сообщения для чата {chat_id}: {e}")
+        raise _RequestError(500, 'Ошибка сервера при обработке вашего сообщения')
+    return user, content.strip()
+
+
+def _cors_headers(flask_app, scope):
+    """CORS-заголовки для нативного маршрута (остальные маршруты обрабатывает Flask-CORS)."""
+    headers = dict(scope.get('headers') or [])
+    origin = headers.get(b'origin')
+    if not origin:
+        return []
+    allowed = flask_app.config['CORS_ORIGINS']
+    if '*' in allowed or origin.decode('latin-1') in allowed:
+        return [(b'access-control-allow-origin', origin),
+                (b'access-control-allow-credentials', b'true'),
+                (b'vary', b'Origin')]
+    return []
+
+
+async def _read_body(receive) -> bytes:
+    body = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+    return b''.join(body)
+
+
+async def _wait_disconnect(receive):
+    """Ждет отключения клиента (http.disconnect) во время отправки потока."""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def _send_json(send, status: int, payload: dict, extra_headers):
+    data = json.dumps(payload).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(data)).encode())] + extra_headers})
+    await send({'type': 'http.response.body', 'body': data})
+
+
+def _observe(flask_app, status: int, start: float):
+    if flask_app.config.get('METRICS_ENABLED'):
+        metrics.observe_request('POST', MESSAGES_ROUTE, status, perf_counter() - start)
+
+
+async def _send_frames(send, frames, chat_id: int):
+    """Отправляет кадры SSE клиенту до конца потока."""
+    try:
+        async for payload in frames:
+            await send({'type': 'http.response.body', 'body': format_sse(payload).encode('utf-8'), 'more_body': True})
+    except (GeminiServiceError, ChatInstanceError) as e:
+        logger.error(f"Ошибка сервиса Gemini при отправке сообщения в чат {chat_id}: {e}")
+        error_event = format_sse(error_payload(f'Ошибка нейросети: {e}'))
+        await send({'type': 'http.response.body', 'body': error_event.encode('utf-8'), 'more_body': True})
+    except OSError as e:
+        # Клиент закрыл соединение - дальнейшая отправка невозможна
+        logger.info(f"Клиент отключился от потока чата {chat_id}: {e}")
+        return
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def _handle_send_message(flask_app, scope, receive, send, chat_id: int):
+    """Асинхронный аналог chat_routes.send_message."""
+    start = perf_counter()
+    body = await _read_body(receive)
+    headers = dict(scope.get('headers') or [])
+    token = headers.get(b'authorization', b'').decode('latin-1') or None
+    cors = _cors_headers(flask_app, scope)
+
+    try:
+        user, content = await gemini_service._run_in_app_context(flask_app, _prepare_message, token, body, chat_id)
+    except _RequestError as e:
+        _observe(flask_app, e.status, start)
+        await _send_json(send, e.status, {'error': e.message}, cors)
+        return
+    except Exception as e:
+        logger.critical(f"Неожиданная ошибка при отправке сообщения в чат {chat_id} (ASGI): {e}", exc_info=True)
+        _observe(flask_app, 500, start)
+        await _send_json(send, 500, {'error': 'Неожиданная внутренняя ошибка сервера'}, cors)
+        return
+
+    _observe(flask_app, 200, start)
+
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'text/event-stream'),
+                            (b'cache-control', b'no-cache')] + cors})
+    payloads = gemini_service.get_gemini_response_stream_async(flask_app, chat_id, user['id'], content)
+    frames = coalesce_events_async(payloads,
+                                   flask_app.config['SSE_COALESCE_WINDOW_MS'],
+                                   flask_app.config['SSE_COALESCE_MAX_BYTES'])
+    # Пока модель генерирует ответ, send() не вызывается и не сообщит об отключении клиента -
+    # его отслеживает отдельная задача, и отправка потока отменяется, чтобы не тратить токены
+    streaming = asyncio.ensure_future(_send_frames(send, frames, chat_id))
+    disconnect = asyncio.ensure_future(_wait_disconnect(receive))
+    try:
+        await asyncio.wait({streaming, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        if not streaming.done():
+            logger.info(f"Клиент отключился от потока чата {chat_id}, генерация ответа прерывается")
+    finally:
+        streaming.cancel()
+        disconnect.cancel()
+        try:
+            await streaming
+        except asyncio.CancelledError:
+            pass
+        # Генераторы могли остаться приостановленными на yield (отмена во время send) - закрываем явно
+        await frames.aclose()
+        await payloads.aclose()
+
+
+async def _handle_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def create_asgi_app(flask_app=None):
+    """Создает ASGI-приложение поверх Flask-приложения."""
+    flask_app = flask_app or create_app()
+    wsgi_fallback = WsgiToAsgi(flask_app)
+
+    async def asgi_app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await _handle_lifespan(receive, send)
+            return
+        if scope['type'] == 'http' and scope['method'] == 'POST':
+            match = MESSAGES_PATH_RE.fullmatch(scope['path'])
+            if match:
+                await _handle_send_message(flask_app, scope, receive, send, int(match.group(1)))
+                return
+        await wsgi_fallback(scope, receive, send)
+
+    logger.info("ASGI-приложение создано (нативный стриминг для POST /api/chats/<id>/messages).")
+    return asgi_app
@@ -9,14 +9,137 @@ class Config:
     DATABASE_URL = os.environ.get('DATABASE_URL') or 'database.db'
     GOOGLE_API_KEY = os.environ.get('GOOGLE_API_KEY')
 
-    # Проверяем, что GOOGLE_API_KEY установлен
-    if not GOOGLE_API_KEY:
+    # Бэкенд языковой модели: 'gemini' (Google Gemini API) или 'fake' - детерминированная
+    # локальная модель для нагрузочных тестов и бенчмарков без API (см. FAKE_LLM_* ниже)
+    LLM_BACKEND = os.environ.get('LLM_BACKEND', 'gemini').lower()
+
+    # Проверяем, что GOOGLE_API_KEY установлен (нужен только для Gemini)
+    if LLM_BACKEND == 'gemini' and not GOOGLE_API_KEY:
         raise ValueError("GOOGLE_API_KEY не найден в переменных окружения (.env)")
 
     # Настройки CORS (можно расширить при необходимости)
     CORS_ORIGINS = ["http://localhost:8000", "http://127.0.0.1:8000", "*"]
     CORS_METHODS = ["GET", "POST", "OPTIONS"]
     CORS_HEADERS = ["Content-Type", "Authorization"]
+    CORS_EXPOSE_HEADERS = ["X-Next-Cursor", "X-Next-Offset", "ETag"] # Заголовки ответа, доступные JS на фронтенде
 
     # Время жизни экземпляра чата Gemini без активности (в секундах)
-    CHAT_INSTANCE_TIMEOUT = 3600
\ No newline at end of file
+    CHAT_INSTANCE_TIMEOUT = 3600
+    # Максимальное число сессий в памяти процесса (вытесняются наименее используемые)
+    SESSION_CACHE_MAX_ENTRIES = int(os.environ.get('SESSION_CACHE_MAX_ENTRIES', 10000))
+    # Ограничение суммарного размера сессий в памяти (оценка в байтах, 0 - без ограничения)
+    SESSION_CACHE_MAX_BYTES = int(os.environ.get('SESSION_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+    # Через сколько секунд простоя сессия "засыпает": история сжимается в блоб, объекты SDK
+    # освобождаются, а при следующем сообщении сессия восстанавливается без запроса к БД (0 - выключено).
+    # Лимиты для блобов усыпленных сессий - отдельные
+    SESSION_HIBERNATE_AFTER = int(os.environ.get('SESSION_HIBERNATE_AFTER', 300))
+    SESSION_HIBERNATED_MAX_ENTRIES = int(os.environ.get('SESSION_HIBERNATED_MAX_ENTRIES', 100000))
+    SESSION_HIBERNATED_MAX_BYTES = int(os.environ.get('SESSION_HIBERNATED_MAX_BYTES', 128 * 1024 * 1024))
+    # Интервал работы фонового потока очистки неактивных сессий (в секундах)
+    SESSION_REAPER_INTERVAL = 60
+
+    # Хранилище сессий GeminiChat: 'memory' (в памяти процесса) или 'sqlite'
+    # (общее для всех воркеров WSGI, история и модель сериализуются в таблицу chat_sessions)
+    SESSION_STORE = os.environ.get('SESSION_STORE', 'memory')
+    # Путь к БД SQLite для хранилища сессий (по умолчанию - основная БД)
+    SESSION_STORE_PATH = os.environ.get('SESSION_STORE_PATH') or None
+
+    # Объединение мелких чанков ответа в один кадр SSE: окно (мс, 0 - отключено)
+    # и максимальный размер накопленного текста (в байтах UTF-8). Первый токен отправляется сразу
+    SSE_COALESCE_WINDOW_MS = float(os.environ.get('SSE_COALESCE_WINDOW_MS', 50))
+    SSE_COALESCE_MAX_BYTES = int(os.environ.get('SSE_COALESCE_MAX_BYTES', 2048))
+
+    # Настройки соединений SQLite (см. app/database.py). WAL позволяет читать во время записи,
+    # busy_timeout - ждать освобождения блокировки вместо ошибки "database is locked"
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+    SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE', -20000)) # < 0 - размер в КиБ
+    SQLITE_FOREIGN_KEYS = True
+    # Переиспользовать соединение с БД между запросами в пределах одного потока
+    DB_POOL_ENABLED = os.environ.get('DB_POOL_ENABLED', '1') not in ('0', 'false', 'False')
+
+    # Отложенная групповая запись сообщений (write-behind): вставки из разных запросов
+    # фиксируются пачками одной транзакцией в фоновом потоке
+    WRITE_BEHIND_ENABLED = os.environ.get('WRITE_BEHIND_ENABLED', '0') in ('1', 'true', 'True')
+    WRITE_BEHIND_MAX_QUEUE = int(os.environ.get('WRITE_BEHIND_MAX_QUEUE', 1000))
+    WRITE_BEHIND_MAX_BATCH = int(os.environ.get('WRITE_BEHIND_MAX_BATCH', 100))
+    # Сколько ждать следующих записей после первой в пачке (мс)
+    WRITE_BEHIND_FLUSH_INTERVAL_MS = float(os.environ.get('WRITE_BEHIND_FLUSH_INTERVAL_MS', 5))
+
+    # Размер страницы сообщений чата по умолчанию и максимальный (параметр limit)
+    MESSAGES_PAGE_SIZE = int(os.environ.get('MESSAGES_PAGE_SIZE', 50))
+    MESSAGES_PAGE_MAX = int(os.environ.get('MESSAGES_PAGE_MAX', 200))
+
+    # Полнотекстовый поиск по сообщениям (GET /api/search): размер страницы и длина запроса
+    SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', 20))
+    SEARCH_PAGE_MAX = int(os.environ.get('SEARCH_PAGE_MAX', 100))
+    SEARCH_QUERY_MAX_CHARS = int(os.environ.get('SEARCH_QUERY_MAX_CHARS', 256))
+    # Индексация сообщений, созданных до появления индекса: строк в транзакции и пауза между ними
+    SEARCH_INDEX_BATCH_SIZE = int(os.environ.get('SEARCH_INDEX_BATCH_SIZE', 2000))
+    SEARCH_INDEX_BATCH_PAUSE_MS = int(os.environ.get('SEARCH_INDEX_BATCH_PAUSE_MS', 50))
+
+    # Кэш проверенных JWT-токенов (токен -> пользователь), чтобы не обращаться к БД на каждый запрос.
+    # TTL ограничивает, как долго другой процесс может не видеть изменения пользователя
+    AUTH_CACHE_ENABLED = os.environ.get('AUTH_CACHE_ENABLED', '1') not in ('0', 'false', 'False')
+    AUTH_CACHE_TTL = int(os.environ.get('AUTH_CACHE_TTL', 60))
+    AUTH_CACHE_MAX_ENTRIES = int(os.environ.get('AUTH_CACHE_MAX_ENTRIES', 10000))
+
+    # Хеширование паролей: метод werkzeug и стоимость (число итераций pbkdf2). Хеши, созданные
+    # другим методом или стоимостью, пересохраняются при успешном входе
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256')
+    PASSWORD_HASH_ITERATIONS = int(os.environ.get('PASSWORD_HASH_ITERATIONS', 260000))
+    # Число процессов пула хеширования (0 - хешировать в потоке запроса) и лимит ожидающих задач
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+    PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 32))
+    PASSWORD_HASH_QUEUE_TIMEOUT = 5 # сек ожидания свободного места в пуле
+
+    # Бюджет токенов контекста (системный промпт + история диалога, оценка ~4 символа на токен):
+    # при превышении старые реплики отбрасываются. CONTEXT_TOKEN_BUDGET - для всех моделей (0 - без
+    # ограничения), CONTEXT_TOKEN_BUDGETS - для отдельных моделей: "gemini-2.0-flash=64000,gemini-1.5-flash-8b=16000".
+    # Выключено по умолчанию: окно контекста моделей Gemini (~1M токенов) обычно не достигается, а обрезка
+    # со сводкой меняет ответы модели
+    CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 0))
+    CONTEXT_TOKEN_BUDGETS = {
+        model.strip(): int(budget)
+        for model, _, budget in (item.partition('=') for item in os.environ.get('CONTEXT_TOKEN_BUDGETS', '').split(','))
+        if model.strip() and budget.strip()
+    }
+    # Размер скользящей сводки отброшенных реплик (в токенах, 0 - отброшенные реплики забываются)
+    CONTEXT_SUMMARY_MAX_TOKENS = int(os.environ.get('CONTEXT_SUMMARY_MAX_TOKENS', 0))
+
+    # Кэш ответов на первое сообщение чата (одинаковые вопросы в новых чатах одной модели не идут в API).
+    # Ключ - модель, хеш системного промпта и точный текст сообщения; выключен по умолчанию
+    RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', '0') in ('1', 'true', 'True')
+    RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 3600))
+    RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 1000))
+    RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+    # Одновременные одинаковые первые сообщения (тот же ключ) обслуживаются одной генерацией модели
+    SINGLE_FLIGHT_ENABLED = os.environ.get('SINGLE_FLIGHT_ENABLED', '0') in ('1', 'true', 'True')
+
+    # Метрики в формате Prometheus (GET /metrics): время запросов по маршрутам, запросов к БД,
+    # потоков ответа модели. Выключены по умолчанию: метрики раскрывают внутреннее устройство
+    # и нагрузку сервиса. При заданном METRICS_TOKEN эндпоинт требует заголовок
+    # Authorization: Bearer <METRICS_TOKEN>, без него открыт всем - тогда закрывайте его на прокси
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '0') in ('1', 'true', 'True')
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN') or None
+
+    # Как часто (в секундах) проверять изменение файлов промптов в app/prompts
+    PROMPT_RELOAD_CHECK_INTERVAL = float(os.environ.get('PROMPT_RELOAD_CHECK_INTERVAL', 2.0))
+
+    # Модели, для которых системный промпт кэшируется на стороне API (context caching).
+    # Поддерживается не всеми моделями и требует минимального размера промпта - при ошибке
+    # промпт передается как обычный system_instruction
+    GEMINI_CONTEXT_CACHE_MODELS = [m for m in os.environ.get('GEMINI_CONTEXT_CACHE_MODELS', '').split(',') if m]
+    GEMINI_CONTEXT_CACHE_TTL = int(os.environ.get('GEMINI_CONTEXT_CACHE_TTL', 3600))
+
+    # Фейковая модель (LLM_BACKEND=fake): шаблон ответа (подстановки {message}, {model}, {turn})
+    # и число его повторов, текст размышлений в <think> (пусто - без них), размер чанка в символах,
+    # задержки до первого чанка и между чанками (мс), каждый N-й запрос завершается ошибкой (0 - никогда)
+    FAKE_LLM_RESPONSE = os.environ.get('FAKE_LLM_RESPONSE', 'Тестовый ответ модели {model} на сообщение: {message}')
+    FAKE_LLM_RESPONSE_REPEAT = int(os.environ.get('FAKE_LLM_RESPONSE_REPEAT', 1))
+    FAKE_LLM_THOUGHTS = os.environ.get('FAKE_LLM_THOUGHTS', '')
+    FAKE_LLM_CHUNK_CHARS = int(os.environ.get('FAKE_LLM_CHUNK_CHARS', 16))
+    FAKE_LLM_FIRST_TOKEN_MS = float(os.environ.get('FAKE_LLM_FIRST_TOKEN_MS', 300))
+    FAKE_LLM_CHUNK_DELAY_MS = float(os.environ.get('FAKE_LLM_CHUNK_DELAY_MS', 20))
+    FAKE_LLM_ERROR_EVERY = int(os.environ.get('FAKE_LLM_ERROR_EVERY', 0))
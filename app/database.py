@@ -1,6 +1,9 @@
 # app/database.py
+import os
 import sqlite3
 import logging
+import threading
+from time import perf_counter
 from flask import g, current_app # Импортируем current_app для доступа к конфигу
 
 # Убираем импорт Config, он больше не нужен напрямую здесь
@@ -11,8 +14,131 @@ logger = logging.getLogger(__name__)
 # Убираем DATABASE = Config.DATABASE_URL, будем получать из app.config
 DATABASE_URL = None # Эта переменная будет установлена в init_app
 
+# Настройки соединений по умолчанию (переопределяются из app.config в init_app)
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL', # Читатели не блокируют писателя и наоборот
+    'synchronous': 'NORMAL', # В режиме WAL безопасно и заметно быстрее FULL
+    'busy_timeout': 5000, # мс ожидания блокировки вместо мгновенного "database is locked"
+    'foreign_keys': 'ON',
+    'cache_size': -20000, # Отрицательное значение - размер в КиБ (~20 МБ)
+}
+PRAGMAS = dict(DEFAULT_PRAGMAS)
+POOL_ENABLED = True # Переиспользовать соединение потока между запросами
+
+# Длина превью последнего сообщения, хранимого в chats.last_message_preview
+LAST_MESSAGE_PREVIEW_LEN = 200
+
+# Замер времени запросов для метрик: callable(operation, seconds) или None (замер выключен).
+# Устанавливается в configure_pool при METRICS_ENABLED
+_query_observer = None
+_QUERY_OPERATIONS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'PRAGMA', 'WITH'}
+
+
+def _observe_query(sql, seconds):
+    words = sql.split(None, 1)
+    operation = words[0].upper() if words else ''
+    _query_observer(operation if operation in _QUERY_OPERATIONS else 'OTHER', seconds)
+
+
+class _TimedCursor(sqlite3.Cursor):
+    """Курсор, сообщающий время выполнения execute/executemany в _query_observer."""
+
+    def execute(self, sql, parameters=()):
+        start = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _observe_query(sql, perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _observe_query(sql, perf_counter() - start)
+
+
+class _TimedConnection(sqlite3.Connection):
+    """Соединение с замером запросов: и db.execute(), и db.cursor().execute() идут через _TimedCursor."""
+
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+# Соединения, закрепленные за потоками: {db_url: connection}. PID нужен, так как
+# соединения SQLite нельзя использовать в дочернем процессе после fork
+_local = threading.local()
+
+
+def create_connection(db_url, pragmas=None):
+    """Открывает соединение с БД и применяет PRAGMA-настройки."""
+    pragmas = PRAGMAS if pragmas is None else pragmas
+    busy_timeout = pragmas.get('busy_timeout', 5000)
+    factory = _TimedConnection if _query_observer is not None else sqlite3.Connection
+    conn = sqlite3.connect(db_url, detect_types=sqlite3.PARSE_DECLTYPES, timeout=busy_timeout / 1000,
+                           factory=factory)
+    conn.row_factory = sqlite3.Row # Возвращать строки как объекты, похожие на dict
+    for name, value in pragmas.items():
+        if value is None:
+            continue
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
+
+def _thread_connections():
+    """Соединения текущего потока; после fork унаследованные соединения отбрасываются."""
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.connections = {}
+    return _local.connections
+
+
+def _acquire_connection(db_url):
+    """Возвращает соединение потока для db_url (создает при первом обращении)."""
+    if not POOL_ENABLED:
+        return create_connection(db_url)
+    connections = _thread_connections()
+    conn = connections.get(db_url)
+    if conn is None:
+        conn = create_connection(db_url)
+        connections[db_url] = conn
+        logger.debug(f"Создано новое соединение с БД для потока {threading.current_thread().name}: {db_url}")
+    return conn
+
+
+def _release_connection(conn):
+    """Возвращает соединение в пул потока: незавершенная транзакция откатывается."""
+    if not POOL_ENABLED:
+        conn.close()
+        return
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+    except sqlite3.Error as e:
+        # Соединение в неизвестном состоянии - закрываем, следующий запрос откроет новое
+        logger.warning(f"Ошибка при возврате соединения в пул, соединение закрыто: {e}")
+        close_thread_connections()
+
+
+def close_thread_connections():
+    """Закрывает все соединения текущего потока (например, при завершении фонового потока)."""
+    connections = _thread_connections()
+    while connections:
+        _, conn = connections.popitem()
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+
 def get_db():
-    """Возвращает соединение с БД для текущего запроса."""
+    """Возвращает соединение с БД для текущего запроса (соединение потока из пула)."""
     db_url = DATABASE_URL # Используем глобальную переменную модуля
     if not db_url:
          # Если DATABASE_URL не установлен, пытаемся получить его из current_app
@@ -26,20 +152,18 @@ def get_db():
 
     if 'db' not in g:
         try:
-            g.db = sqlite3.connect(db_url, detect_types=sqlite3.PARSE_DECLTYPES)
-            g.db.row_factory = sqlite3.Row # Возвращать строки как объекты, похожие на dict
-            logger.debug(f"Создано новое соединение с БД: {db_url}")
+            g.db = _acquire_connection(db_url)
         except sqlite3.Error as e:
             logger.error(f"Ошибка подключения к БД {db_url}: {e}")
             raise # Передаем ошибку выше
     return g.db
 
 def close_db(e=None):
-    """Закрывает соединение с БД в конце запроса."""
+    """Освобождает соединение с БД в конце запроса (возвращает его в пул потока)."""
     db = g.pop('db', None)
     if db is not None:
-        db.close()
-        logger.debug("Соединение с БД закрыто.")
+        _release_connection(db)
+        logger.debug("Соединение с БД освобождено.")
 
 def _check_and_apply_migrations(conn):
     """Проверяет и применяет простые миграции схемы."""
@@ -56,6 +180,117 @@ def _check_and_apply_migrations(conn):
         else:
             logger.debug("Колонка 'thoughts' уже существует в таблице 'messages'.")
 
+        # HTML ответа бота, собранный при сохранении (utils/markdown_render.py), и версия рендерера.
+        # Старые сообщения заполняются командой `flask backfill-html`
+        if 'content_html' not in columns:
+            logger.info("Обнаружено отсутствие колонки 'content_html'. Применяется миграция...")
+            cursor.execute("ALTER TABLE messages ADD COLUMN content_html TEXT NULL")
+            cursor.execute("ALTER TABLE messages ADD COLUMN content_html_version INTEGER NULL")
+            conn.commit()
+            logger.info("Колонки 'content_html' и 'content_html_version' добавлены в таблицу 'messages'.")
+
+        # Проверка наличия колонки 'context_start_id' в таблице 'chats'
+        # (ID последнего сообщения перед сбросом контекста нейросети)
+        cursor.execute("PRAGMA table_info(chats)")
+        chat_columns = [column[1].lower() for column in cursor.fetchall()]
+        if 'context_start_id' not in chat_columns:
+            logger.info("Обнаружено отсутствие колонки 'context_start_id'. Применяется миграция...")
+            cursor.execute("ALTER TABLE chats ADD COLUMN context_start_id INTEGER NOT NULL DEFAULT 0")
+            conn.commit()
+            logger.info("Колонка 'context_start_id' успешно добавлена в таблицу 'chats'.")
+        else:
+            logger.debug("Колонка 'context_start_id' уже существует в таблице 'chats'.")
+
+        # Выбранная в чате модель (NULL - модель по умолчанию): нужна, чтобы восстановить
+        # выгруженную из памяти сессию с той же моделью
+        if 'model_name' not in chat_columns:
+            logger.info("Обнаружено отсутствие колонки 'model_name' в 'chats'. Применяется миграция...")
+            cursor.execute("ALTER TABLE chats ADD COLUMN model_name TEXT NULL")
+            conn.commit()
+            logger.info("Колонка 'model_name' успешно добавлена в таблицу 'chats'.")
+
+        # Денормализованная сводка о последнем сообщении чата для списка чатов:
+        # last_message_id, last_message_preview и updated_at (время последней активности)
+        if 'last_message_id' not in chat_columns:
+            logger.info("Обнаружено отсутствие сводки последнего сообщения в 'chats'. Применяется миграция...")
+            cursor.execute("ALTER TABLE chats ADD COLUMN last_message_id INTEGER NULL")
+            cursor.execute("ALTER TABLE chats ADD COLUMN last_message_preview TEXT NULL")
+            cursor.execute("ALTER TABLE chats ADD COLUMN updated_at TIMESTAMP NULL")
+            # Заполняем сводку по уже существующим сообщениям
+            cursor.execute(f'''
+                UPDATE chats SET
+                    last_message_id = (SELECT MAX(m.id) FROM messages m WHERE m.chat_id = chats.id),
+                    last_message_preview = (SELECT substr(m.content, 1, {LAST_MESSAGE_PREVIEW_LEN}) FROM messages m
+                                            WHERE m.chat_id = chats.id ORDER BY m.id DESC LIMIT 1),
+                    updated_at = COALESCE((SELECT m.created_at FROM messages m
+                                           WHERE m.chat_id = chats.id ORDER BY m.id DESC LIMIT 1), created_at)
+            ''')
+            conn.commit()
+            logger.info("Сводка последнего сообщения добавлена в 'chats' и заполнена.")
+        else:
+            logger.debug("Сводка последнего сообщения уже существует в таблице 'chats'.")
+        # Сводка обновляется триггером при любой вставке сообщения (в том числе из потока
+        # групповой записи), поэтому код сервисов не должен ее поддерживать вручную
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_messages_update_chat_summary
+            AFTER INSERT ON messages
+            BEGIN
+                UPDATE chats SET
+                    last_message_id = NEW.id,
+                    last_message_preview = substr(NEW.content, 1, {LAST_MESSAGE_PREVIEW_LEN}),
+                    updated_at = NEW.created_at
+                WHERE id = NEW.chat_id;
+            END
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_chats_user_updated_at ON chats (user_id, updated_at DESC, id DESC)')
+        conn.commit()
+
+        # Составной индекс (chat_id, id) для keyset-пагинации сообщений;
+        # он покрывает и запросы по одному chat_id, поэтому старый индекс не нужен
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat_id_id ON messages (chat_id, id)')
+        cursor.execute('DROP INDEX IF EXISTS idx_messages_chat_id')
+        conn.commit()
+
+        # Счетчики версий для ETag: chats.version - сообщения чата, users.chats_version - список
+        # чатов пользователя. Увеличиваются триггерами при любой записи сообщений и чатов
+        if 'version' not in chat_columns:
+            logger.info("Обнаружено отсутствие колонки 'version' в 'chats'. Применяется миграция...")
+            cursor.execute("ALTER TABLE chats ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            conn.commit()
+        cursor.execute("PRAGMA table_info(users)")
+        user_columns = [column[1].lower() for column in cursor.fetchall()]
+        if 'chats_version' not in user_columns:
+            logger.info("Обнаружено отсутствие колонки 'chats_version' в 'users'. Применяется миграция...")
+            cursor.execute("ALTER TABLE users ADD COLUMN chats_version INTEGER NOT NULL DEFAULT 0")
+            conn.commit()
+        for event, row in (('INSERT', 'NEW'), ('DELETE', 'OLD')):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_messages_{event.lower()}_bump_version
+                AFTER {event} ON messages
+                BEGIN
+                    UPDATE chats SET version = version + 1 WHERE id = {row}.chat_id;
+                    UPDATE users SET chats_version = chats_version + 1
+                    WHERE id = (SELECT user_id FROM chats WHERE id = {row}.chat_id);
+                END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_chats_{event.lower()}_bump_version
+                AFTER {event} ON chats
+                BEGIN
+                    UPDATE users SET chats_version = chats_version + 1 WHERE id = {row}.user_id;
+                END
+            ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_chats_title_bump_version
+            AFTER UPDATE OF title ON chats
+            BEGIN
+                UPDATE users SET chats_version = chats_version + 1 WHERE id = NEW.user_id;
+            END
+        ''')
+        conn.commit()
+
+        _create_search_index(conn)
+
         # Здесь можно добавить другие проверки миграций в будущем
         # Например, проверка наличия другой колонки или индекса
 
@@ -70,6 +305,68 @@ def _check_and_apply_migrations(conn):
         conn.rollback() # Откатываем на всякий случай
         # Не прерываем работу, но логируем ошибку
 
+def _create_search_index(conn):
+    """
+    Полнотекстовый индекс сообщений (FTS5, external content над messages) и триггеры синхронизации.
+
+    user_id индексируется отдельной колонкой: поиск в пределах пользователя - пересечение списков
+    документов в индексе, а не фильтрация всех совпадений. Сообщения, существовавшие до создания
+    индекса (id <= target_id), индексируются постепенно небольшими транзакциями
+    (services/search_service.py), indexed_id - докуда они уже проиндексированы. Удаление и изменение
+    еще не проиндексированной строки не должны трогать индекс - отсюда условие WHEN у триггеров.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")
+    if cursor.fetchone():
+        logger.debug("Полнотекстовый индекс 'messages_fts' уже существует.")
+        return
+    logger.info("Обнаружено отсутствие полнотекстового индекса 'messages_fts'. Применяется миграция...")
+    conn.commit()
+    try:
+        # Таблица, триггеры и граница уже существующих сообщений - в одной транзакции, чтобы каждая
+        # строка попала в индекс ровно одним путем: через триггер или через постепенную индексацию
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+            CREATE VIRTUAL TABLE messages_fts USING fts5(
+                content, user_id,
+                content='messages', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+        cursor.execute('CREATE TABLE search_index_state (target_id INTEGER NOT NULL, indexed_id INTEGER NOT NULL)')
+        cursor.execute('INSERT INTO search_index_state SELECT COALESCE(MAX(id), 0), 0 FROM messages')
+        indexed = ('(OLD.id > (SELECT target_id FROM search_index_state) '
+                   'OR OLD.id <= (SELECT indexed_id FROM search_index_state))')
+        cursor.execute('''
+            CREATE TRIGGER trg_messages_fts_insert AFTER INSERT ON messages
+            BEGIN
+                INSERT INTO messages_fts (rowid, content, user_id) VALUES (NEW.id, NEW.content, NEW.user_id);
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER trg_messages_fts_delete AFTER DELETE ON messages WHEN {indexed}
+            BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, content, user_id)
+                VALUES ('delete', OLD.id, OLD.content, OLD.user_id);
+            END
+        ''')
+        # Только по изменению индексируемых колонок (заполнение content_html индекс не трогает)
+        cursor.execute(f'''
+            CREATE TRIGGER trg_messages_fts_update AFTER UPDATE OF content, user_id ON messages WHEN {indexed}
+            BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, content, user_id)
+                VALUES ('delete', OLD.id, OLD.content, OLD.user_id);
+                INSERT INTO messages_fts (rowid, content, user_id) VALUES (NEW.id, NEW.content, NEW.user_id);
+            END
+        ''')
+        conn.commit()
+        logger.info("Полнотекстовый индекс 'messages_fts' создан, существующие сообщения будут проиндексированы в фоне.")
+    except sqlite3.OperationalError as e:
+        conn.rollback()
+        if 'fts5' not in str(e).lower():
+            raise
+        logger.warning(f"SQLite собран без FTS5 - поиск по сообщениям недоступен: {e}")
+
 def init_db(db_url):
     """Инициализирует таблицы и применяет миграции."""
     try:
@@ -111,7 +408,7 @@ def init_db(db_url):
                 )
             ''')
             # Индексы для ускорения запросов
-            c.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages (chat_id)')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat_id_id ON messages (chat_id, id)')
             c.execute('CREATE INDEX IF NOT EXISTS idx_chats_user_id ON chats (user_id)')
             c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_users_email ON users (email)')
 
@@ -125,6 +422,28 @@ def init_db(db_url):
         logger.error(f"Критическая ошибка инициализации базы данных '{db_url}': {e}")
         raise
 
+def configure_pool(config):
+    """
+    Применяет настройки соединений (SQLITE_* и DB_POOL_ENABLED) из конфигурации приложения.
+    При METRICS_ENABLED новые соединения замеряют время запросов (db_query_duration_seconds).
+    """
+    global PRAGMAS, POOL_ENABLED, _query_observer
+    PRAGMAS = {
+        'journal_mode': config.get('SQLITE_JOURNAL_MODE', DEFAULT_PRAGMAS['journal_mode']),
+        'synchronous': config.get('SQLITE_SYNCHRONOUS', DEFAULT_PRAGMAS['synchronous']),
+        'busy_timeout': int(config.get('SQLITE_BUSY_TIMEOUT_MS', DEFAULT_PRAGMAS['busy_timeout'])),
+        'foreign_keys': 'ON' if config.get('SQLITE_FOREIGN_KEYS', True) else 'OFF',
+        'cache_size': int(config.get('SQLITE_CACHE_SIZE', DEFAULT_PRAGMAS['cache_size'])),
+    }
+    POOL_ENABLED = bool(config.get('DB_POOL_ENABLED', True))
+    if config.get('METRICS_ENABLED', False):
+        from .utils import metrics
+        _query_observer = lambda operation, seconds: metrics.DB_QUERY_DURATION.labels(operation).observe(seconds)
+    else:
+        _query_observer = None
+    logger.info(f"Настройки соединений SQLite: {PRAGMAS}, пул потоков: {'вкл' if POOL_ENABLED else 'выкл'}")
+
+
 def init_app(app):
     """Регистрирует функции управления БД в приложении Flask."""
     global DATABASE_URL
@@ -139,7 +458,8 @@ def init_app(app):
          logger.critical(e)
          raise e
 
-    app.teardown_appcontext(close_db) # Регистрируем закрытие соединения
+    configure_pool(app.config)
+    app.teardown_appcontext(close_db) # Регистрируем освобождение соединения
 
     # Инициализируем БД (создание таблиц + миграции) при старте приложения
     # Используем app.app_context() для доступа к конфигурации
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import time
+from itertools import count
+from app.config import Config # Импортируем конфигурацию
+from app.external.llm_backend import ChatBackend, GeminiModel, ChunkKind, StreamChunk, prompt_registry
+
+logger = logging.getLogger(__name__)
+
+# Маркеры в тексте сообщения, по которым фейковая модель имитирует сбой
+ERROR_MARKER = '[fake:error]'
+BLOCKED_MARKER = '[fake:blocked]'
+
+# Сквозной номер запроса в процессе (для FAKE_LLM_ERROR_EVERY)
+_request_counter = count(1)
+
+
+class FakeChat(ChatBackend):
+    """
+    Детерминированная локальная модель для нагрузочных тестов и бенчмарков (LLM_BACKEND=fake).
+
+    Не обращается к внешним API: ответ собирается из шаблона FAKE_LLM_RESPONSE, при заданном
+    FAKE_LLM_THOUGHTS перед ним идет блок <think>. Текст отдается чанками по FAKE_LLM_CHUNK_CHARS
+    символов с задержкой FAKE_LLM_FIRST_TOKEN_MS до первого чанка и FAKE_LLM_CHUNK_DELAY_MS между
+    остальными. Ошибки: каждый FAKE_LLM_ERROR_EVERY-й запрос процесса, а также сообщения
+    с маркерами [fake:error] и [fake:blocked].
+    """
+
+    # Без объектов SDK сессия - это только список реплик
+    SESSION_OVERHEAD_BYTES = 1024
+    TURN_OVERHEAD_BYTES = 300
+
+    def __init__(self, model_name=GeminiModel.BEYKUS_SMALL.value, history=None):
+        self.model_name = model_name
+        self._load_system_prompt()
+        self.history = self._fit_history([{'role': h['role'], 'parts': list(h['parts'])} for h in history or []])
+        logger.info(f"Инициализирован экземпляр FakeChat с моделью: {model_name} (реплик в истории: {len(self.history)})")
+
+    def _load_system_prompt(self):
+        prompt = prompt_registry.get(self.model_name)
+        self.system_prompt = prompt.text
+        self.system_prompt_hash = prompt.hash
+
+    def _build_response(self, message):
+        """Полный текст ответа (с блоком <think>, если размышления включены)."""
+        response = Config.FAKE_LLM_RESPONSE.format(message=message, model=self.model_name,
+                                                   turn=len(self.history) // 2 + 1)
+        response = ' '.join([response] * max(1, Config.FAKE_LLM_RESPONSE_REPEAT))
+        if Config.FAKE_LLM_THOUGHTS:
+            return f"<think>{Config.FAKE_LLM_THOUGHTS}</think>{response}"
+        return response
+
+    def _plan(self, message):
+        """
+        Готовит ответ на сообщение: возвращает (chunks, failure), где chunks - список
+        (задержка в секундах, StreamChunk), а failure - итоговый StreamChunk ошибки или None.
+        """
+        error_every = Config.FAKE_LLM_ERROR_EVERY
+        if BLOCKED_MARKER in message:
+            return [], StreamChunk(ChunkKind.BLOCKED, 'FAKE_BLOCK_REASON')
+        fail = ERROR_MARKER in message or (error_every > 0 and next(_request_counter) % error_every == 0)
+
+        text = self._build_response(message)
+        size = max(1, Config.FAKE_LLM_CHUNK_CHARS)
+        first_delay = Config.FAKE_LLM_FIRST_TOKEN_MS / 1000.0
+        chunk_delay = Config.FAKE_LLM_CHUNK_DELAY_MS / 1000.0
+        chunks = [(first_delay if i == 0 else chunk_delay, StreamChunk(ChunkKind.TEXT, text[i:i + size]))
+                  for i in range(0, len(text), size)]
+        if fail:
+            # Обрыв посередине ответа, как при ошибке API во время стриминга
+            return chunks[:len(chunks) // 2], StreamChunk(ChunkKind.ERROR, 'Fake API Error: simulated failure')
+        return chunks, None
+
+    def append_turn(self, message, response_text):
+        self._remember(message, response_text)
+
+    def _remember(self, message, response):
+        self.history.append({'role': 'user', 'parts': [message]})
+        self.history.append({'role': 'model', 'parts': [response]})
+        if self._account_turn(message, response):
+            self.history = self._fit_history(self.history)
+
+    def get_streaming_response(self, message):
+        chunks, failure = self._plan(message)
+        for delay, chunk in chunks:
+            if delay:
+                time.sleep(delay)
+            yield chunk
+        if failure:
+            yield failure
+            return
+        self._remember(message, ''.join(chunk.text for _, chunk in chunks))
+
+    async def get_streaming_response_async(self, message):
+        chunks, failure = self._plan(message)
+        for delay, chunk in chunks:
+            if delay:
+                await asyncio.sleep(delay)
+            yield chunk
+        if failure:
+            yield failure
+            return
+        self._remember(message, ''.join(chunk.text for _, chunk in chunks))
+
+    def get_history(self):
+        return [{'role': h['role'], 'parts': list(h['parts'])} for h in self.history]
+
+    def reset_chat(self):
+        self.history = []
+        self.history_tokens = 0
+        self._load_system_prompt()
+        logger.info(f"История фейкового чата для модели {self.model_name} сброшена.")
+
+    def change_model(self, new_model_name):
+        self.check_model_name(new_model_name)
+        self.model_name = new_model_name
+        self.reset_chat()
@@ -1,12 +1,12 @@
 import google.generativeai as genai
-import os
+from google.api_core import exceptions as google_exceptions
+import asyncio
 import logging
-from enum import Enum
-import markdown
-import bleach
-import re
-import json
+from datetime import timedelta
+from threading import Event, Lock
+from time import monotonic
 from app.config import Config # Импортируем конфигурацию
+from app.external.llm_backend import ChatBackend, GeminiModel, ChunkKind, StreamChunk, prompt_registry
 
 logger = logging.getLogger(__name__)
 
@@ -24,181 +24,262 @@ except Exception as e:
     logger.critical(f"Ошибка конфигурации Google Generative AI SDK: {e}")
     raise
 
-class GeminiModel(Enum):
-    BEYKUS_SMALL = "gemini-2.0-flash"
-    BEYKUS_CHAT = "gemini-1.5-flash-8b"
-    BEYKUS_SMALL_R = "gemini-2.0-pro-exp-02-05"
+# Кэши контекста (CachedContent) с системным промптом: (model_name, prompt_hash) -> (cached_content, valid_until).
+# cached_content = None - создание не удалось (модель не поддерживает кэширование или промпт слишком мал),
+# повторная попытка не раньше valid_until
+_context_caches = {}
+# Ключи, для которых кэш сейчас создается (key -> Event): запрос к API выполняется вне общей
+# блокировки, остальные потоки ждут только создания кэша для того же ключа
+_context_caches_pending = {}
+_context_caches_lock = Lock()
+CONTEXT_CACHE_CREATE_WAIT = 30 # Сколько ждать кэш, создаваемый другим потоком (сек), затем - без кэша
 
-class GeminiChat:
-    def __init__(self, model_name=GeminiModel.BEYKUS_SMALL.value):
+
+def _get_cached_content(model_name: str, system_prompt: str, prompt_hash: str):
+    """
+    Возвращает кэш контекста с системным промптом для модели или None.
+
+    Кэширование включается только для моделей из Config.GEMINI_CONTEXT_CACHE_MODELS:
+    закэшированные токены промпта не обрабатываются заново и тарифицируются по сниженной ставке.
+    """
+    if model_name not in getattr(Config, 'GEMINI_CONTEXT_CACHE_MODELS', ()):
+        return None
+    ttl = getattr(Config, 'GEMINI_CONTEXT_CACHE_TTL', 3600)
+    key = (model_name, prompt_hash)
+    while True:
+        with _context_caches_lock:
+            entry = _context_caches.get(key)
+            if entry is not None and entry[1] > monotonic():
+                return entry[0]
+            pending = _context_caches_pending.get(key)
+            if pending is None:
+                pending = _context_caches_pending[key] = Event()
+                break
+        if not pending.wait(CONTEXT_CACHE_CREATE_WAIT):
+            return None
+
+    entry = (None, monotonic() + ttl)
+    try:
+        full_name = model_name if model_name.startswith('models/') else f"models/{model_name}"
+        cached = genai.caching.CachedContent.create(
+            model=full_name,
+            system_instruction=system_prompt,
+            ttl=timedelta(seconds=ttl)
+        )
+        # Обновляем кэш немного раньше истечения на стороне API (живые сессии переходят
+        # на новый кэш перед следующей репликой - GeminiChat._refresh_context_cache)
+        entry = (cached, monotonic() + ttl * 0.9)
+        logger.info(f"Создан кэш контекста для {model_name} (prompt {prompt_hash[:12]}), TTL {ttl} сек")
+    except Exception as e:
+        logger.warning(f"Кэш контекста для {model_name} не создан, промпт передается напрямую: {e}")
+    finally:
+        with _context_caches_lock:
+            _context_caches[key] = entry
+            del _context_caches_pending[key]
+        pending.set()
+    return entry[0]
+
+
+def _invalidate_cached_content(model_name: str, prompt_hash: str, cached_content):
+    """Забывает кэш контекста, отклоненный API (истек или удален): следующий запрос создаст новый."""
+    with _context_caches_lock:
+        entry = _context_caches.get((model_name, prompt_hash))
+        if entry is not None and entry[0] is cached_content:
+            del _context_caches[(model_name, prompt_hash)]
+
+class GeminiChat(ChatBackend):
+    def __init__(self, model_name=GeminiModel.BEYKUS_SMALL.value, history=None):
         self.model_name = model_name
         self.system_prompt = "" # Будет загружен в _initialize_model
+        self.system_prompt_hash = None # Хеш промпта (ключ для кэшей, зависящих от промпта)
         self.model = None
         self.chat = None
+        self._cached_content = None # Кэш контекста, из которого создана self.model
         try:
-            self._initialize_model()
+            # history - ранее сохраненные реплики диалога (без системного промпта),
+            # позволяет восстановить контекст после выгрузки инстанса из памяти
+            self._initialize_model(history=history)
             logger.info(f"Инициализирован экземпляр GeminiChat с моделью: {model_name}")
         except Exception as e:
             logger.error(f"Критическая ошибка инициализации GeminiChat ({model_name}): {e}")
             raise # Передаем исключение выше
 
-    def _initialize_model(self):
-        """Инициализирует модель и чат, включая загрузку промпта."""
+    def _initialize_model(self, history=None):
+        """Инициализирует модель и чат, включая загрузку промпта и (опционально) истории."""
         try:
-            self.model = genai.GenerativeModel(self.model_name)
             self.system_prompt = self._load_system_prompt()
-            # Сразу начинаем чат с системным промптом
-            self.chat = self.model.start_chat(history=[
-                {'role': 'user', 'parts': [f'System: {self.system_prompt}']}, # Явное указание роли System
-                {'role': 'model', 'parts': ['Understood. I will follow these instructions.']}
-            ])
-            logger.info(f"Модель {self.model_name} и чат инициализированы.")
+            # Промпт передается как system_instruction модели, а не фиктивными репликами в истории:
+            # так он не смешивается с диалогом и, где поддерживается, берется из кэша контекста
+            cached_content = _get_cached_content(self.model_name, self.system_prompt, self.system_prompt_hash)
+            self._build_model(cached_content)
+            history = self._fit_history(list(history or [])) # Не больше бюджета токенов модели
+            self.chat = self.model.start_chat(history=history)
+            logger.info(f"Модель {self.model_name} и чат инициализированы (восстановлено реплик: {len(history)}"
+                        f"{', промпт из кэша контекста' if cached_content is not None else ''}).")
             logger.debug(f"Загружен системный промпт (начало): {self.system_prompt[:150]}...")
         except Exception as e:
             logger.error(f"Ошибка при инициализации модели {self.model_name} или чата: {e}")
             raise
 
+    def _build_model(self, cached_content):
+        """Создает объект модели: из кэша контекста или с промптом в system_instruction."""
+        self._cached_content = cached_content
+        if cached_content is not None:
+            self.model = genai.GenerativeModel.from_cached_content(cached_content)
+        else:
+            self.model = genai.GenerativeModel(self.model_name, system_instruction=self.system_prompt)
+
+    def _rebuild_model(self, cached_content):
+        """Пересоздает модель с другим кэшем контекста, сохраняя историю (локально, без запросов к API)."""
+        history = self.get_history()
+        self._build_model(cached_content)
+        self.chat = self.model.start_chat(history=history)
+
+    def _refresh_context_cache(self):
+        """
+        Перед репликой переходит на актуальный кэш контекста: сессия может жить дольше TTL кэша,
+        с которым она создана, а после его истечения на стороне API запросы с ним отклоняются.
+        """
+        if self._cached_content is None:
+            return
+        cached_content = _get_cached_content(self.model_name, self.system_prompt, self.system_prompt_hash)
+        if cached_content is not self._cached_content:
+            logger.info(f"Сессия {self.model_name} переходит на обновленный кэш контекста")
+            self._rebuild_model(cached_content)
+
+    def _drop_context_cache(self, error):
+        """Запрос с кэшем контекста отклонен - дальше промпт передается в system_instruction."""
+        logger.warning(f"Запрос с кэшем контекста {self.model_name} отклонен ({error}), повтор без кэша")
+        _invalidate_cached_content(self.model_name, self.system_prompt_hash, self._cached_content)
+        self._rebuild_model(None)
+
+    def get_history(self):
+        """Возвращает историю диалога в сериализуемом виде (системный промпт в ней не хранится)."""
+        if not self.chat:
+            return []
+        history = []
+        for content in self.chat.history:
+            parts = [part.text for part in content.parts if getattr(part, 'text', None)]
+            if parts:
+                history.append({'role': content.role, 'parts': parts})
+        return history
+
     def _load_system_prompt(self):
-        """Загружает и комбинирует системные промпты."""
+        """Возвращает собранный системный промпт модели из реестра (без чтения файлов)."""
         try:
-            model_map = {
-                GeminiModel.BEYKUS_SMALL.value: "BeykusSmall.txt",
-                GeminiModel.BEYKUS_SMALL_R.value: "BeykusSmallR.txt",
-                GeminiModel.BEYKUS_CHAT.value: "BeykusChat.txt"
-            }
-            # Важно: Путь относительно текущего файла gemini_api.py
-            prompts_dir = os.path.join(os.path.dirname(__file__), '..', 'prompts') # Поднимаемся на уровень выше
-
-            # Проверка существования директории
-            if not os.path.isdir(prompts_dir):
-                logger.error(f"Директория промптов не найдена: {prompts_dir}")
-                # Можно создать директорию или вернуть дефолтный промпт
-                # os.makedirs(prompts_dir)
-                # raise FileNotFoundError(f"Директория промптов не найдена: {prompts_dir}")
-                return "You are a helpful AI assistant. [Error: Prompts directory not found]"
-
-
-            default_prompt_path = os.path.join(prompts_dir, 'default.txt')
-            default_prompt = ""
-            if os.path.exists(default_prompt_path):
-                 with open(default_prompt_path, 'r', encoding='utf-8') as f:
-                    default_prompt = f.read().strip()
-            else:
-                 logger.warning(f"Файл default.txt не найден в {prompts_dir}")
-
-
-            model_file = model_map.get(self.model_name)
-            model_prompt = ""
-            if model_file:
-                model_prompt_path = os.path.join(prompts_dir, model_file)
-                if os.path.exists(model_prompt_path):
-                    with open(model_prompt_path, 'r', encoding='utf-8') as f:
-                        model_prompt = f.read().strip()
-                else:
-                    logger.warning(f"Файл промпта {model_file} не найден для модели {self.model_name}")
-
-            # Комбинируем промпты: специфичный для модели важнее, если он есть
-            if default_prompt and model_prompt:
-                 final_prompt = f"{default_prompt}\n\n{model_prompt}"
-            elif model_prompt:
-                 final_prompt = model_prompt
-            elif default_prompt:
-                 final_prompt = default_prompt
-            else:
-                 logger.error(f"Не удалось загрузить ни один файл промпта из {prompts_dir}")
-                 final_prompt = "You are a helpful AI assistant. [Error: No prompt files loaded]"
-
-            logger.debug(f"Финальный промпт для {self.model_name} собран.")
-            return final_prompt
-
+            prompt = prompt_registry.get(self.model_name)
+            self.system_prompt_hash = prompt.hash
+            logger.debug(f"Промпт для {self.model_name} получен из реестра (hash {prompt.hash[:12]}).")
+            return prompt.text
         except Exception as e:
             logger.error(f"Ошибка загрузки системного промпта: {e}")
             return "You are a helpful AI assistant. [Error loading system prompt]"
 
-    # format_markdown остается без изменений
+    # Параметры генерации, общие для синхронного и асинхронного стриминга
+    GENERATION_CONFIG = {'temperature': 0.8, 'top_p': 0.9}
 
-    def format_markdown(self, text):
-        """Форматирует текст в безопасный HTML с поддержкой Markdown"""
-        try:
-            # Улучшенная обработка блоков кода
-            def replace_code_block(match):
-                lang = match.group(1) or ''
-                code = match.group(2)
-                # Экранирование HTML внутри блока кода, если нужно
-                # code = bleach.clean(code, tags=[], strip=True)
-                return f'<pre><code class="language-{lang}">{code}</code></pre>'
-
-            text = re.sub(r'```(\w+)?\s*\n(.*?)\n```', replace_code_block, text, flags=re.DOTALL)
-
-            # Обработка inline-кода
-            text = re.sub(r'`([^`]+)`', r'<code>\1</code>', text)
-
-            # Базовое форматирование Markdown в HTML
-            html = markdown.markdown(text, extensions=['fenced_code', 'tables', 'nl2br']) # nl2br для переносов строк
-
-            # Очистка HTML
-            allowed_tags = [
-                'p', 'br', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
-                'strong', 'em', 'b', 'i',
-                'ul', 'ol', 'li',
-                'code', 'pre', # Добавляем класс для подсветки, если используется JS библиотека
-                'blockquote', 'a',
-                'table', 'thead', 'tbody', 'tr', 'th', 'td'
-            ]
-            allowed_attrs = {
-                'a': ['href', 'title'],
-                'pre': [], # Можно добавить 'class' если используется JS подсветка
-                'code': ['class'], # Для 'language-...'
-            }
-            # Включить strip=True, чтобы удалить неразрешенные теги полностью
-            cleaned_html = bleach.clean(html, tags=allowed_tags, attributes=allowed_attrs, strip=True)
-            return cleaned_html
-        except Exception as e:
-            logger.error(f"Ошибка форматирования Markdown: {str(e)}")
-            # В случае ошибки вернуть текст, обернутый в <pre> для сохранения форматирования
-            safe_text = bleach.clean(text, tags=[], strip=True)
-            return f"<pre>{safe_text}</pre>"
+    def _convert_chunk(self, chunk):
+        """
+        Преобразует чанк ответа SDK в StreamChunk.
+        Возвращает (stream_chunk, stop): stream_chunk - StreamChunk или None, stop - нужно ли прекратить поток.
+        """
+        # Проверка на наличие текста и обработка ошибок API
+        if chunk.parts:
+            text = ''.join(part.text for part in chunk.parts if hasattr(part, 'text'))
+            if text:
+                return StreamChunk(ChunkKind.TEXT, text), False
+            # Не логируем каждый пустой чанк, их может быть много
+            return None, False
+        if chunk.prompt_feedback and chunk.prompt_feedback.block_reason:
+            reason = chunk.prompt_feedback.block_reason
+            logger.warning(f"Запрос заблокирован API Gemini по причине: {reason}")
+            return StreamChunk(ChunkKind.BLOCKED, str(reason)), True # Прекращаем поток при блокировке
+        return None, False
 
+    def _error_chunk(self, e):
+        """Формирует StreamChunk с ошибкой, не раскрывая пользователю лишних деталей."""
+        if isinstance(e, google_exceptions.GoogleAPIError):
+            logger.error(f"Ошибка Google API при стриминге: {e}")
+            message = getattr(e, 'message', str(e))
+            return StreamChunk(ChunkKind.ERROR, f'Google API Error: {message}')
+        # Ловим более общие ошибки, которые могли не обработаться выше
+        error_type = type(e).__name__
+        logger.error(f"Неожиданная ошибка {error_type} в get_streaming_response: {e}")
+        return StreamChunk(ChunkKind.ERROR, 'An unexpected error occurred on the server.')
 
-    # get_streaming_response остается почти без изменений
     def get_streaming_response(self, message):
-        """Возвращает потоковый ответ от Gemini API"""
+        """Возвращает потоковый ответ от Gemini API в виде последовательности StreamChunk."""
         if not self.chat:
              logger.error("Попытка отправить сообщение без инициализированного чата.")
-             yield f"data: {json.dumps({'error': 'Chat not initialized'})}\n\n"
+             yield StreamChunk(ChunkKind.ERROR, 'Chat not initialized')
              return
 
         try:
-            # Системный промпт уже в истории, не нужно добавлять его снова
-            # prompt_reminder = f"User message: {message}" # Просто отправляем сообщение пользователя
-            response = self.chat.send_message(
-                message, # Отправляем чистое сообщение
-                stream=True,
-                generation_config={'temperature': 0.8, 'top_p': 0.9} # Немного другие параметры для примера
-            )
+            self._refresh_context_cache()
+            # Системный промпт задан в модели (system_instruction), отправляем только сообщение
+            try:
+                response = self.chat.send_message(message, stream=True, generation_config=self.GENERATION_CONFIG)
+            except google_exceptions.GoogleAPIError as e:
+                if self._cached_content is None:
+                    raise
+                self._drop_context_cache(e)
+                response = self.chat.send_message(message, stream=True, generation_config=self.GENERATION_CONFIG)
+            parts = []
             for chunk in response:
-                # Проверка на наличие текста и обработка ошибок API
-                if chunk.parts:
-                    text = ''.join(part.text for part in chunk.parts if hasattr(part, 'text'))
-                    if text:
-                        yield f"data: {json.dumps({'content': text})}\n\n"
-                    # else: # Не логируем каждый пустой чанк, их может быть много
-                    #     logger.debug("Получен чанк без текстового содержимого")
-                elif chunk.prompt_feedback and chunk.prompt_feedback.block_reason:
-                    reason = chunk.prompt_feedback.block_reason
-                    logger.warning(f"Запрос заблокирован API Gemini по причине: {reason}")
-                    yield f"data: {json.dumps({'error': f'Content blocked by API: {reason}'})}\n\n"
-                    return # Прекращаем поток при блокировке
-
-        except google.api_core.exceptions.GoogleAPIError as e:
-             logger.error(f"Ошибка Google API при стриминге: {e}")
-             yield f"data: {json.dumps({'error': f'Google API Error: {e.message}'})}\n\n"
+                stream_chunk, stop = self._convert_chunk(chunk)
+                if stream_chunk:
+                    if stream_chunk.kind is ChunkKind.TEXT:
+                        parts.append(stream_chunk.text)
+                    yield stream_chunk
+                if stop:
+                    return
+            self._after_turn(message, ''.join(parts))
         except Exception as e:
-            # Ловим более общие ошибки, которые могли не обработаться выше
-            error_type = type(e).__name__
-            logger.error(f"Неожиданная ошибка {error_type} в get_streaming_response: {e}")
-            # Не выводим все детали ошибки пользователю из соображений безопасности
-            yield f"data: {json.dumps({'error': 'An unexpected error occurred on the server.'})}\n\n"
+            yield self._error_chunk(e)
+
+    async def get_streaming_response_async(self, message):
+        """Асинхронный вариант get_streaming_response: ожидание чанков не блокирует поток."""
+        if not self.chat:
+             logger.error("Попытка отправить сообщение без инициализированного чата.")
+             yield StreamChunk(ChunkKind.ERROR, 'Chat not initialized')
+             return
+
+        try:
+            # Обновление кэша контекста может обращаться к API - не в event loop
+            await asyncio.get_running_loop().run_in_executor(None, self._refresh_context_cache)
+            try:
+                response = await self.chat.send_message_async(
+                    message, stream=True, generation_config=self.GENERATION_CONFIG)
+            except google_exceptions.GoogleAPIError as e:
+                if self._cached_content is None:
+                    raise
+                self._drop_context_cache(e)
+                response = await self.chat.send_message_async(
+                    message, stream=True, generation_config=self.GENERATION_CONFIG)
+            parts = []
+            async for chunk in response:
+                stream_chunk, stop = self._convert_chunk(chunk)
+                if stream_chunk:
+                    if stream_chunk.kind is ChunkKind.TEXT:
+                        parts.append(stream_chunk.text)
+                    yield stream_chunk
+                if stop:
+                    return
+            self._after_turn(message, ''.join(parts))
+        except Exception as e:
+            yield self._error_chunk(e)
+
+    def append_turn(self, message, response_text):
+        history = self.get_history() + [{'role': 'user', 'parts': [message]},
+                                        {'role': 'model', 'parts': [response_text]}]
+        self.chat = self.model.start_chat(history=history) # Локально, без запроса к API
+        self._after_turn(message, response_text)
+
+    def _after_turn(self, message, response_text):
+        """Учитывает реплику в размере контекста и при превышении бюджета сокращает историю."""
+        if self._account_turn(message, response_text):
+            # Пересоздание чата SDK с сокращенной историей выполняется локально, без запросов к API
+            self.chat = self.model.start_chat(history=self._fit_history(self.get_history()))
 
 
     def reset_chat(self):
@@ -216,15 +297,7 @@ class GeminiChat:
 
     def change_model(self, new_model_name):
         """Меняет модель Gemini и сбрасывает чат."""
-        # Проверяем, существует ли такая модель в нашем Enum (опционально, но полезно)
-        valid_model = False
-        for model_enum in GeminiModel:
-            if model_enum.value == new_model_name:
-                valid_model = True
-                break
-        if not valid_model:
-             logger.error(f"Попытка сменить на невалидную модель: {new_model_name}")
-             raise ValueError(f"Invalid model name: {new_model_name}")
+        self.check_model_name(new_model_name)
 
         if new_model_name == self.model_name:
              logger.info(f"Модель уже установлена на {new_model_name}. Сброс чата...")
@@ -0,0 +1,234 @@
+import logging
+import os
+import re
+import sys
+from collections import namedtuple
+from enum import Enum
+from app.config import Config # Импортируем конфигурацию
+from app.utils import metrics
+from app.utils.prompt_registry import PromptRegistry
+
+logger = logging.getLogger(__name__)
+
+
+class GeminiModel(Enum):
+    BEYKUS_SMALL = "gemini-2.0-flash"
+    BEYKUS_CHAT = "gemini-1.5-flash-8b"
+    BEYKUS_SMALL_R = "gemini-2.0-pro-exp-02-05"
+
+class ChunkKind(Enum):
+    TEXT = "text" # Фрагмент текста ответа
+    BLOCKED = "blocked" # Запрос заблокирован API (text - причина блокировки)
+    ERROR = "error" # Ошибка API/сервера (text - сообщение для пользователя)
+
+# Элемент потока ответа. SSE-кодирование выполняется один раз - на границе маршрута
+StreamChunk = namedtuple('StreamChunk', ['kind', 'text'])
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов текста (~4 символа на токен) без обращения к API модели."""
+    return (len(text) + 3) // 4
+
+# Системные промпты собираются один раз на процесс и перечитываются только при изменении файлов
+prompt_registry = PromptRegistry(
+    # Важно: Путь относительно текущего файла llm_backend.py
+    prompts_dir=os.path.normpath(os.path.join(os.path.dirname(__file__), '..', 'prompts')),
+    model_files={
+        GeminiModel.BEYKUS_SMALL.value: "BeykusSmall.txt",
+        GeminiModel.BEYKUS_SMALL_R.value: "BeykusSmallR.txt",
+        GeminiModel.BEYKUS_CHAT.value: "BeykusChat.txt"
+    },
+    check_interval=getattr(Config, 'PROMPT_RELOAD_CHECK_INTERVAL', 2.0)
+)
+
+
+# --- Окно контекста: бюджет токенов истории диалога ---
+
+# История сокращается не до самого бюджета, а с запасом, чтобы не пересобирать ее на каждой реплике
+TRIM_TARGET_RATIO = 0.75
+# Заголовок сводки отброшенных реплик (первая часть первой реплики пользователя в истории)
+SUMMARY_HEADER = "[Краткое содержание более ранней части разговора]"
+SUMMARY_LINE_CHARS = 160 # Сколько символов каждой отброшенной реплики попадает в сводку
+_THINK_BLOCK_RE = re.compile(r'<think>.*?(</think>|$)', re.DOTALL)
+
+
+def context_budget(model_name: str) -> int:
+    """Бюджет токенов контекста модели (системный промпт + история); 0 - без ограничения."""
+    budgets = getattr(Config, 'CONTEXT_TOKEN_BUDGETS', None) or {}
+    return budgets.get(model_name, getattr(Config, 'CONTEXT_TOKEN_BUDGET', 0))
+
+
+def history_tokens(history: list) -> int:
+    """Оценка числа токенов истории в формате [{'role', 'parts'}]."""
+    return sum(estimate_tokens(part) for turn in history for part in turn['parts'])
+
+
+def _split_summary(history: list):
+    """Отделяет сводку от истории. Возвращает (строки сводки, история без нее)."""
+    if not history or not history[0]['parts'] or not history[0]['parts'][0].startswith(SUMMARY_HEADER):
+        return [], history
+    first = history[0]
+    lines = first['parts'][0][len(SUMMARY_HEADER):].strip().splitlines()
+    rest = [{'role': first['role'], 'parts': first['parts'][1:]}] + history[1:]
+    return lines, rest
+
+
+def _summary_line(turn: dict) -> str:
+    text = ' '.join(_THINK_BLOCK_RE.sub('', part) for part in turn['parts'])
+    text = ' '.join(text.split()) # Переносы строк внутри реплики ломают разбор сводки
+    if len(text) > SUMMARY_LINE_CHARS:
+        text = text[:SUMMARY_LINE_CHARS].rstrip() + '…'
+    role = 'Пользователь' if turn['role'] == 'user' else 'Модель'
+    return f"- {role}: {text}"
+
+
+def fit_history(history: list, budget: int, reserved_tokens: int = 0, summary_max_tokens: int = 0):
+    """
+    Укладывает историю в бюджет токенов (reserved_tokens - системный промпт).
+
+    Если история не помещается, с начала отбрасываются целые реплики, пока она не займет
+    TRIM_TARGET_RATIO бюджета; последняя пара реплик сохраняется всегда, история по-прежнему
+    начинается с реплики пользователя. При summary_max_tokens > 0 отброшенные реплики в сокращенном
+    виде добавляются в сводку в начале первой реплики пользователя; сводка скользящая - старые
+    строки удаляются, когда она превышает summary_max_tokens.
+    Возвращает (история, число отброшенных реплик).
+    """
+    if budget <= 0 or history_tokens(history) + reserved_tokens <= budget:
+        return history, 0
+    summary_lines, turns = _split_summary(history)
+    target = budget * TRIM_TARGET_RATIO - reserved_tokens - summary_max_tokens # Место под сводку
+    total = history_tokens(turns)
+    start = 0
+    while start < len(turns) - 2 and (total > target or turns[start]['role'] != 'user'):
+        total -= history_tokens(turns[start:start + 1])
+        start += 1
+    dropped, kept = turns[:start], [dict(turn, parts=list(turn['parts'])) for turn in turns[start:]]
+    kept = [turn for turn in kept if turn['parts']]
+    if summary_max_tokens > 0 and kept:
+        lines = summary_lines + [_summary_line(turn) for turn in dropped if turn['parts']]
+        while lines and estimate_tokens('\n'.join(lines)) > summary_max_tokens:
+            lines.pop(0)
+        if lines:
+            kept[0]['parts'].insert(0, SUMMARY_HEADER + '\n' + '\n'.join(lines))
+    return kept, len(dropped)
+
+
+class ChatBackend:
+    """
+    Базовый интерфейс сессии чата с языковой моделью.
+
+    Реализации: GeminiChat (gemini_api.py, Google Gemini API) и FakeChat (fake_llm.py,
+    детерминированная локальная модель для нагрузочных тестов и бенчмарков без API).
+    Конструктор принимает model_name и history - ранее сохраненные реплики диалога
+    (без системного промпта) в виде [{'role': 'user' | 'model', 'parts': [str, ...]}].
+    """
+
+    model_name = GeminiModel.BEYKUS_SMALL.value
+    system_prompt = ""
+    system_prompt_hash = None # Хеш системного промпта (ключ для кэшей, зависящих от промпта)
+    history_tokens = 0 # Оценка токенов истории диалога (без системного промпта)
+    # Оценка памяти сессии без учета текста истории: объекты модели/сессии и одной реплики (байт)
+    SESSION_OVERHEAD_BYTES = 16 * 1024
+    TURN_OVERHEAD_BYTES = 512
+    context_trims = 0 # Сколько раз история сокращалась под бюджет
+    context_dropped_turns = 0 # Сколько реплик отброшено за все сокращения
+
+    def get_streaming_response(self, message):
+        """Отправляет сообщение и возвращает ответ в виде последовательности StreamChunk."""
+        raise NotImplementedError
+
+    def get_streaming_response_async(self, message):
+        """Асинхронный вариант get_streaming_response (асинхронный генератор StreamChunk)."""
+        raise NotImplementedError
+
+    def get_history(self) -> list:
+        """Возвращает историю диалога в сериализуемом виде (системный промпт в ней не хранится)."""
+        raise NotImplementedError
+
+    def append_turn(self, message: str, response_text: str):
+        """Добавляет в историю готовую пару реплик (например, ответ из кэша) без запроса к модели."""
+        raise NotImplementedError
+
+    def reset_chat(self):
+        """Сбрасывает историю диалога."""
+        raise NotImplementedError
+
+    def change_model(self, new_model_name):
+        """Меняет модель и сбрасывает чат. Бросает ValueError для неизвестной модели."""
+        raise NotImplementedError
+
+    def context_tokens(self) -> int:
+        """Оценка токенов, отправляемых модели на каждой реплике: системный промпт + история."""
+        return estimate_tokens(self.system_prompt or '') + self.history_tokens
+
+    def estimate_size(self) -> int:
+        """
+        Примерный объем памяти сессии в байтах: служебные объекты плюс строки и объекты реплик
+        истории. Системный промпт не учитывается - он общий для всех сессий модели (реестр промптов).
+        """
+        return self.SESSION_OVERHEAD_BYTES + sum(
+            self.TURN_OVERHEAD_BYTES + sum(sys.getsizeof(part) for part in turn['parts'])
+            for turn in self.get_history()
+        )
+
+    def context_stats(self) -> dict:
+        """Размер контекста сессии для логов и метрик."""
+        return {
+            'model': self.model_name,
+            'context_tokens': self.context_tokens(),
+            'budget': context_budget(self.model_name),
+            'trims': self.context_trims,
+            'dropped_turns': self.context_dropped_turns,
+        }
+
+    def _fit_history(self, history: list) -> list:
+        """Укладывает историю в бюджет токенов модели и пересчитывает history_tokens."""
+        fitted, dropped = fit_history(history, context_budget(self.model_name),
+                                      reserved_tokens=estimate_tokens(self.system_prompt or ''),
+                                      summary_max_tokens=getattr(Config, 'CONTEXT_SUMMARY_MAX_TOKENS', 0))
+        if dropped:
+            self.context_trims += 1
+            self.context_dropped_turns += dropped
+            metrics.LLM_CONTEXT_TRIMS.labels(self.model_name).inc()
+            metrics.LLM_CONTEXT_DROPPED_TURNS.labels(self.model_name).inc(dropped)
+            logger.info(f"История {self.model_name} сокращена под бюджет {context_budget(self.model_name)} токенов: "
+                        f"отброшено реплик {dropped}, осталось {len(fitted)}")
+        self.history_tokens = history_tokens(fitted)
+        return fitted
+
+    def _account_turn(self, message: str, response: str) -> bool:
+        """
+        Учитывает завершенную реплику в размере истории.
+        Возвращает True, если контекст превысил бюджет и историю нужно сократить (_fit_history).
+        """
+        self.history_tokens += estimate_tokens(message) + estimate_tokens(response)
+        context_tokens = self.context_tokens()
+        metrics.LLM_CONTEXT_TOKENS.labels(self.model_name).observe(context_tokens)
+        budget = context_budget(self.model_name)
+        return budget > 0 and context_tokens > budget
+
+    @staticmethod
+    def check_model_name(model_name):
+        """Бросает ValueError, если модели нет в GeminiModel."""
+        if model_name not in {m.value for m in GeminiModel}:
+            logger.error(f"Попытка сменить на невалидную модель: {model_name}")
+            raise ValueError(f"Invalid model name: {model_name}")
+
+
+def _backend_class():
+    """Класс сессии чата по Config.LLM_BACKEND ('gemini' или 'fake'). Модули импортируются лениво."""
+    kind = (getattr(Config, 'LLM_BACKEND', 'gemini') or 'gemini').lower()
+    if kind == 'gemini':
+        from app.external.gemini_api import GeminiChat
+        return GeminiChat
+    if kind == 'fake':
+        from app.external.fake_llm import FakeChat
+        return FakeChat
+    raise ValueError(f"Неизвестный бэкенд языковой модели: {kind}")
+
+
+def create_chat(model_name=None, history=None) -> ChatBackend:
+    """Создает сессию чата выбранного в конфигурации бэкенда (модель по умолчанию, если model_name не задан)."""
+    backend = _backend_class()
+    if model_name is None:
+        return backend(history=history)
+    return backend(model_name=model_name, history=history)
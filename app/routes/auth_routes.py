@@ -1,9 +1,10 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, g
 import logging
 from ..services import auth_service
 from ..services.auth_service import (
     ValidationError, UserExistsError, InvalidCredentialsError, AuthServiceError
 )
+from ..utils.decorators import token_required
 
 auth_bp = Blueprint('auth', __name__, url_prefix='/api')
 logger = logging.getLogger(__name__)
@@ -68,6 +69,29 @@ def login():
         logger.critical(f"Неожиданная ошибка при входе ({email}): {e}", exc_info=True)
         return jsonify({'error': 'Неожиданная внутренняя ошибка сервера'}), 500
 
+
+@auth_bp.route('/change_password', methods=['POST'])
+@token_required
+def change_password():
+    data = request.get_json()
+    if not data:
+        return jsonify({'error': 'Не предоставлены данные'}), 400
+
+    user = g.current_user
+    try:
+        auth_service.change_password(user['id'], data.get('current_password'), data.get('new_password'))
+        return jsonify({'message': 'Пароль изменен'}), 200
+    except ValidationError as e:
+        return jsonify({'error': str(e)}), 400
+    except InvalidCredentialsError as e:
+        return jsonify({'error': str(e)}), 403
+    except AuthServiceError as e:
+        logger.error(f"Сервисная ошибка при смене пароля (user ID={user['id']}): {e}")
+        return jsonify({'error': 'Внутренняя ошибка сервера при смене пароля'}), 500
+    except Exception as e:
+        logger.critical(f"Неожиданная ошибка при смене пароля (user ID={user['id']}): {e}", exc_info=True)
+        return jsonify({'error': 'Неожиданная внутренняя ошибка сервера'}), 500
+
 # Пример защищенного маршрута для проверки токена (не обязательно)
 # from ..utils.decorators import token_required
 # @auth_bp.route('/verify_token', methods=['GET'])
@@ -1,9 +1,8 @@
 # app/routes/chat_routes.py
 
 # Импорты Flask и стандартных библиотек
-from flask import Blueprint, request, jsonify, Response, g, stream_with_context
+from flask import Blueprint, request, jsonify, Response, g, stream_with_context, current_app
 import logging
-import json # Нужен для создания JSON в error_stream
 
 # Импорты сервисов и ошибок
 # Убедись, что импорт gemini_service и его ошибок есть
@@ -13,11 +12,26 @@ from ..services.chat_service import ChatNotFoundError, InvalidInputError, ChatSe
 from ..services.gemini_service import GeminiServiceError, ChatInstanceError
 # Импорт декоратора
 from ..utils.decorators import token_required
+# SSE-кодирование событий выполняется здесь, на границе маршрута
+from ..utils.sse import sse_stream, error_payload, coalesce_events
 
 # Создание Blueprint - убедимся, что имя 'chat_bp' совпадает с регистрацией в __init__.py
 chat_bp = Blueprint('chats', __name__, url_prefix='/api/chats')
 logger = logging.getLogger(__name__)
 
+# --- Условные GET (ETag) ---
+
+def _not_modified(etag: str):
+    """Ответ 304 для совпавшего If-None-Match: без запроса данных и сериализации JSON."""
+    response = current_app.response_class(status=304)
+    return _with_etag(response, etag)
+
+def _with_etag(response, etag: str):
+    response.set_etag(etag, weak=True)
+    # Браузер хранит ответ, но перед использованием всегда перепроверяет его по ETag
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 # --- Маршруты для чатов ---
 
 @chat_bp.route('', methods=['GET'])
@@ -26,8 +40,11 @@ def get_chats():
     """Получение списка чатов текущего пользователя."""
     user = g.current_user
     try:
+        etag = f"u{user['id']}-{chat_service.get_chats_version(user['id'])}"
+        if request.if_none_match.contains_weak(etag):
+            return _not_modified(etag)
         chats = chat_service.get_chats_for_user(user['id'])
-        return jsonify(chats), 200
+        return _with_etag(jsonify(chats), etag), 200
     except ChatServiceError as e:
         logger.error(f"Ошибка получения чатов для пользователя ID={user['id']}: {e}")
         return jsonify({'error': 'Ошибка сервера при получении чатов'}), 500
@@ -61,15 +78,38 @@ def create_chat():
 @chat_bp.route('/<int:chat_id>/messages', methods=['GET'])
 @token_required
 def get_messages(chat_id: int):
-    """Получение сообщений конкретного чата."""
+    """
+    Получение страницы сообщений конкретного чата.
+
+    Параметры запроса: before_id / after_id (курсор) и limit. Без курсора возвращаются
+    самые новые сообщения. Тело ответа - список сообщений по возрастанию id (как и раньше),
+    курсор следующей страницы передается в заголовке X-Next-Cursor (нет заголовка - страниц больше нет).
+    Поддерживается условный запрос: при совпадении If-None-Match возвращается 304.
+    """
     user = g.current_user
     try:
-        # Вызываем функцию из chat_service, которая теперь возвращает thoughts
-        messages = chat_service.get_messages_for_chat(chat_id, user['id'])
-        return jsonify(messages), 200
+        # Версия чата меняется при каждой записи сообщения; страница зависит и от параметров запроса
+        version = chat_service.get_chat_version(chat_id, user['id'])
+        etag = "c{}-{}-{}-{}-{}".format(chat_id, version, request.args.get('before_id', ''),
+                                        request.args.get('after_id', ''), request.args.get('limit', ''))
+        if request.if_none_match.contains_weak(etag):
+            return _not_modified(etag)
+
+        page = chat_service.get_messages_for_chat(
+            chat_id, user['id'],
+            before_id=request.args.get('before_id'),
+            after_id=request.args.get('after_id'),
+            limit=request.args.get('limit')
+        )
+        response = jsonify(page['messages'])
+        if page['next_cursor'] is not None:
+            response.headers['X-Next-Cursor'] = str(page['next_cursor'])
+        return _with_etag(response, etag), 200
     except ChatNotFoundError as e:
         logger.warning(f"Доступ к сообщениям чата {chat_id} запрещен/не найден для user {user['id']}: {e}")
         return jsonify({'error': str(e)}), 404
+    except InvalidInputError as e:
+        return jsonify({'error': str(e)}), 400
     except ChatServiceError as e:
         logger.error(f"Ошибка получения сообщений чата {chat_id} для пользователя {user['id']}: {e}")
         return jsonify({'error': 'Ошибка сервера при получении сообщений'}), 500
@@ -103,8 +143,13 @@ def send_message(chat_id: int):
             chat_id, user['id'], content.strip()
         )
 
-        # 4. Возвращаем потоковый ответ клиенту
-        return Response(stream_with_context(stream_generator),
+        # 4. Объединяем мелкие чанки в кадры (см. SSE_COALESCE_*) и возвращаем поток клиенту.
+        # Ответ модели читается в отдельном потоке - ему нужен свой контекст приложения (БД через g)
+        frames = coalesce_events(stream_generator,
+                                 current_app.config['SSE_COALESCE_WINDOW_MS'],
+                                 current_app.config['SSE_COALESCE_MAX_BYTES'],
+                                 context=current_app._get_current_object().app_context)
+        return Response(stream_with_context(sse_stream(frames)),
                         mimetype='text/event-stream',
                         headers={'Cache-Control': 'no-cache'})
 
@@ -123,19 +168,14 @@ def send_message(chat_id: int):
          # Ошибки инициализации Gemini или другие ошибки сервиса Gemini
          logger.error(f"Ошибка сервиса Gemini при отправке сообщения в чат {chat_id}: {e}")
          # Возвращаем ошибку в формате потока SSE
-         def error_stream():
-             # Формируем JSON с ошибкой
-             error_payload = json.dumps({'content': None, 'thoughts': None, 'error': f'Ошибка нейросети: {e}'})
-             yield f"data: {error_payload}\n\n"
+         error_stream = sse_stream([error_payload(f'Ошибка нейросети: {e}')])
          # Используем stream_with_context и здесь
-         return Response(stream_with_context(error_stream()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+         return Response(stream_with_context(error_stream), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
     except Exception as e:
         # Ловим все остальные непредвиденные ошибки
         logger.critical(f"Неожиданная ошибка при отправке сообщения в чат {chat_id} для user ID={user['id']}: {e}", exc_info=True)
-        def critical_error_stream():
-             error_payload = json.dumps({'content': None, 'thoughts': None, 'error': 'Неожиданная внутренняя ошибка сервера'})
-             yield f"data: {error_payload}\n\n"
-        return Response(stream_with_context(critical_error_stream()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+        critical_error_stream = sse_stream([error_payload('Неожиданная внутренняя ошибка сервера')])
+        return Response(stream_with_context(critical_error_stream), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 
 # --- Маршруты управления чатом Gemini (reset, model) ---
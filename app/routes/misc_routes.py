@@ -1,10 +1,12 @@
 # app/routes/misc_routes.py
 
-from flask import Blueprint, jsonify, send_from_directory, current_app # Добавил current_app
+from flask import Blueprint, jsonify, send_from_directory, current_app, Response, request # Добавил current_app
+import hmac
 import logging
 import os
 # Убедимся в правильности импорта gemini_service
 from ..services import gemini_service
+from ..utils import metrics
 
 misc_bp = Blueprint('misc', __name__)
 logger = logging.getLogger(__name__)
@@ -19,6 +21,19 @@ def get_models():
         logger.error(f"Ошибка получения списка моделей Gemini: {e}")
         return jsonify({'error': 'Ошибка сервера при получении списка моделей'}), 500
 
+@misc_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Метрики приложения в текстовом формате Prometheus."""
+    if not current_app.config.get('METRICS_ENABLED'):
+        return jsonify(error="Запрошенный ресурс не найден"), 404
+    token = current_app.config.get('METRICS_TOKEN')
+    if token:
+        provided = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(provided.encode('utf-8'), f'Bearer {token}'.encode('utf-8')):
+            logger.warning(f"Запрос метрик без действительного токена с {request.remote_addr}")
+            return jsonify(error="Требуется токен доступа к метрикам"), 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 # --- Маршруты для статики ---
 
 # Получаем путь к папке static из конфигурации приложения Flask
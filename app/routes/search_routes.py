@@ -0,0 +1,43 @@
+# app/routes/search_routes.py
+
+from flask import Blueprint, request, jsonify, g
+import logging
+
+from ..services import search_service
+from ..services.search_service import InvalidQueryError, SearchUnavailableError, SearchServiceError
+from ..utils.decorators import token_required
+
+search_bp = Blueprint('search', __name__, url_prefix='/api/search')
+logger = logging.getLogger(__name__)
+
+@search_bp.route('', methods=['GET'])
+@token_required
+def search_messages():
+    """
+    Полнотекстовый поиск по сообщениям всех чатов текущего пользователя.
+
+    Параметры запроса: q (текст), limit и offset. Тело ответа - список результатов по убыванию
+    релевантности (message_id, chat_id, chat_title, is_bot, created_at, snippet - HTML с <mark>),
+    смещение следующей страницы передается в заголовке X-Next-Offset (нет заголовка - страниц больше нет).
+    """
+    user = g.current_user
+    try:
+        page = search_service.search_messages(
+            user['id'], request.args.get('q'),
+            limit=request.args.get('limit'),
+            offset=request.args.get('offset')
+        )
+        response = jsonify(page['results'])
+        if page['next_offset'] is not None:
+            response.headers['X-Next-Offset'] = str(page['next_offset'])
+        return response, 200
+    except InvalidQueryError as e:
+        return jsonify({'error': str(e)}), 400
+    except SearchUnavailableError as e:
+        return jsonify({'error': str(e)}), 503
+    except SearchServiceError as e:
+        logger.error(f"Ошибка поиска для пользователя ID={user['id']}: {e}")
+        return jsonify({'error': 'Ошибка сервера при поиске'}), 500
+    except Exception as e:
+        logger.critical(f"Неожиданная ошибка при поиске для user ID={user['id']}: {e}", exc_info=True)
+        return jsonify({'error': 'Неожиданная внутренняя ошибка сервера'}), 500
@@ -1,13 +1,28 @@
 import jwt
 import logging
+import sqlite3
+from collections import defaultdict
 from datetime import datetime, timezone, timedelta
-from werkzeug.security import generate_password_hash, check_password_hash
+from time import time
 from app.config import Config
 from app.database import get_db
+from ..utils.cache import TTLCache
+from ..utils import metrics
+from . import password_hasher
+from .password_hasher import PasswordHasherBusyError
 from ..utils.helpers import validate_email, validate_password, validate_name
 
 logger = logging.getLogger(__name__)
 
+# Кэш проверенных токенов: token -> (данные пользователя, exp токена, поколение пользователя).
+# TTL не скользящий, чтобы изменения пользователя в других процессах подхватывались не позже AUTH_CACHE_TTL
+_principal_cache = TTLCache(max_entries=getattr(Config, 'AUTH_CACHE_MAX_ENTRIES', 10000),
+                            ttl=getattr(Config, 'AUTH_CACHE_TTL', 60),
+                            sliding=False)
+# Поколения пользователей: invalidate_user() увеличивает его, и закэшированные ранее токены
+# этого пользователя перестают считаться действительными без обхода кэша
+_user_generations = defaultdict(int)
+
 class AuthServiceError(Exception):
     """Базовый класс для ошибок сервиса аутентификации."""
     pass
@@ -42,7 +57,12 @@ def register_user(name, email, password):
     if not validate_password(password):
         raise ValidationError('Пароль должен содержать минимум 6 символов')
 
-    hashed_password = generate_password_hash(password, method='pbkdf2:sha256') # Используем более современный метод
+    try:
+        # Метод и стоимость задаются в конфигурации (PASSWORD_HASH_*), хеширование - в пуле процессов
+        hashed_password = password_hasher.hash_password(password)
+    except PasswordHasherBusyError as e:
+        logger.error(f"Не удалось захешировать пароль при регистрации {email}: {e}")
+        raise AuthServiceError('Сервер перегружен, попробуйте позже')
 
     db = get_db()
     try:
@@ -82,10 +102,19 @@ def authenticate_user(email, password):
 
         user = dict(user_row) # Преобразуем sqlite3.Row в dict
 
-        if not check_password_hash(user['password'], password):
+        try:
+            password_ok = password_hasher.verify_password(user['password'], password)
+        except PasswordHasherBusyError as e:
+            logger.error(f"Не удалось проверить пароль для {email}: {e}")
+            raise AuthServiceError('Сервер перегружен, попробуйте позже')
+        if not password_ok:
             logger.warning(f"Неудачная попытка входа для email: {email} (неверный пароль)")
             raise InvalidCredentialsError('Неверный email или пароль')
 
+        # Хеш создан устаревшим методом или стоимостью - прозрачно обновляем его, пока известен пароль
+        if password_hasher.needs_rehash(user['password']):
+            _rehash_password(db, user['id'], password)
+
         token = generate_auth_token(user['id'])
         logger.info(f"Успешная аутентификация пользователя: ID={user['id']}, Email={email}")
         return {
@@ -97,6 +126,54 @@ def authenticate_user(email, password):
         raise AuthServiceError(f'Ошибка сервера при аутентификации: {e}')
 
 
+def _rehash_password(db, user_id, password):
+    """Пересохраняет хеш пароля текущим методом. Ошибка не мешает входу пользователя."""
+    try:
+        new_hash = password_hasher.hash_password(password)
+        db.execute('UPDATE users SET password = ? WHERE id = ?', (new_hash, user_id))
+        db.commit()
+        invalidate_user(user_id)
+        logger.info(f"Хеш пароля пользователя ID={user_id} обновлен до {password_hasher.password_method()}")
+    except (sqlite3.Error, PasswordHasherBusyError) as e:
+        logger.warning(f"Не удалось обновить хеш пароля пользователя ID={user_id}: {e}")
+        if isinstance(e, sqlite3.Error):
+            db.rollback()
+
+
+def change_password(user_id, current_password, new_password):
+    """Меняет пароль пользователя после проверки текущего."""
+    current_password = (current_password or '').strip()
+    new_password = (new_password or '').strip()
+    if not current_password or not new_password:
+        raise ValidationError('Необходимо указать текущий и новый пароль')
+    if not validate_password(new_password):
+        raise ValidationError('Пароль должен содержать минимум 6 символов')
+
+    db = get_db()
+    try:
+        user_row = db.execute('SELECT password FROM users WHERE id = ?', (user_id,)).fetchone()
+        if not user_row:
+            raise InvalidCredentialsError('Пользователь не найден')
+        try:
+            password_ok = password_hasher.verify_password(user_row['password'], current_password)
+            new_hash = password_hasher.hash_password(new_password) if password_ok else None
+        except PasswordHasherBusyError as e:
+            logger.error(f"Не удалось сменить пароль пользователя ID={user_id}: {e}")
+            raise AuthServiceError('Сервер перегружен, попробуйте позже')
+        if not password_ok:
+            logger.warning(f"Неудачная попытка смены пароля пользователя ID={user_id} (неверный текущий пароль)")
+            raise InvalidCredentialsError('Неверный текущий пароль')
+
+        db.execute('UPDATE users SET password = ? WHERE id = ?', (new_hash, user_id))
+        db.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка БД при смене пароля пользователя ID={user_id}: {e}")
+        db.rollback()
+        raise AuthServiceError(f'Ошибка сервера при смене пароля: {e}')
+    invalidate_user(user_id)
+    logger.info(f"Пароль пользователя ID={user_id} изменен")
+
+
 def generate_auth_token(user_id, expires_in_days=7):
     """Генерирует JWT токен для пользователя."""
     try:
@@ -112,6 +189,34 @@ def generate_auth_token(user_id, expires_in_days=7):
         raise AuthServiceError('Не удалось сгенерировать токен')
 
 
+def invalidate_user(user_id):
+    """Сбрасывает закэшированные токены пользователя (вызывать при изменении или удалении пользователя)."""
+    _user_generations[user_id] += 1
+    logger.debug(f"Кэш авторизации сброшен для пользователя ID={user_id}")
+
+
+def clear_principal_cache():
+    """Полностью очищает кэш проверенных токенов."""
+    _principal_cache.clear()
+
+
+def get_principal_cache_stats() -> dict:
+    """Счетчики кэша проверенных токенов (размер, попадания/промахи, доля попаданий)."""
+    return _principal_cache.stats()
+
+
+def _get_cached_principal(token):
+    """Данные пользователя из кэша или None, если токена нет, он истек или пользователь изменился."""
+    entry = _principal_cache.get(token)
+    if entry is None:
+        return None
+    user, exp, generation = entry
+    if exp <= time() or generation != _user_generations[user['id']]:
+        _principal_cache.pop(token)
+        return None
+    return dict(user) # Копия, чтобы обработчики запроса не изменили закэшированные данные
+
+
 def verify_auth_token(token):
     """Проверяет JWT токен и возвращает данные пользователя."""
     if not token:
@@ -122,11 +227,20 @@ def verify_auth_token(token):
         if token.startswith('Bearer '):
             token = token.split(' ')[1]
 
+        # Токен уже проверялся недавно - не повторяем проверку подписи и запрос к БД
+        if getattr(Config, 'AUTH_CACHE_ENABLED', True):
+            cached_user = _get_cached_principal(token)
+            if cached_user is not None:
+                return cached_user
+
         payload = jwt.decode(token, Config.SECRET_KEY, algorithms=['HS256'])
         user_id = payload.get('user_id')
         if not user_id:
              raise InvalidTokenError("Некорректный токен (отсутствует user_id)")
 
+        # Поколение берем до запроса к БД: invalidate_user() во время запроса не будет потерян
+        generation = _user_generations[user_id]
+
         # Дополнительно проверяем, существует ли пользователь в БД
         db = get_db()
         cursor = db.cursor()
@@ -138,7 +252,10 @@ def verify_auth_token(token):
              raise InvalidTokenError("Пользователь не найден")
 
         logger.debug(f"Токен успешно верифицирован для пользователя ID={user_id}")
-        return dict(user_row) # Возвращаем данные пользователя в виде dict
+        user = dict(user_row) # Возвращаем данные пользователя в виде dict
+        if getattr(Config, 'AUTH_CACHE_ENABLED', True):
+            _principal_cache.set(token, (dict(user), payload.get('exp', 0), generation))
+        return user
 
     except jwt.ExpiredSignatureError:
         logger.info("Попытка использовать истекший токен")
@@ -151,4 +268,13 @@ def verify_auth_token(token):
         raise AuthServiceError(f"Ошибка сервера при проверке токена: {e}")
     except Exception as e: # Ловим другие возможные ошибки
         logger.error(f"Неожиданная ошибка при верификации токена: {e}")
-        raise InvalidTokenError(f"Ошибка обработки токена: {e}")
\ No newline at end of file
+        raise InvalidTokenError(f"Ошибка обработки токена: {e}")
+
+
+metrics.CallbackMetric('auth_principal_cache_hits_total', 'Проверки токена, обслуженные из кэша авторизации',
+                       lambda: _principal_cache.hits, kind='counter')
+metrics.CallbackMetric('auth_principal_cache_misses_total', 'Проверки токена с проверкой подписи и запросом к БД',
+                       lambda: _principal_cache.misses, kind='counter')
+metrics.CallbackMetric('auth_principal_cache_hit_ratio', 'Доля попаданий в кэш авторизации с запуска процесса',
+                       lambda: get_principal_cache_stats().get('hit_ratio'))
+metrics.CallbackMetric('auth_principal_cache_entries', 'Токены в кэше авторизации', lambda: len(_principal_cache))
@@ -1,7 +1,10 @@
 import logging
 import sqlite3
 from datetime import datetime, timezone
+from app.config import Config
 from app.database import get_db
+from app.utils.markdown_render import render_markdown, RENDERER_VERSION
+from . import message_writer
 
 logger = logging.getLogger(__name__)
 
@@ -35,7 +38,8 @@ def create_chat(user_id: int, title: str):
         # if not cursor.fetchone():
         #     raise ChatServiceError("Пользователь не найден") # Или другая ошибка
 
-        cursor.execute('INSERT INTO chats (user_id, title) VALUES (?, ?)', (user_id, title))
+        # updated_at задаем явно: новый чат должен оказаться в начале списка (сортировка по активности)
+        cursor.execute('INSERT INTO chats (user_id, title, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)', (user_id, title))
         chat_id = cursor.lastrowid
         db.commit()
 
@@ -59,33 +63,29 @@ def create_chat(user_id: int, title: str):
 
 def get_chats_for_user(user_id: int):
     """Возвращает список чатов пользователя с последним сообщением."""
+    message_writer.wait_for_user(user_id) # Последние сообщения могут еще быть в очереди записи
     db = get_db()
     try:
         cursor = db.cursor()
-        # Оптимизированный запрос для получения последнего сообщения
+        # Последнее сообщение хранится в самой таблице chats (обновляется триггером),
+        # поэтому список - один проход по индексу (user_id, updated_at, id)
         cursor.execute('''
-            SELECT
-                c.id,
-                c.title,
-                c.created_at,
-                (SELECT m.content
-                 FROM messages m
-                 WHERE m.chat_id = c.id
-                 ORDER BY m.created_at DESC
-                 LIMIT 1) AS last_message_content
-            FROM chats c
-            WHERE c.user_id = ?
-            ORDER BY c.created_at DESC
+            SELECT id, title, created_at, updated_at, last_message_preview
+            FROM chats
+            WHERE user_id = ?
+            ORDER BY updated_at DESC, id DESC
         ''', (user_id,))
         chats_rows = cursor.fetchall()
 
         chats_list = []
         for row in chats_rows:
+            updated_at = row['updated_at'] or row['created_at']
             chats_list.append({
                 'id': row['id'],
                 'title': row['title'],
                 'created_at': row['created_at'].isoformat().replace('+00:00', 'Z'),
-                'last_message': row['last_message_content'] or 'Нет сообщений'
+                'updated_at': updated_at.isoformat().replace('+00:00', 'Z'),
+                'last_message': row['last_message_preview'] or 'Нет сообщений'
             })
         logger.debug(f"Получено {len(chats_list)} чатов для пользователя ID={user_id}")
         return chats_list
@@ -106,20 +106,99 @@ def _check_chat_access(chat_id: int, user_id: int):
     return True # Возвращаем True для удобства использования
 
 
-def get_messages_for_chat(chat_id: int, user_id: int):
-    """Возвращает список сообщений для указанного чата."""
+_MAX_ROWID = 2 ** 63 - 1 # Без before_id страница начинается с самого нового сообщения
+
+
+def get_chats_version(user_id: int) -> int:
+    """Версия списка чатов пользователя (растет при любом изменении чатов и их сообщений)."""
+    message_writer.wait_for_user(user_id) # Версия должна учитывать записи из очереди
+    db = get_db()
+    try:
+        row = db.execute('SELECT chats_version FROM users WHERE id = ?', (user_id,)).fetchone()
+        return row['chats_version'] if row else 0
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка БД при получении версии списка чатов пользователя ID={user_id}: {e}")
+        raise ChatServiceError(f"Ошибка сервера при получении версии чатов: {e}")
+
+
+def get_chat_version(chat_id: int, user_id: int) -> int:
+    """
+    Версия сообщений чата (растет при каждой записи сообщения). Заодно проверяет доступ:
+    бросает ChatNotFoundError, если чата нет или он принадлежит другому пользователю.
+    """
+    message_writer.wait_for_chat(chat_id)
+    db = get_db()
+    try:
+        row = db.execute('SELECT version FROM chats WHERE id = ? AND user_id = ?', (chat_id, user_id)).fetchone()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка БД при получении версии чата ID={chat_id}: {e}")
+        raise ChatServiceError(f"Ошибка сервера при получении версии чата: {e}")
+    if not row:
+        logger.warning(f"Попытка доступа к чату ID={chat_id} пользователем ID={user_id} (не найден или нет прав)")
+        raise ChatNotFoundError(f"Чат с ID {chat_id} не найден или доступ запрещен.")
+    return row['version']
+
+
+def _parse_cursor(value, name: str):
+    """Проверяет параметр пагинации: None или положительное целое."""
+    if value is None or value == '':
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise InvalidInputError(f'Параметр {name} должен быть целым числом')
+    if value <= 0:
+        raise InvalidInputError(f'Параметр {name} должен быть положительным')
+    return value
+
+
+def get_messages_for_chat(chat_id: int, user_id: int, before_id=None, after_id=None, limit=None):
+    """
+    Возвращает страницу сообщений чата (keyset-пагинация по id).
+
+    Без курсоров - самые новые limit сообщений; before_id - более старые сообщения,
+    after_id - более новые. Сообщения на странице всегда идут по возрастанию id.
+    Возвращает {'messages': [...], 'next_cursor': id или None}: next_cursor - значение
+    для следующего запроса в том же направлении (before_id или after_id), None - страниц больше нет.
+    """
+    before_id = _parse_cursor(before_id, 'before_id')
+    after_id = _parse_cursor(after_id, 'after_id')
+    if before_id is not None and after_id is not None:
+        raise InvalidInputError('Нельзя одновременно указывать before_id и after_id')
+    limit = _parse_cursor(limit, 'limit') or Config.MESSAGES_PAGE_SIZE
+    limit = min(limit, Config.MESSAGES_PAGE_MAX)
+
     _check_chat_access(chat_id, user_id) # Проверяем доступ
+    message_writer.wait_for_chat(chat_id) # Read-your-writes при включенной отложенной записи
 
     db = get_db()
     try:
         cursor = db.cursor()
-        cursor.execute('''
-            SELECT id, content, is_bot, created_at, thoughts
-            FROM messages
-            WHERE chat_id = ?
-            ORDER BY created_at ASC
-        ''', (chat_id,))
-        messages_rows = cursor.fetchall()
+        # Запрашиваем на одну запись больше, чтобы узнать, есть ли следующая страница.
+        # Все варианты - диапазонный проход по индексу (chat_id, id)
+        if after_id is not None:
+            cursor.execute('''
+                SELECT id, content, is_bot, created_at, thoughts, content_html, content_html_version
+                FROM messages
+                WHERE chat_id = ? AND id > ?
+                ORDER BY id ASC
+                LIMIT ?
+            ''', (chat_id, after_id, limit + 1))
+            messages_rows = cursor.fetchall()
+        else:
+            cursor.execute('''
+                SELECT id, content, is_bot, created_at, thoughts, content_html, content_html_version
+                FROM messages
+                WHERE chat_id = ? AND id < ?
+                ORDER BY id DESC
+                LIMIT ?
+            ''', (chat_id, before_id or _MAX_ROWID, limit + 1))
+            messages_rows = cursor.fetchall()
+
+        has_more = len(messages_rows) > limit
+        messages_rows = messages_rows[:limit]
+        if after_id is None:
+            messages_rows.reverse() # Страница "назад" читалась от новых к старым
 
         messages_list = []
         for row in messages_rows:
@@ -128,10 +207,16 @@ def get_messages_for_chat(chat_id: int, user_id: int):
                 'content': row['content'],
                 'is_bot': bool(row['is_bot']), # Преобразуем 0/1 в True/False
                 'created_at': row['created_at'].isoformat().replace('+00:00', 'Z'),
-                'thoughts': row['thoughts']
+                'thoughts': row['thoughts'],
+                # HTML устаревшей версии рендерера не отдаем - клиент отрисует Markdown сам
+                'content_html': row['content_html'] if row['content_html_version'] == RENDERER_VERSION else None
             })
-        logger.debug(f"Получено {len(messages_list)} сообщений для чата ID={chat_id}")
-        return messages_list
+
+        next_cursor = None
+        if has_more and messages_list:
+            next_cursor = messages_list[-1]['id'] if after_id is not None else messages_list[0]['id']
+        logger.debug(f"Получено {len(messages_list)} сообщений для чата ID={chat_id} (следующий курсор: {next_cursor})")
+        return {'messages': messages_list, 'next_cursor': next_cursor}
     except sqlite3.Error as e:
         logger.error(f"Ошибка БД при получении сообщений для чата ID={chat_id}: {e}")
         raise ChatServiceError(f"Ошибка сервера при получении сообщений: {e}")
@@ -151,12 +236,13 @@ def add_user_message(chat_id: int, user_id: int, content: str):
     db = get_db()
     try:
         cursor = db.cursor()
-        cursor.execute(
+        # При включенной групповой записи вставка фиксируется вместе с вставками других запросов
+        message_id = message_writer.execute_insert(
+            db,
             'INSERT INTO messages (chat_id, user_id, content, is_bot) VALUES (?, ?, ?, 0)',
-            (chat_id, user_id, content)
+            (chat_id, user_id, content),
+            chat_id, user_id
         )
-        message_id = cursor.lastrowid
-        db.commit()
 
         # Получаем время создания из БД
         cursor.execute("SELECT created_at FROM messages WHERE id = ?", (message_id,))
@@ -177,4 +263,40 @@ def add_user_message(chat_id: int, user_id: int, content: str):
 
 # Функция add_bot_message была перенесена внутрь get_gemini_response_stream в gemini_service,
 # так как логично сохранять ответ бота после его получения.
-# Если нужно добавить сообщение бота из другого места, можно создать похожую функцию здесь.
\ No newline at end of file
+# Если нужно добавить сообщение бота из другого места, можно создать похожую функцию здесь.
+
+
+def backfill_message_html(batch_size: int = 500) -> int:
+    """
+    Заполняет content_html ответов бота, сохраненных без HTML или с устаревшей версией рендерера.
+    Обходит сообщения по id пачками по batch_size, каждая пачка - отдельная транзакция; версии
+    затронутых чатов увеличиваются, чтобы клиенты не получили старую историю по ETag.
+    Возвращает число обновленных сообщений.
+    """
+    db = get_db()
+    last_id = 0
+    updated = 0
+    while True:
+        rows = db.execute('''
+            SELECT id, chat_id, content FROM messages
+            WHERE id > ? AND is_bot = 1 AND (content_html_version IS NULL OR content_html_version != ?)
+            ORDER BY id
+            LIMIT ?
+        ''', (last_id, RENDERER_VERSION, batch_size)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1]['id']
+        # Рендеринг - до транзакции, чтобы не держать блокировку записи
+        params = [(render_markdown(row['content']), RENDERER_VERSION, row['id']) for row in rows]
+        chat_ids = [(chat_id,) for chat_id in {row['chat_id'] for row in rows}]
+        try:
+            db.executemany('UPDATE messages SET content_html = ?, content_html_version = ? WHERE id = ?', params)
+            db.executemany('UPDATE chats SET version = version + 1 WHERE id = ?', chat_ids)
+            db.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка БД при заполнении HTML сообщений (после id {last_id}): {e}")
+            db.rollback()
+            raise ChatServiceError(f"Ошибка заполнения HTML сообщений: {e}")
+        updated += len(rows)
+        logger.info(f"HTML собран для {updated} сообщений (последний id {last_id})")
+    return updated
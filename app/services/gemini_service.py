@@ -1,10 +1,17 @@
 # app/services/gemini_service.py
+import asyncio
 import logging
-import json
-from time import time
-from threading import Lock
+import os
 import re
-from ..external.gemini_api import GeminiChat, GeminiModel
+from threading import Event, Lock, Thread
+from time import monotonic, perf_counter
+from ..external.llm_backend import ChatBackend, GeminiModel, ChunkKind, StreamChunk, create_chat, estimate_tokens
+from .session_store import create_session_store
+from . import message_writer, response_cache, single_flight
+from ..utils.think_parser import ThinkTagParser, VISIBLE, THOUGHT
+from ..utils.sse import error_payload
+from ..utils.markdown_render import render_markdown, RENDERER_VERSION
+from ..utils import metrics
 # Используем относительный импорт для Config и database
 from ..config import Config
 from ..database import get_db
@@ -12,9 +19,51 @@ import sqlite3
 
 logger = logging.getLogger(__name__)
 
-# Словарь для хранения активных экземпляров GeminiChat {chat_id: {'instance': GeminiChat, 'last_used': timestamp}}
-chat_instances = {}
-instances_lock = Lock()
+# Хранилище сессий GeminiChat (история + выбранная модель) по chat_id.
+# Тип задается Config.SESSION_STORE: 'memory' - в памяти процесса, 'sqlite' - общее для всех воркеров
+session_store = create_session_store(Config)
+
+# Размер хранилища и вытеснения читаются из его счетчиков при запросе /metrics. Все метрики
+# сессий берут значения из одного снимка: для SQLite-хранилища каждый stats() - запрос к БД
+_SESSION_STATS_SNAPSHOT_TTL = 1.0 # сек
+_session_stats_snapshot = (float('-inf'), {})
+_session_stats_lock = Lock()
+
+
+def _session_stats_for_metrics() -> dict:
+    """Снимок get_session_stats(), общий для всех метрик одного запроса /metrics."""
+    global _session_stats_snapshot
+    with _session_stats_lock:
+        taken_at, stats = _session_stats_snapshot
+        now = monotonic()
+        if now - taken_at >= _SESSION_STATS_SNAPSHOT_TTL:
+            stats = get_session_stats()
+            _session_stats_snapshot = (now, stats)
+        return stats
+
+
+metrics.CallbackMetric('chat_instances', 'Сессии чата в хранилище',
+                       lambda: _session_stats_for_metrics().get('size'))
+metrics.CallbackMetric('chat_instances_evictions_total', 'Сессии, вытесненные из памяти по лимиту числа сессий',
+                       lambda: _session_stats_for_metrics().get('evictions'), kind='counter')
+metrics.CallbackMetric('chat_instances_expirations_total', 'Сессии, удаленные по таймауту неактивности',
+                       lambda: _session_stats_for_metrics().get('expirations'), kind='counter')
+metrics.CallbackMetric('chat_instances_bytes', 'Оценка памяти, занятой сессиями в памяти процесса (байт)',
+                       lambda: _session_stats_for_metrics().get('bytes'))
+metrics.CallbackMetric('chat_sessions_hibernated', 'Усыпленные сессии (сжатая история)',
+                       lambda: _session_stats_for_metrics().get('hibernated'))
+metrics.CallbackMetric('chat_sessions_hibernated_bytes', 'Размер блобов усыпленных сессий (байт)',
+                       lambda: _session_stats_for_metrics().get('hibernated_bytes'))
+metrics.CallbackMetric('chat_sessions_hibernations_total', 'Сколько раз сессии усыплялись',
+                       lambda: _session_stats_for_metrics().get('hibernations'), kind='counter')
+metrics.CallbackMetric('chat_sessions_revivals_total', 'Сколько раз сессии восстанавливались из блоба',
+                       lambda: _session_stats_for_metrics().get('revivals'), kind='counter')
+
+# Фоновый поток очистки неактивных сессий (вне пути обработки запросов)
+_reaper_thread = None
+_reaper_pid = None
+_reaper_lock = Lock()
+_reaper_stop = Event()
 
 class GeminiServiceError(Exception):
     pass
@@ -22,258 +71,463 @@ class GeminiServiceError(Exception):
 class ChatInstanceError(GeminiServiceError):
     pass
 
-def get_chat_instance(chat_id: int) -> GeminiChat:
-    """Возвращает или создает экземпляр GeminiChat для указанного chat_id."""
-    current_time = time()
-    with instances_lock:
-        if chat_id in chat_instances:
-            chat_instances[chat_id]['last_used'] = current_time
-            logger.debug(f"Используется существующий экземпляр Gemini для chat_id {chat_id}")
-            return chat_instances[chat_id]['instance']
-        else:
-            try:
-                logger.info(f"Создание нового экземпляра Gemini для chat_id {chat_id}")
-                # TODO: Получать модель из настроек чата в БД, если нужно
-                instance = GeminiChat() # Используем модель по умолчанию
-                chat_instances[chat_id] = {'instance': instance, 'last_used': current_time}
-                return instance
-            except Exception as e:
-                logger.error(f"Ошибка создания экземпляра GeminiChat для chat_id {chat_id}: {e}")
-                # Логируем stack trace для подробной отладки
-                logger.exception("Stack trace:")
-                raise ChatInstanceError(f"Не удалось инициализировать нейросеть: {e}")
+def _load_chat_state(chat_id: int):
+    """
+    Восстанавливает модель чата (chats.model_name) и историю диалога из таблицы messages.
+    Возвращает (model_name или None - модель по умолчанию, история).
 
-# ИСПРАВЛЕННАЯ ФУНКЦИЯ
-def get_gemini_response_stream(chat_id: int, user_id: int, user_message: str):
+    Учитываются только сообщения после последнего сброса контекста (chats.context_start_id).
+    Подряд идущие реплики одной роли объединяются, а неотвеченные сообщения пользователя
+    в конце (включая только что сохраненное текущее) отбрасываются - их отправит send_message.
+    """
+    message_writer.wait_for_chat(chat_id)
+    db = get_db()
+    try:
+        cursor = db.cursor()
+        cursor.execute('SELECT model_name FROM chats WHERE id = ?', (chat_id,))
+        row = cursor.fetchone()
+        model_name = row['model_name'] if row else None
+        cursor.execute('''
+            SELECT m.content, m.is_bot
+            FROM messages m
+            JOIN chats c ON c.id = m.chat_id
+            WHERE m.chat_id = ? AND m.id > c.context_start_id
+            ORDER BY m.id ASC
+        ''', (chat_id,))
+        rows = cursor.fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка БД при восстановлении истории чата {chat_id}: {e}")
+        return None, []
+    if model_name is not None and model_name not in {m.value for m in GeminiModel}:
+        logger.warning(f"Сохраненная модель {model_name} чата {chat_id} больше не поддерживается, используется модель по умолчанию")
+        model_name = None
+
+    history = []
+    for row in rows:
+        role = 'model' if row['is_bot'] else 'user'
+        if history and history[-1]['role'] == role:
+            history[-1]['parts'].append(row['content'])
+        elif history or role == 'user': # История должна начинаться с реплики пользователя
+            history.append({'role': role, 'parts': [row['content']]})
+
+    if history and history[-1]['role'] == 'user':
+        history.pop()
+    return model_name, history
+
+def _mark_context_reset(chat_id: int, model_name: str = None):
     """
-    Получает потоковый ответ от Gemini, обрабатывает теги <think>,
-    отправляет структурированный JSON через SSE и сохраняет видимый ответ и размышления в БД.
+    Запоминает в БД точку сброса контекста, чтобы не восстанавливать историю до нее,
+    и выбранную модель (model_name), если она меняется.
     """
+    message_writer.wait_for_chat(chat_id) # MAX(id) должен учитывать ответы из очереди записи
+    db = get_db()
     try:
-        chat_instance = get_chat_instance(chat_id)
-    except ChatInstanceError as e:
-        yield f"data: {json.dumps({'content': None, 'thoughts': None, 'error': str(e)})}\n\n"
-        return
+        cursor = db.cursor()
+        cursor.execute('''
+            UPDATE chats
+            SET context_start_id = COALESCE((SELECT MAX(id) FROM messages WHERE chat_id = ?), 0),
+                model_name = COALESCE(?, model_name)
+            WHERE id = ?
+        ''', (chat_id, model_name, chat_id))
+        db.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка БД при сохранении точки сброса контекста чата {chat_id}: {e}")
+        db.rollback()
+        raise GeminiServiceError(f"Ошибка сохранения сброса контекста: {e}")
+
+def get_chat_instance(chat_id: int) -> ChatBackend:
+    """Возвращает или создает экземпляр GeminiChat для указанного chat_id."""
+    _ensure_reaper_started()
+    try:
+        instance = session_store.get(chat_id)
+        if instance is not None:
+            logger.debug(f"Используется существующий экземпляр Gemini для chat_id {chat_id}")
+            return instance
+
+        # Сессии нет в хранилище: она могла быть выгружена по таймауту или потеряна
+        # при рестарте воркера - восстанавливаем контекст из сохраненных сообщений
+        model_name, history = _load_chat_state(chat_id)
+        logger.info(f"Создание нового экземпляра Gemini для chat_id {chat_id} "
+                    f"(модель: {model_name or 'по умолчанию'}, реплик в истории: {len(history)})")
+        instance = create_chat(model_name=model_name, history=history)
+        session_store.save(chat_id, instance)
+        return instance
+    except Exception as e:
+        logger.error(f"Ошибка создания экземпляра GeminiChat для chat_id {chat_id}: {e}")
+        # Логируем stack trace для подробной отладки
+        logger.exception("Stack trace:")
+        raise ChatInstanceError(f"Не удалось инициализировать нейросеть: {e}")
 
-    full_visible_response = "" # Текст для отображения и сохранения в content
-    full_accumulated_thoughts = "" # Все размышления для сохранения в thoughts
-    error_occurred = False
-    current_thoughts_buffer = "" # Буфер для текущего блока <think>
-    is_inside_think_tag = False
+class _ResponseStreamProcessor:
+    """
+    Состояние обработки одного потокового ответа: принимает StreamChunk от бэкенда модели,
+    извлекает теги <think> (через ThinkTagParser) и накапливает видимый ответ и размышления
+    для сохранения в БД. Используется и синхронным (WSGI), и асинхронным (ASGI) путями стриминга.
 
-    try:
-        for raw_chunk_str in chat_instance.get_streaming_response(user_message):
-            chunk_to_yield = {"content": None, "thoughts": None, "error": None}
-            processed_visible_chunk = ""
-            send_chunk = False
+    Методы возвращают события для клиента в виде dict ({content, thoughts, error});
+    кодирование в SSE выполняется один раз - на уровне маршрута.
 
-            try:
-                # --- Обработка ошибок/данных, полученных от gemini_api.py ---
-                if raw_chunk_str.strip() and raw_chunk_str.startswith('data: '):
-                    json_str = raw_chunk_str[len('data: '):].strip()
-                    if json_str:
-                        chunk_data = json.loads(json_str)
-                        if chunk_data.get('error'):
-                            logger.error(f"Ошибка от Gemini API уровня ниже для chat_id {chat_id}: {chunk_data['error']}")
-                            chunk_to_yield["error"] = chunk_data['error']
-                            error_occurred = True
-                            send_chunk = True
-                            yield f"data: {json.dumps(chunk_to_yield)}\n\n"
-                            break # Прерываем обработку при ошибке API
-
-                        raw_content = chunk_data.get('content', '')
-                        if not raw_content:
-                            continue
-                    else:
-                        logger.warning(f"Получен пустой JSON в нижележащем потоке для chat_id {chat_id}: '{raw_chunk_str}'")
-                        continue
-                else:
-                    logger.debug(f"Пропуск строки не-SSE данных: '{raw_chunk_str[:50]}...'")
-                    continue
-
-                # --- Логика извлечения <think> тегов из raw_content ---
-                temp_raw_content = raw_content
-                while temp_raw_content:
-                    if not is_inside_think_tag:
-                        start_tag_pos = temp_raw_content.find("<think>")
-                        if start_tag_pos != -1:
-                            part = temp_raw_content[:start_tag_pos]
-                            processed_visible_chunk += part
-                            temp_raw_content = temp_raw_content[start_tag_pos + len("<think>"):]
-                            is_inside_think_tag = True
-                        else:
-                            processed_visible_chunk += temp_raw_content
-                            temp_raw_content = ""
-                    else: # is_inside_think_tag is True
-                        end_tag_pos = temp_raw_content.find("</think>")
-                        if end_tag_pos != -1:
-                            part = temp_raw_content[:end_tag_pos]
-                            current_thoughts_buffer += part
-                            # Добавляем завершенный блок размышлений к общему счету
-                            # Используем .strip() для удаления возможных пробелов по краям
-                            # и добавляем разделитель только если буфер не пустой
-                            if current_thoughts_buffer.strip():
-                                full_accumulated_thoughts += current_thoughts_buffer.strip() + "\n\n" # Двойной перенос для разделения блоков
-                            temp_raw_content = temp_raw_content[end_tag_pos + len("</think>"):]
-                            is_inside_think_tag = False
-                            # Отправляем текущий блок размышлений клиенту
-                            chunk_to_yield["thoughts"] = current_thoughts_buffer # РАСКОММЕНТИРОВАНО
-                            send_chunk = True
-                            logger.debug(f"Отправка размышлений (chat {chat_id}): {current_thoughts_buffer[:100]}...")
-                            current_thoughts_buffer = "" # Очищаем буфер
-                        else:
-                            # Накапливаем часть размышлений
-                            current_thoughts_buffer += temp_raw_content
-                            # Не добавляем в full_accumulated_thoughts здесь, сделаем это в конце, если тег не закрылся
-                            temp_raw_content = ""
-
-                # --- Подготовка и отправка обработанного чанка клиенту ---
-                if processed_visible_chunk:
-                    chunk_to_yield["content"] = processed_visible_chunk
-                    full_visible_response += processed_visible_chunk
-                    send_chunk = True
-
-                if send_chunk:
-                    yield f"data: {json.dumps(chunk_to_yield)}\n\n"
-
-            except json.JSONDecodeError:
-                logger.error(f"Ошибка декодирования JSON из нижележащего потока для chat_id {chat_id}: '{raw_chunk_str}'")
-                continue
-            except Exception as e:
-                logger.error(f"Ошибка обработки чанка из gemini_api для chat_id {chat_id}: {e}", exc_info=True)
-                continue
+    Используется как контекстный менеджер вокруг чтения потока: учитывает открытые потоки,
+    время до первого фрагмента, скорость генерации и исход запроса в метриках.
 
-    except Exception as e:
-        logger.error(f"Критическая ошибка во время стриминга от Gemini для chat_id {chat_id}: {e}", exc_info=True)
-        yield f"data: {json.dumps({'content': None, 'thoughts': None, 'error': f'Критическая ошибка сервера: {e}'})}\n\n"
-        error_occurred = True
+    cache_key - ключ кэша ответов (response_cache), если это первое сообщение сессии и кэш
+    включен: успешный ответ модели сохраняется в кэш целиком, вместе с блоками <think>.
+    Без ключа исходный текст ответа не накапливается.
+    """
 
-    # --- Добавляем незакрытые размышления в общий счетчик, если поток оборвался внутри тега ---
-    if is_inside_think_tag and current_thoughts_buffer.strip():
-        logger.warning(f"Поток завершился внутри тега <think> для chat_id {chat_id}. Добавляем остаток буфера.")
-        full_accumulated_thoughts += current_thoughts_buffer.strip()
+    def __init__(self, chat_id: int, model_name: str = None, cache_key=None):
+        self.chat_id = chat_id
+        self.model_name = model_name
+        self.cache_key = cache_key
+        self.parser = ThinkTagParser()
+        self.response_parts = [] # Исходный текст ответа (для кэша ответов)
+        self.error_occurred = False
+        self.outcome = 'ok' # Исход для метрик: ok, error, blocked, cancelled, cached (ответ из кэша)
+        self.started = perf_counter()
+        self.first_chunk_at = None
+        self.last_chunk_at = None
+
+    def __enter__(self):
+        metrics.LLM_STREAMS_ACTIVE.inc()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        metrics.LLM_STREAMS_ACTIVE.dec()
+        if exc_type is not None and not issubclass(exc_type, Exception):
+            self.outcome = 'cancelled' # GeneratorExit/CancelledError: клиент закрыл поток
+        try:
+            self._record_metrics()
+        except Exception as e:
+            logger.error(f"Ошибка записи метрик потока для chat_id {self.chat_id}: {e}")
+        return False
+
+    def _record_metrics(self):
+        labels = (getattr(Config, 'LLM_BACKEND', 'gemini'), self.model_name)
+        metrics.LLM_REQUESTS.labels(*labels, self.outcome).inc()
+        if self.first_chunk_at is None or self.outcome == 'cached':
+            return # Ответ из кэша не характеризует скорость модели
+        metrics.LLM_TIME_TO_FIRST_TOKEN.labels(*labels).observe(self.first_chunk_at - self.started)
+        duration = self.last_chunk_at - self.first_chunk_at
+        if duration > 0:
+            tokens = estimate_tokens(self.parser.visible_text) + estimate_tokens(self.parser.thoughts_text or '')
+            metrics.LLM_TOKENS_PER_SECOND.labels(*labels).observe(tokens / duration)
+
+    def _to_payload(self, events):
+        """Собирает события парсера в одно событие для клиента или None, если отправлять нечего."""
+        if not events:
+            return None
+        visible = [text for kind, text in events if kind == VISIBLE]
+        thoughts = [text for kind, text in events if kind == THOUGHT]
+        payload = {"content": "".join(visible) or None,
+                   "thoughts": "".join(thoughts) if thoughts else None,
+                   "error": None}
+        if thoughts:
+            logger.debug(f"Отправка размышлений (chat {self.chat_id}): {payload['thoughts'][:100]}...")
+        return payload
+
+    def process(self, chunk):
+        """Обрабатывает один StreamChunk от gemini_api. Возвращает событие для клиента или None."""
+        chat_id = self.chat_id
+        try:
+            # --- Обработка ошибок/блокировок, полученных от gemini_api.py ---
+            if chunk.kind is ChunkKind.ERROR:
+                logger.error(f"Ошибка от Gemini API уровня ниже для chat_id {chat_id}: {chunk.text}")
+                self.error_occurred = True # Вызывающий код прерывает поток при ошибке API
+                self.outcome = 'error'
+                return error_payload(chunk.text)
+            if chunk.kind is ChunkKind.BLOCKED:
+                self.error_occurred = True
+                self.outcome = 'blocked'
+                return error_payload(f'Content blocked by API: {chunk.text}')
+            if not chunk.text:
+                return None
+            self.last_chunk_at = perf_counter()
+            if self.first_chunk_at is None:
+                self.first_chunk_at = self.last_chunk_at
+            if self.cache_key is not None:
+                self.response_parts.append(chunk.text)
+
+            # --- Извлечение <think> тегов (в том числе разрезанных границей чанков) ---
+            return self._to_payload(self.parser.feed(chunk.text))
 
-    # --- Сохранение в БД ---
-    # Убираем лишние пробелы по краям перед сохранением
-    cleaned_response = full_visible_response.strip()
-    # Убираем лишние пробелы и пустые строки из размышлений, None если ничего нет
-    cleaned_thoughts = "\n\n".join(filter(None, [p.strip() for p in full_accumulated_thoughts.split("\n\n")])) or None
+        except Exception as e:
+            logger.error(f"Ошибка обработки чанка из gemini_api для chat_id {chat_id}: {e}", exc_info=True)
+        return None
+
+    def flush(self):
+        """
+        Завершает разбор потока: возвращает событие с придержанным парсером хвостом
+        (например, одиночным "<" в конце ответа) или None.
+        """
+        if self.parser.unclosed:
+            logger.warning(f"Поток завершился внутри тега <think> для chat_id {self.chat_id}. Добавляем остаток буфера.")
+        return self._to_payload(self.parser.close())
+
+    def critical_error(self, e: Exception) -> dict:
+        """Отмечает обрыв потока и возвращает событие с ошибкой для клиента."""
+        logger.error(f"Критическая ошибка во время стриминга от Gemini для chat_id {self.chat_id}: {e}", exc_info=True)
+        self.error_occurred = True
+        self.outcome = 'error'
+        return error_payload(f'Критическая ошибка сервера: {e}')
+
+    def result(self):
+        """Возвращает (видимый ответ, размышления) в виде, готовом к сохранению в БД."""
+        self.parser.close() # Незакрытые размышления и хвост попадают в итог, даже если flush() не вызывался
+        return self.parser.visible_text.strip(), self.parser.thoughts_text
+
+
+def _finish_response(chat_id: int, user_id: int, chat_instance: ChatBackend, processor: _ResponseStreamProcessor):
+    """Сохраняет ответ бота в БД и обновленную историю сессии в хранилище."""
+    cleaned_response, cleaned_thoughts = processor.result()
 
     # Сохраняем, только если есть видимый ответ
     if cleaned_response:
+        # HTML собирается один раз здесь, а не каждым клиентом при каждой загрузке истории
+        content_html = render_markdown(cleaned_response)
+        db = get_db()
         try:
-            db = get_db()
-            cursor = db.cursor()
-            cursor.execute(
-                'INSERT INTO messages (chat_id, user_id, content, is_bot, thoughts) VALUES (?, ?, ?, 1, ?)',
-                (chat_id, user_id, cleaned_response, cleaned_thoughts)
+            # Клиент уже получил ответ - при включенной отложенной записи не ждем фиксации
+            message_writer.execute_insert(
+                db,
+                'INSERT INTO messages (chat_id, user_id, content, is_bot, thoughts, content_html, content_html_version) '
+                'VALUES (?, ?, ?, 1, ?, ?, ?)',
+                (chat_id, user_id, cleaned_response, cleaned_thoughts, content_html, RENDERER_VERSION),
+                chat_id, user_id, wait=False
             )
-            db.commit()
             log_thoughts_info = f"с {len(cleaned_thoughts)} chars размышлений" if cleaned_thoughts else "без размышлений"
             logger.info(f"Ответ бота ({len(cleaned_response)} chars) {log_thoughts_info} сохранен в БД для chat_id {chat_id}")
         except sqlite3.Error as e:
             logger.error(f"Ошибка сохранения ответа бота в БД для chat_id {chat_id}: {e}")
             db.rollback()
-            # Можно отправить предупреждение клиенту, но это опционально
-            # yield f"data: {json.dumps({'content': None, 'thoughts': None, 'error': 'Ошибка сохранения ответа в историю'})}\n\n"
 
-    # Очистка неактивных инстансов
-    cleanup_inactive_chats()
+    if processor.outcome == 'ok' and cleaned_response:
+        response_cache.store(processor.cache_key, ''.join(processor.response_parts))
+
+    logger.debug(f"Контекст сессии chat_id {chat_id}: {chat_instance.context_stats()}")
+
+    # Сохраняем обновленную историю сессии (для общего хранилища это делает ее видимой другим воркерам)
+    try:
+        session_store.save(chat_id, chat_instance)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения сессии Gemini для chat_id {chat_id}: {e}")
+
+
+def _open_response(chat_id: int, chat_instance: ChatBackend, user_message: str, is_async: bool = False):
+    """
+    Готовит обработку ответа на сообщение. Возвращает (processor, stream), где stream - поток
+    StreamChunk (асинхронный при is_async): для первого сообщения сессии - ответ из кэша ответов
+    (RESPONSE_CACHE_ENABLED) или общая генерация с одновременными одинаковыми запросами
+    (SINGLE_FLIGHT_ENABLED), иначе - собственный запрос сессии к модели.
+    """
+    key = response_cache.request_key(chat_instance, user_message)
+    cached = response_cache.lookup(key)
+    if cached is not None:
+        processor = _ResponseStreamProcessor(chat_id, chat_instance.model_name)
+        processor.outcome = 'cached'
+        logger.info(f"Ответ на первое сообщение chat_id {chat_id} взят из кэша ответов ({len(cached)} chars)")
+        replay = _replay_cached_async if is_async else _replay_cached
+        return processor, replay(chat_instance, user_message, cached)
+
+    # Ключ кэша передается обработчику только при включенном кэше: иначе ответ некуда сохранять
+    # и копить его исходный текст незачем (single_flight использует ключ независимо от кэша)
+    processor = _ResponseStreamProcessor(chat_id, chat_instance.model_name,
+                                         cache_key=key if response_cache.enabled() else None)
+    if key is not None and single_flight.enabled():
+        subscribe = single_flight.subscribe_async if is_async else single_flight.subscribe
+        return processor, subscribe(key, chat_instance, user_message)
+    if is_async:
+        return processor, chat_instance.get_streaming_response_async(user_message)
+    return processor, chat_instance.get_streaming_response(user_message)
+
+
+def _replay_cached(chat_instance: ChatBackend, user_message: str, response_text: str):
+    """Поток ответа из кэша в формате бэкенда модели; реплика добавляется в историю сессии без запроса к API."""
+    yield StreamChunk(ChunkKind.TEXT, response_text)
+    chat_instance.append_turn(user_message, response_text)
+
+
+async def _replay_cached_async(chat_instance: ChatBackend, user_message: str, response_text: str):
+    yield StreamChunk(ChunkKind.TEXT, response_text)
+    chat_instance.append_turn(user_message, response_text)
+
+
+def get_gemini_response_stream(chat_id: int, user_id: int, user_message: str):
+    """
+    Получает потоковый ответ от Gemini, обрабатывает теги <think>, выдает события
+    для клиента (dict, кодируются в SSE маршрутом) и сохраняет видимый ответ и размышления в БД.
+    """
+    try:
+        chat_instance = get_chat_instance(chat_id)
+    except ChatInstanceError as e:
+        yield error_payload(str(e))
+        return
+
+    processor, stream = _open_response(chat_id, chat_instance, user_message)
+    with processor:
+        try:
+            for chunk in stream:
+                event = processor.process(chunk)
+                if event:
+                    yield event
+                if processor.error_occurred:
+                    break # Прерываем обработку при ошибке API
+            else:
+                tail = processor.flush()
+                if tail:
+                    yield tail
+        except Exception as e:
+            yield processor.critical_error(e)
+
+        _finish_response(chat_id, user_id, chat_instance, processor)
+
+
+async def _run_in_app_context(app, func, *args):
+    """Выполняет синхронную функцию (работа с БД) в пуле потоков внутри контекста приложения Flask."""
+    def call():
+        with app.app_context():
+            return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(None, call)
+
+
+async def get_gemini_response_stream_async(app, chat_id: int, user_id: int, user_message: str):
+    """
+    Асинхронный вариант get_gemini_response_stream для ASGI: ожидание токенов от Gemini
+    не занимает поток, а короткие обращения к БД выполняются в пуле потоков.
+    """
+    try:
+        chat_instance = await _run_in_app_context(app, get_chat_instance, chat_id)
+    except ChatInstanceError as e:
+        yield error_payload(str(e))
+        return
+
+    processor, stream = _open_response(chat_id, chat_instance, user_message, is_async=True)
+    try:
+        with processor:
+            try:
+                async for chunk in stream:
+                    event = processor.process(chunk)
+                    if event:
+                        yield event
+                    if processor.error_occurred:
+                        break # Прерываем обработку при ошибке API
+                else:
+                    tail = processor.flush()
+                    if tail:
+                        yield tail
+            except Exception as e:
+                yield processor.critical_error(e)
+
+            await _run_in_app_context(app, _finish_response, chat_id, user_id, chat_instance, processor)
+    finally:
+        # Асинхронный генератор не закрывается сборщиком мусора сразу: при отключении клиента
+        # запрос к модели (или подписка на общую генерацию) прерывается здесь
+        await stream.aclose()
 
 
 # --- Остальные функции сервиса (reset_gemini_chat, change_gemini_model, cleanup_inactive_chats, get_available_models) ---
 
 def reset_gemini_chat(chat_id: int):
     """Сбрасывает состояние чата Gemini для указанного chat_id."""
-    with instances_lock:
-        if chat_id in chat_instances:
-            try:
-                instance_data = chat_instances[chat_id]
-                instance_data['instance'].reset_chat()
-                instance_data['last_used'] = time()
-                logger.info(f"Чат Gemini для chat_id {chat_id} успешно сброшен.")
-            except Exception as e:
-                logger.error(f"Ошибка при сбросе чата Gemini для chat_id {chat_id}: {e}")
-                if chat_id in chat_instances:
-                    del chat_instances[chat_id]
-                raise GeminiServiceError(f"Ошибка сброса состояния нейросети: {e}")
-        else:
-            logger.info(f"Попытка сброса несуществующего инстанса Gemini для chat_id {chat_id}.")
+    # Точка сброса сохраняется в БД, иначе после выгрузки инстанса история восстановится заново
+    _mark_context_reset(chat_id)
+    instance = session_store.get(chat_id)
+    if instance is None:
+        logger.info(f"Попытка сброса несуществующего инстанса Gemini для chat_id {chat_id}.")
+        return
+    try:
+        instance.reset_chat()
+        session_store.save(chat_id, instance)
+        logger.info(f"Чат Gemini для chat_id {chat_id} успешно сброшен.")
+    except Exception as e:
+        logger.error(f"Ошибка при сбросе чата Gemini для chat_id {chat_id}: {e}")
+        session_store.delete(chat_id)
+        raise GeminiServiceError(f"Ошибка сброса состояния нейросети: {e}")
 
 
 def change_gemini_model(chat_id: int, model_name: str):
     """Изменяет модель Gemini для указанного chat_id."""
-    current_time = time()
-    with instances_lock:
+    try:
+        # Проверка, валидно ли имя модели (если GeminiModel доступен)
         try:
-            # Проверка, валидно ли имя модели (если GeminiModel доступен)
-            try:
-                valid_models = [m.value for m in GeminiModel]
-                if model_name not in valid_models:
-                    raise ValueError(f"Недопустимое имя модели: {model_name}")
-            except NameError:
-                 logger.warning("Enum GeminiModel не найден, проверка имени модели пропускается.")
-
-
-            if chat_id not in chat_instances:
-                logger.info(f"Создание нового экземпляра Gemini с моделью {model_name} для chat_id {chat_id}")
-                instance = GeminiChat(model_name=model_name)
-                chat_instances[chat_id] = {'instance': instance, 'last_used': current_time}
-            else:
-                instance_data = chat_instances[chat_id]
-                if instance_data['instance'].model_name != model_name:
-                    logger.info(f"Смена модели с {instance_data['instance'].model_name} на {model_name} для инстанса chat_id {chat_id}")
-                    instance_data['instance'].change_model(model_name)
-                    instance_data['last_used'] = current_time
-                else:
-                    logger.info(f"Модель {model_name} уже используется для chat_id {chat_id}, сброс чата...")
-                    instance_data['instance'].reset_chat()
-                    instance_data['last_used'] = current_time
+            valid_models = [m.value for m in GeminiModel]
+            if model_name not in valid_models:
+                raise ValueError(f"Недопустимое имя модели: {model_name}")
+        except NameError:
+             logger.warning("Enum GeminiModel не найден, проверка имени модели пропускается.")
+
+        # Смена модели всегда сбрасывает контекст чата; модель сохраняется в чате, чтобы
+        # восстановленная после выгрузки сессия использовала ее, а не модель по умолчанию
+        _mark_context_reset(chat_id, model_name)
+
+        instance = session_store.get(chat_id)
+        if instance is None:
+            logger.info(f"Создание нового экземпляра Gemini с моделью {model_name} для chat_id {chat_id}")
+            instance = create_chat(model_name=model_name)
+        elif instance.model_name != model_name:
+            logger.info(f"Смена модели с {instance.model_name} на {model_name} для инстанса chat_id {chat_id}")
+            instance.change_model(model_name)
+        else:
+            logger.info(f"Модель {model_name} уже используется для chat_id {chat_id}, сброс чата...")
+            instance.reset_chat()
+        session_store.save(chat_id, instance)
 
-            logger.info(f"Модель для chat_id {chat_id} успешно установлена/обновлена на {model_name}")
+        logger.info(f"Модель для chat_id {chat_id} успешно установлена/обновлена на {model_name}")
 
-        except ValueError as e: # Ловим ошибку невалидного имени модели
-             logger.error(f"Ошибка смены модели для chat_id {chat_id}: {e}")
-             # Передаем ошибку выше, чтобы контроллер вернул 400 или 500
-             raise GeminiServiceError(str(e))
-        except Exception as e:
-             logger.error(f"Критическая ошибка при смене модели для chat_id {chat_id} на {model_name}: {e}", exc_info=True)
-             if chat_id in chat_instances:
-                 del chat_instances[chat_id]
-             raise GeminiServiceError(f"Ошибка смены модели нейросети: {e}")
+    except ValueError as e: # Ловим ошибку невалидного имени модели
+         logger.error(f"Ошибка смены модели для chat_id {chat_id}: {e}")
+         # Передаем ошибку выше, чтобы контроллер вернул 400 или 500
+         raise GeminiServiceError(str(e))
+    except Exception as e:
+         logger.error(f"Критическая ошибка при смене модели для chat_id {chat_id} на {model_name}: {e}", exc_info=True)
+         session_store.delete(chat_id)
+         raise GeminiServiceError(f"Ошибка смены модели нейросети: {e}")
 
 
 def cleanup_inactive_chats():
-    """Удаляет неактивные экземпляры GeminiChat из памяти."""
-    current_time = time()
+    """Удаляет неактивные сессии GeminiChat из хранилища (вызывается фоновым потоком)."""
     try:
-        timeout = Config.CHAT_INSTANCE_TIMEOUT
-    except AttributeError:
-        logger.warning("CHAT_INSTANCE_TIMEOUT не найден в Config, используется значение по умолчанию 3600.")
-        timeout = 3600
-
-    cleaned_count = 0
-    with instances_lock:
-        # Копируем ключи для безопасной итерации и удаления
-        chat_ids_to_check = list(chat_instances.keys())
-        for chat_id in chat_ids_to_check:
-            # Проверяем наличие chat_id снова, на случай удаления другим потоком
-            if chat_id in chat_instances:
-                last_used = chat_instances[chat_id].get('last_used', 0)
-                if current_time - last_used > timeout:
-                    try:
-                        del chat_instances[chat_id]
-                        logger.info(f"Удален неактивный экземпляр Gemini для chat_id {chat_id} (неактивен {current_time - last_used:.0f} сек)")
-                        cleaned_count += 1
-                    except KeyError:
-                         # Уже удален, игнорируем
-                         pass
+        cleaned_count = session_store.cleanup()
+    except Exception as e:
+        logger.error(f"Ошибка очистки неактивных сессий Gemini: {e}")
+        return
 
     if cleaned_count > 0:
-        logger.debug(f"Очистка завершена. Удалено {cleaned_count} неактивных инстансов. Осталось: {len(chat_instances)}")
+        logger.debug(f"Очистка завершена. Удалено {cleaned_count} неактивных инстансов. Статистика: {get_session_stats()}")
     # else: logger.debug("Очистка чатов: неактивных инстансов не найдено.")
 
 
+def _reaper_loop(interval: float):
+    while not _reaper_stop.wait(interval):
+        cleanup_inactive_chats()
+
+
+def _ensure_reaper_started():
+    """
+    Лениво запускает поток очистки сессий. Проверка PID нужна, так как потоки
+    не переживают fork (например, gunicorn --preload) - в каждом воркере свой поток.
+    """
+    global _reaper_thread, _reaper_pid
+    if _reaper_thread is not None and _reaper_pid == os.getpid():
+        return
+    with _reaper_lock:
+        if _reaper_thread is not None and _reaper_pid == os.getpid():
+            return
+        interval = getattr(Config, 'SESSION_REAPER_INTERVAL', 60)
+        _reaper_thread = Thread(target=_reaper_loop, args=(interval,), name='gemini-session-reaper', daemon=True)
+        _reaper_pid = os.getpid()
+        _reaper_thread.start()
+        logger.info(f"Запущен поток очистки сессий Gemini (интервал {interval} сек)")
+
+
+def get_session_stats() -> dict:
+    """Возвращает счетчики хранилища сессий (размер, попадания/промахи, вытеснения)."""
+    try:
+        return session_store.stats()
+    except Exception as e:
+        logger.error(f"Ошибка получения статистики хранилища сессий: {e}")
+        return {}
+
+
 def get_available_models():
     """Возвращает список доступных моделей из Enum."""
     try:
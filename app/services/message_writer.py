@@ -0,0 +1,335 @@
+# app/services/message_writer.py
+import atexit
+import logging
+import os
+import sqlite3
+from collections import Counter
+from queue import Queue, Empty, Full
+from threading import Condition, Event, Lock, Thread
+from time import monotonic
+from ..config import Config
+from .. import database
+
+logger = logging.getLogger(__name__)
+
+_STOP = object() # Маркер остановки потока записи
+
+
+class WriteBehindError(Exception):
+    """Запись не может быть поставлена в очередь (очередь переполнена или поток остановлен)."""
+    pass
+
+
+class PendingWrite:
+    """Результат отложенной записи: wait() возвращает lastrowid после фиксации транзакции."""
+
+    __slots__ = ('sql', 'params', 'chat_id', 'user_id', '_done', 'lastrowid', 'error', 'claimed', 'cancelled')
+
+    def __init__(self, sql, params, chat_id, user_id):
+        self.sql = sql
+        self.params = params
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self._done = Event()
+        self.lastrowid = None
+        self.error = None
+        self.claimed = False # Взята потоком записи в пачку - отменить уже нельзя
+        self.cancelled = False
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError("Запись в БД не подтверждена за отведенное время")
+        if self.error is not None:
+            raise self.error
+        return self.lastrowid
+
+
+class MessageWriter:
+    """
+    Фоновая запись сообщений в БД с групповой фиксацией (write-behind).
+
+    Вставки из разных запросов попадают в ограниченную очередь; поток записи забирает их
+    пачками (до max_batch штук или пока не пройдет flush_interval_ms после первой) и
+    выполняет одной транзакцией - один fsync на пачку вместо одного на сообщение.
+
+    Для чтения своих записей (read-your-writes) ведется счетчик незафиксированных записей
+    по chat_id и user_id: wait_for_chat()/wait_for_user() блокируют читателя до их фиксации.
+    При остановке (close(), в том числе через atexit) очередь дописывается до конца.
+    """
+
+    def __init__(self, db_url: str, max_queue: int, max_batch: int, flush_interval_ms: float):
+        self.db_url = db_url
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval_ms / 1000.0
+        self._queue = Queue(maxsize=max_queue)
+        self._pending_chats = Counter()
+        self._pending_users = Counter()
+        self._pending_cond = Condition()
+        self._closed = False
+        self.batches = 0
+        self.writes = 0
+        self._thread = Thread(target=self._run, name='message-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, sql: str, params, chat_id: int, user_id: int, timeout: float = 1.0) -> PendingWrite:
+        """Ставит INSERT в очередь. Бросает WriteBehindError, если очередь не освободилась за timeout."""
+        if self._closed or not self._thread.is_alive():
+            raise WriteBehindError("Поток записи остановлен")
+        item = PendingWrite(sql, params, chat_id, user_id)
+        with self._pending_cond:
+            self._pending_chats[chat_id] += 1
+            self._pending_users[user_id] += 1
+        try:
+            self._queue.put(item, timeout=timeout)
+        except Full:
+            self._complete(item)
+            raise WriteBehindError("Очередь записи переполнена")
+        return item
+
+    def cancel(self, item: PendingWrite) -> bool:
+        """
+        Отменяет запись, которую поток записи еще не взял в пачку. False - запись уже выполняется,
+        и ее результат нужно дождаться через item.wait().
+        """
+        with self._pending_cond:
+            if item.claimed:
+                return False
+            item.cancelled = True
+            self._release(item)
+        return True
+
+    def wait_for_chat(self, chat_id: int, timeout: float = None) -> bool:
+        """Ждет фиксации всех поставленных в очередь записей чата. False - по таймауту."""
+        with self._pending_cond:
+            return self._pending_cond.wait_for(lambda: not self._pending_chats[chat_id], timeout)
+
+    def wait_for_user(self, user_id: int, timeout: float = None) -> bool:
+        """Ждет фиксации всех поставленных в очередь записей пользователя. False - по таймауту."""
+        with self._pending_cond:
+            return self._pending_cond.wait_for(lambda: not self._pending_users[user_id], timeout)
+
+    def close(self, timeout: float = 10.0):
+        """Дописывает очередь и останавливает поток записи."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error("Поток записи сообщений не завершился вовремя, часть записей может быть потеряна")
+        else:
+            logger.info(f"Поток записи сообщений остановлен. Статистика: {self.stats()}")
+
+    def stats(self) -> dict:
+        """Счетчики для логов и метрик: размер очереди, число пачек и записей."""
+        return {
+            'queued': self._queue.qsize(),
+            'batches': self.batches,
+            'writes': self.writes,
+            'avg_batch': round(self.writes / self.batches, 2) if self.batches else None,
+        }
+
+    def _release(self, item: PendingWrite):
+        """Снимает запись со счетчиков незафиксированных (под self._pending_cond)."""
+        self._pending_chats[item.chat_id] -= 1
+        if not self._pending_chats[item.chat_id]:
+            del self._pending_chats[item.chat_id]
+        self._pending_users[item.user_id] -= 1
+        if not self._pending_users[item.user_id]:
+            del self._pending_users[item.user_id]
+        self._pending_cond.notify_all()
+
+    def _complete(self, item: PendingWrite):
+        with self._pending_cond:
+            self._release(item)
+        item._done.set()
+
+    def _next_batch(self):
+        """Собирает пачку записей. Возвращает (batch, stop)."""
+        item = self._queue.get()
+        if item is _STOP:
+            return [], True
+        batch = [item]
+        deadline = monotonic() + self.flush_interval
+        while len(batch) < self.max_batch:
+            remaining = deadline - monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        conn = None
+        stop = False
+        try:
+            conn = database.create_connection(self.db_url)
+            while not stop:
+                batch, stop = self._next_batch()
+                if batch:
+                    try:
+                        self._write_batch(conn, batch)
+                    except Exception as e:
+                        # Поток записи не должен умирать из-за одной пачки: иначе очередь встанет
+                        logger.exception(f"Непредвиденная ошибка записи пачки ({len(batch)} записей): {e}")
+                        self._fail(batch, e)
+        except Exception as e:
+            logger.exception(f"Поток записи сообщений остановлен из-за ошибки: {e}")
+            # Ожидающие в очереди записи не должны висеть до таймаута
+            self._fail(self._drain(), e)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _drain(self):
+        """Забирает из очереди все оставшиеся записи (без маркера остановки)."""
+        items = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except Empty:
+                return items
+            if item is not _STOP:
+                items.append(item)
+
+    def _fail(self, items, error: Exception):
+        """Завершает с ошибкой записи, которые не были выполнены и не отменены."""
+        with self._pending_cond:
+            items = [item for item in items if not item.cancelled and not item._done.is_set()]
+            for item in items:
+                item.claimed = True
+        for item in items:
+            item.lastrowid = None
+            item.error = _as_db_error(error)
+            self._complete(item)
+
+    def _write_batch(self, conn, batch):
+        with self._pending_cond:
+            for item in batch:
+                item.claimed = not item.cancelled
+        batch = [item for item in batch if item.claimed] # Отмененные по таймауту не пишем
+        if not batch:
+            return
+        try:
+            with conn: # Одна транзакция на всю пачку
+                for item in batch:
+                    item.lastrowid = conn.execute(item.sql, item.params).lastrowid
+        except Exception as e:
+            # Одна ошибочная запись не должна терять остальные - повторяем по одной
+            logger.warning(f"Ошибка групповой записи ({len(batch)} записей), повтор по одной: {e}")
+            for item in batch:
+                try:
+                    with conn:
+                        item.lastrowid = conn.execute(item.sql, item.params).lastrowid
+                except Exception as item_error:
+                    logger.error(f"Ошибка записи сообщения в чат {item.chat_id}: {item_error}")
+                    item.lastrowid = None
+                    item.error = _as_db_error(item_error)
+        self.batches += 1
+        self.writes += len(batch)
+        for item in batch:
+            self._complete(item)
+
+
+def _as_db_error(error: Exception) -> sqlite3.Error:
+    """Вызывающий код ловит sqlite3.Error - прочие исключения записи приводим к нему."""
+    if isinstance(error, sqlite3.Error):
+        return error
+    return sqlite3.OperationalError(f"Ошибка записи в БД: {error}")
+
+
+_writer = None
+_writer_pid = None
+_writer_lock = Lock()
+
+
+def _close_writer():
+    if _writer is not None and _writer_pid == os.getpid():
+        _writer.close()
+
+
+def get_writer():
+    """
+    Возвращает фоновый поток записи процесса или None, если WRITE_BEHIND_ENABLED выключен.
+    Запускается лениво; проверка PID нужна, так как потоки не переживают fork. Если поток
+    записи неожиданно завершился, он перезапускается (до перезапуска submit() отказывает,
+    и execute_insert пишет синхронно).
+    """
+    global _writer, _writer_pid
+    if not getattr(Config, 'WRITE_BEHIND_ENABLED', False):
+        return None
+    if _writer is not None and _writer_pid == os.getpid() and (_writer._closed or _writer._thread.is_alive()):
+        return _writer
+    with _writer_lock:
+        if _writer is None or _writer_pid != os.getpid() or not (_writer._closed or _writer._thread.is_alive()):
+            if _writer is not None and _writer_pid == os.getpid():
+                logger.error("Поток записи сообщений неожиданно завершился, перезапуск")
+            first_start = _writer is None
+            db_url = database.DATABASE_URL or Config.DATABASE_URL
+            _writer = MessageWriter(db_url,
+                                    max_queue=getattr(Config, 'WRITE_BEHIND_MAX_QUEUE', 1000),
+                                    max_batch=getattr(Config, 'WRITE_BEHIND_MAX_BATCH', 100),
+                                    flush_interval_ms=getattr(Config, 'WRITE_BEHIND_FLUSH_INTERVAL_MS', 5))
+            _writer_pid = os.getpid()
+            if first_start:
+                atexit.register(_close_writer)
+            logger.info(f"Запущен поток групповой записи сообщений в БД: {db_url}")
+    return _writer
+
+
+def wait_for_chat(chat_id: int, timeout: float = 5.0):
+    """Read-your-writes: перед чтением сообщений чата дожидается фиксации его отложенных записей."""
+    writer = get_writer()
+    if writer is not None and not writer.wait_for_chat(chat_id, timeout):
+        logger.warning(f"Отложенные записи чата {chat_id} не зафиксированы за {timeout} сек")
+
+
+def wait_for_user(user_id: int, timeout: float = 5.0):
+    """Read-your-writes для списка чатов пользователя."""
+    writer = get_writer()
+    if writer is not None and not writer.wait_for_user(user_id, timeout):
+        logger.warning(f"Отложенные записи пользователя {user_id} не зафиксированы за {timeout} сек")
+
+
+def get_writer_stats() -> dict:
+    """Счетчики потока записи ({} если он выключен или еще не запускался)."""
+    return _writer.stats() if _writer is not None else {}
+
+
+def execute_insert(db, sql: str, params, chat_id: int, user_id: int, wait: bool = True, timeout: float = 5.0):
+    """
+    Выполняет INSERT сообщения через поток записи (если он включен) или напрямую через db.
+
+    wait=True - дождаться фиксации пачки и вернуть id записи; wait=False - вернуть None сразу
+    (write-behind). Если очередь переполнена, запись выполняется синхронно на соединении db.
+    Ошибки БД пробрасываются как sqlite3.Error; при таймауте ожидания запись, еще не взятая в
+    пачку, отменяется, так что после ошибки сообщение в БД не появится.
+    """
+    writer = get_writer()
+    if writer is not None:
+        try:
+            pending = writer.submit(sql, params, chat_id, user_id)
+        except WriteBehindError as e:
+            logger.warning(f"{e}: сообщение чата {chat_id} записывается синхронно")
+            # Сохраняем порядок сообщений чата: синхронная запись - только после записей из очереди
+            if not writer.wait_for_chat(chat_id, timeout):
+                raise sqlite3.OperationalError(
+                    f"Отложенные записи чата {chat_id} не зафиксированы за {timeout} сек")
+        else:
+            if not wait:
+                return None
+            try:
+                return pending.wait(timeout)
+            except TimeoutError as e:
+                if writer.cancel(pending):
+                    raise sqlite3.OperationalError(str(e))
+                # Запись уже в транзакции пачки: ошибка сейчас означала бы сообщение,
+                # сохраненное без ведома вызывающего, - дожидаемся результата
+                logger.warning(f"Запись сообщения чата {chat_id} выполняется дольше {timeout} сек, ожидание подтверждения")
+                return pending.wait()
+    cursor = db.execute(sql, params)
+    db.commit()
+    return cursor.lastrowid
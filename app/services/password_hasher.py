@@ -0,0 +1,104 @@
+# app/services/password_hasher.py
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import BoundedSemaphore, Lock
+from werkzeug.security import generate_password_hash, check_password_hash
+from ..config import Config
+
+logger = logging.getLogger(__name__)
+
+# Пул процессов для хеширования паролей: pbkdf2 занимает ядро CPU целиком и под GIL
+# останавливает все остальные потоки воркера (в том числе открытые SSE-потоки)
+_pool = None
+_pool_pid = None
+_pool_lock = Lock()
+_slots = None # Ограничение числа задач в пуле (выполняемых и ожидающих)
+
+
+class PasswordHasherBusyError(Exception):
+    """Пул хеширования перегружен: задача не поставлена за отведенное время."""
+    pass
+
+
+def password_method() -> str:
+    """Метод хеширования для werkzeug: алгоритм и стоимость (число итераций) из конфигурации."""
+    method = getattr(Config, 'PASSWORD_HASH_METHOD', 'pbkdf2:sha256')
+    iterations = getattr(Config, 'PASSWORD_HASH_ITERATIONS', None)
+    return f"{method}:{iterations}" if iterations else method
+
+
+def _get_pool():
+    """
+    Лениво создает пул процессов (отдельный в каждом воркере - пулы не переживают fork).
+    Процессы запускаются через spawn: fork из многопоточного воркера может унаследовать
+    захваченные другими потоками блокировки (логирование, SQLite) и зависнуть.
+    """
+    global _pool, _pool_pid, _slots
+    workers = getattr(Config, 'PASSWORD_HASH_WORKERS', 2)
+    if workers <= 0:
+        return None
+    if _pool is not None and _pool_pid == os.getpid():
+        return _pool
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _pool_pid = os.getpid()
+            _slots = BoundedSemaphore(workers + getattr(Config, 'PASSWORD_HASH_MAX_PENDING', 32))
+            logger.info(f"Создан пул хеширования паролей: {workers} процессов, метод {password_method()}")
+    return _pool
+
+
+def _reset_pool(broken):
+    """Отбрасывает поврежденный пул (процесс пула завершился аварийно); следующий вызов создаст новый."""
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False)
+
+
+def _run(func, *args):
+    for _ in range(2): # Поврежденный пул пересоздается один раз
+        pool = _get_pool()
+        if pool is None:
+            return func(*args) # PASSWORD_HASH_WORKERS=0 - хеширование в текущем потоке
+        slots = _slots
+        if not slots.acquire(timeout=getattr(Config, 'PASSWORD_HASH_QUEUE_TIMEOUT', 5)):
+            raise PasswordHasherBusyError("Пул хеширования паролей перегружен")
+        try:
+            return pool.submit(func, *args).result()
+        except BrokenProcessPool as e:
+            logger.error(f"Пул хеширования паролей поврежден, пересоздается: {e}")
+            _reset_pool(pool)
+        finally:
+            slots.release()
+    logger.error("Пул хеширования паролей снова поврежден, хеширование в текущем потоке")
+    return func(*args)
+
+
+def hash_password(password: str) -> str:
+    """Хеширует пароль текущим методом из конфигурации (в пуле процессов)."""
+    return _run(generate_password_hash, password, password_method())
+
+
+def verify_password(password_hash: str, password: str) -> bool:
+    """Проверяет пароль по сохраненному хешу (в пуле процессов)."""
+    return _run(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash: str) -> bool:
+    """True, если хеш создан другим методом или с другой стоимостью, чем задано в конфигурации."""
+    stored_method = password_hash.split('$', 1)[0]
+    return stored_method != password_method()
+
+
+def shutdown():
+    """Останавливает пул процессов (например, при завершении приложения)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.shutdown(wait=True)
+        _pool = None
@@ -0,0 +1,65 @@
+# app/services/response_cache.py
+import logging
+import sys
+from ..config import Config
+from ..utils import metrics
+from ..utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Кэш ответов на первое сообщение чата: (модель, хеш системного промпта, сообщение) -> полный
+# текст ответа модели (вместе с блоками <think>, чтобы повтор разбирался так же, как живой поток)
+_cache = TTLCache(max_entries=getattr(Config, 'RESPONSE_CACHE_MAX_ENTRIES', 1000),
+                  ttl=getattr(Config, 'RESPONSE_CACHE_TTL', 3600),
+                  sliding=False, # Ответ не должен жить дольше TTL, как бы часто его ни запрашивали
+                  max_bytes=getattr(Config, 'RESPONSE_CACHE_MAX_BYTES', 0) or None,
+                  sizeof=sys.getsizeof)
+
+
+def request_key(instance, message: str):
+    """
+    Ключ запроса, ответ на который не зависит от сессии: (модель, хеш системного промпта, сообщение).
+    None, если хеш промпта неизвестен или в сессии уже есть реплики (ответ зависит от предыдущего диалога).
+    Тот же ключ использует объединение одновременных запросов (single_flight).
+    """
+    if instance.system_prompt_hash is None or instance.history_tokens:
+        return None
+    return instance.model_name, instance.system_prompt_hash, message
+
+
+def enabled() -> bool:
+    return getattr(Config, 'RESPONSE_CACHE_ENABLED', False)
+
+
+def lookup(key):
+    """Возвращает сохраненный ответ или None (в том числе при выключенном кэше)."""
+    if key is None or not enabled():
+        return None
+    return _cache.get(key)
+
+
+def store(key, response_text: str):
+    """Сохраняет полный ответ модели на первое сообщение."""
+    if key is None or not response_text or not enabled():
+        return
+    _cache.set(key, response_text)
+    logger.debug(f"Ответ модели {key[0]} сохранен в кэш ответов ({len(response_text)} chars)")
+
+
+def clear():
+    _cache.clear()
+
+
+def get_response_cache_stats() -> dict:
+    """Счетчики кэша ответов: размер, попадания/промахи, вытеснения."""
+    return _cache.stats()
+
+
+metrics.CallbackMetric('response_cache_hits_total', 'Ответы на первое сообщение, выданные из кэша',
+                       lambda: _cache.hits, kind='counter')
+metrics.CallbackMetric('response_cache_misses_total', 'Первые сообщения, для которых ответа в кэше не было',
+                       lambda: _cache.misses, kind='counter')
+metrics.CallbackMetric('response_cache_hit_ratio', 'Доля попаданий в кэш ответов с запуска процесса',
+                       lambda: get_response_cache_stats().get('hit_ratio'))
+metrics.CallbackMetric('response_cache_entries', 'Ответы в кэше', lambda: len(_cache))
+metrics.CallbackMetric('response_cache_bytes', 'Размер ответов в кэше (байт)', lambda: _cache.bytes)
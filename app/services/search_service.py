@@ -0,0 +1,205 @@
+# app/services/search_service.py
+import html
+import logging
+import os
+import sqlite3
+import time
+from threading import Lock, Thread
+from app.config import Config
+from app import database
+from app.database import get_db
+from . import message_writer
+
+logger = logging.getLogger(__name__)
+
+class SearchServiceError(Exception):
+    """Базовый класс для ошибок поиска."""
+    pass
+
+class InvalidQueryError(SearchServiceError):
+    """Некорректный поисковый запрос или параметры пагинации."""
+    pass
+
+class SearchUnavailableError(SearchServiceError):
+    """Полнотекстовый индекс недоступен (SQLite без FTS5)."""
+    pass
+
+
+# Границы совпадения в snippet(): символы из области частного использования, которых нет в обычном
+# тексте, - после экранирования HTML они заменяются на <mark>
+_MARK_START, _MARK_END = '\ue000', '\ue001'
+SNIPPET_TOKENS = 16 # Длина фрагмента с совпадением (токенов)
+
+
+def _match_expression(query: str, user_id: int) -> str:
+    """
+    Выражение MATCH для FTS5: каждое слово запроса - отдельная фраза в кавычках (синтаксис FTS5
+    в пользовательском вводе не интерпретируется), все слова обязательны, последнее - как префикс
+    (поиск по мере ввода). Поиск ограничен сообщениями пользователя по индексируемой колонке user_id.
+    """
+    terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+    terms[-1] += '*'
+    return f'user_id : "{int(user_id)}" AND content : ({" ".join(terms)})'
+
+
+def _snippet_html(snippet: str) -> str:
+    return html.escape(snippet).replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>')
+
+
+def _parse_int(value, name: str, minimum: int):
+    if value is None or value == '':
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise InvalidQueryError(f'Параметр {name} должен быть целым числом')
+    if value < minimum:
+        raise InvalidQueryError(f'Параметр {name} должен быть не меньше {minimum}')
+    return value
+
+
+def search_messages(user_id: int, query: str, limit=None, offset=None):
+    """
+    Полнотекстовый поиск по сообщениям всех чатов пользователя, по убыванию релевантности (bm25).
+
+    Возвращает {'results': [...], 'next_offset': смещение следующей страницы или None}; у каждого
+    результата есть snippet - фрагмент сообщения с совпадениями в <mark> (HTML экранирован).
+    """
+    query = (query or '').strip()
+    if not query:
+        raise InvalidQueryError('Поисковый запрос не может быть пустым')
+    if len(query) > Config.SEARCH_QUERY_MAX_CHARS:
+        raise InvalidQueryError('Поисковый запрос слишком длинный')
+    limit = min(_parse_int(limit, 'limit', 1) or Config.SEARCH_PAGE_SIZE, Config.SEARCH_PAGE_MAX)
+    offset = _parse_int(offset, 'offset', 0) or 0
+
+    _ensure_indexer_started()
+    message_writer.wait_for_user(user_id) # Read-your-writes при включенной отложенной записи
+
+    db = get_db()
+    try:
+        # Запрашиваем на одну запись больше, чтобы узнать, есть ли следующая страница
+        rows = db.execute('''
+            SELECT m.id, m.chat_id, c.title AS chat_title, m.is_bot, m.created_at,
+                   snippet(messages_fts, 0, ?, ?, '…', ?) AS snippet
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            JOIN chats c ON c.id = m.chat_id
+            WHERE messages_fts MATCH ? AND c.user_id = ?
+            ORDER BY rank
+            LIMIT ? OFFSET ?
+        ''', (_MARK_START, _MARK_END, SNIPPET_TOKENS, _match_expression(query, user_id),
+              user_id, limit + 1, offset)).fetchall()
+    except sqlite3.OperationalError as e:
+        if 'no such table: messages_fts' in str(e).lower():
+            raise SearchUnavailableError('Поиск по сообщениям недоступен')
+        logger.error(f"Ошибка полнотекстового поиска для пользователя ID={user_id}: {e}")
+        raise SearchServiceError(f"Ошибка сервера при поиске: {e}")
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка БД при поиске для пользователя ID={user_id}: {e}")
+        raise SearchServiceError(f"Ошибка сервера при поиске: {e}")
+
+    results = [{
+        'message_id': row['id'],
+        'chat_id': row['chat_id'],
+        'chat_title': row['chat_title'],
+        'is_bot': bool(row['is_bot']),
+        'created_at': row['created_at'].isoformat().replace('+00:00', 'Z'),
+        'snippet': _snippet_html(row['snippet']),
+    } for row in rows[:limit]]
+    return {'results': results, 'next_offset': offset + limit if len(rows) > limit else None}
+
+
+# --- Постепенная индексация сообщений, созданных до появления индекса ---
+
+_indexer_thread = None
+_indexer_pid = None
+_indexer_lock = Lock()
+_index_complete = False
+
+
+def index_existing_batch(conn, batch_size: int) -> int:
+    """
+    Индексирует следующую пачку сообщений, существовавших до создания индекса (одна короткая
+    транзакция). BEGIN IMMEDIATE сериализует пачки между воркерами: каждая строка индексируется
+    один раз. Возвращает число проиндексированных строк (0 - в диапазоне были только удаленные
+    сообщения) или None, если индексировать больше нечего.
+    """
+    conn.commit()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        state = conn.execute('SELECT target_id, indexed_id FROM search_index_state').fetchone()
+        if state is None or state['indexed_id'] >= state['target_id']:
+            conn.rollback()
+            return None
+        upper = conn.execute('''
+            SELECT MAX(id) FROM (SELECT id FROM messages WHERE id > ? AND id <= ? ORDER BY id LIMIT ?)
+        ''', (state['indexed_id'], state['target_id'], batch_size)).fetchone()[0] or state['target_id']
+        count = conn.execute('''
+            INSERT INTO messages_fts (rowid, content, user_id)
+            SELECT id, content, user_id FROM messages WHERE id > ? AND id <= ?
+        ''', (state['indexed_id'], upper)).rowcount
+        conn.execute('UPDATE search_index_state SET indexed_id = ?', (upper,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    logger.debug(f"Проиндексированы сообщения до id {upper} из {state['target_id']}")
+    return count
+
+
+def _indexer_loop(db_url: str, batch_size: int, pause: float):
+    global _index_complete, _indexer_thread
+    total = 0
+    try:
+        conn = database.create_connection(db_url)
+    except sqlite3.Error as e:
+        logger.error(f"Не удалось открыть БД для индексации сообщений: {e}")
+        return
+    try:
+        while True:
+            count = index_existing_batch(conn, batch_size)
+            if count is None:
+                break
+            total += count
+            time.sleep(pause) # Паузы между пачками оставляют окно для записей обработчиков запросов
+        _index_complete = True
+        if total:
+            logger.info(f"Индексация существующих сообщений для поиска завершена ({total} строк)")
+    except sqlite3.OperationalError as e:
+        if 'no such table' in str(e).lower():
+            _index_complete = True # Индекса нет (SQLite без FTS5)
+        else:
+            logger.error(f"Ошибка индексации сообщений для поиска: {e}")
+    except Exception as e:
+        logger.error(f"Ошибка индексации сообщений для поиска: {e}", exc_info=True)
+    finally:
+        conn.close()
+        if not _index_complete:
+            _indexer_thread = None # Следующий поиск запустит индексацию заново
+
+
+def _ensure_indexer_started(db_url: str = None):
+    """
+    Лениво запускает фоновую индексацию существующих сообщений (по одному потоку на процесс,
+    проверка PID - как у потока очистки сессий). После завершения больше не запускается.
+    """
+    global _indexer_thread, _indexer_pid
+    if _index_complete or (_indexer_thread is not None and _indexer_pid == os.getpid()):
+        return
+    with _indexer_lock:
+        if _index_complete or (_indexer_thread is not None and _indexer_pid == os.getpid()):
+            return
+        db_url = db_url or database.DATABASE_URL
+        if not db_url:
+            return
+        _indexer_thread = Thread(target=_indexer_loop, name='search-indexer', daemon=True,
+                                 args=(db_url, Config.SEARCH_INDEX_BATCH_SIZE,
+                                       Config.SEARCH_INDEX_BATCH_PAUSE_MS / 1000.0))
+        _indexer_pid = os.getpid()
+        _indexer_thread.start()
+
+
+def start_indexer(db_url: str):
+    """Запускает индексацию существующих сообщений при старте приложения."""
+    _ensure_indexer_started(db_url)
@@ -0,0 +1,235 @@
+# app/services/session_store.py
+import json
+import logging
+import sqlite3
+import zlib
+from contextlib import contextmanager
+from time import time
+from ..external.llm_backend import ChatBackend, create_chat
+from ..utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStore:
+    """Базовый интерфейс хранилища сессий чата с моделью (история + выбранная модель)."""
+
+    def get(self, chat_id: int):
+        """Возвращает сессию (ChatBackend) для chat_id или None, если сессии нет."""
+        raise NotImplementedError
+
+    def save(self, chat_id: int, instance: ChatBackend):
+        """Сохраняет (или обновляет) сессию после изменения ее состояния."""
+        raise NotImplementedError
+
+    def delete(self, chat_id: int):
+        """Удаляет сессию, если она есть."""
+        raise NotImplementedError
+
+    def cleanup(self) -> int:
+        """Удаляет устаревшие сессии. Возвращает число удаленных."""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        """Счетчики хранилища (размер, попадания/промахи, вытеснения) для логов и метрик."""
+        return {'size': len(self)}
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Хранилище в памяти процесса. Быстрое, но не разделяется между воркерами WSGI.
+
+    Сессии лежат в LRU-кэше с TTL и ограничениями числа записей и суммарного размера
+    (оценка ChatBackend.estimate_size, max_bytes). При hibernate_after > 0 сессия, которая
+    простаивает дольше hibernate_after секунд или вытесняется по лимиту, "засыпает": ее модель
+    и история сжимаются в компактный блоб (JSON + zlib), а объекты SDK освобождаются. Следующее
+    обращение восстанавливает сессию из блоба без запроса к БД. Блобы хранятся до timeout секунд
+    в отдельном кэше со своим лимитом размера; сессия, выпавшая и оттуда, восстанавливается из БД.
+    """
+
+    def __init__(self, timeout: float, max_entries: int, max_bytes: int = 0, hibernate_after: float = 0,
+                 hibernated_max_entries: int = 100000, hibernated_max_bytes: int = 0):
+        self.hibernation = hibernate_after > 0
+        live_ttl = min(hibernate_after, timeout) if self.hibernation else timeout
+        self._cache = TTLCache(max_entries=max_entries, ttl=live_ttl, on_evict=self._on_evict,
+                               max_bytes=max_bytes or None, sizeof=self._sizeof)
+        self._hibernated = TTLCache(max_entries=hibernated_max_entries, ttl=timeout,
+                                    max_bytes=hibernated_max_bytes or None, sizeof=len)
+        self.hibernations = 0
+        self.revivals = 0
+
+    @staticmethod
+    def _sizeof(instance) -> int:
+        try:
+            return instance.estimate_size()
+        except Exception as e:
+            logger.error(f"Ошибка оценки размера сессии: {e}")
+            return 0
+
+    @staticmethod
+    def _freeze(instance: ChatBackend) -> bytes:
+        state = {'model_name': instance.model_name, 'history': instance.get_history()}
+        return zlib.compress(json.dumps(state, ensure_ascii=False).encode('utf-8'))
+
+    @staticmethod
+    def _thaw(blob: bytes) -> ChatBackend:
+        state = json.loads(zlib.decompress(blob).decode('utf-8'))
+        return create_chat(model_name=state['model_name'], history=state['history'])
+
+    def _on_evict(self, chat_id, instance, reason):
+        if not self.hibernation:
+            if reason == 'capacity':
+                logger.info(f"Экземпляр Gemini для chat_id {chat_id} вытеснен из памяти (превышен лимит сессий)")
+            else:
+                logger.info(f"Удален неактивный экземпляр Gemini для chat_id {chat_id}")
+            return
+        try:
+            blob = self._freeze(instance)
+        except Exception as e:
+            logger.error(f"Не удалось усыпить сессию chat_id {chat_id}, она будет восстановлена из БД: {e}")
+            return
+        self._hibernated.set(chat_id, blob)
+        self.hibernations += 1
+        cause = 'превышен лимит сессий' if reason == 'capacity' else 'нет активности'
+        logger.info(f"Сессия chat_id {chat_id} усыплена ({cause}): блоб {len(blob)} байт")
+
+    def get(self, chat_id: int):
+        instance = self._cache.get(chat_id)
+        if instance is not None or not self.hibernation:
+            return instance
+        blob = self._hibernated.pop(chat_id)
+        if blob is None:
+            return None
+        try:
+            instance = self._thaw(blob)
+        except Exception as e:
+            logger.error(f"Не удалось восстановить усыпленную сессию chat_id {chat_id}: {e}")
+            return None
+        self.revivals += 1
+        self._cache.set(chat_id, instance)
+        logger.debug(f"Сессия chat_id {chat_id} восстановлена из блоба ({len(blob)} байт)")
+        return instance
+
+    def save(self, chat_id: int, instance: ChatBackend):
+        self._cache.set(chat_id, instance)
+        if self.hibernation:
+            self._hibernated.pop(chat_id) # Блоб устарел
+
+    def delete(self, chat_id: int):
+        self._cache.pop(chat_id)
+        self._hibernated.pop(chat_id)
+
+    def cleanup(self) -> int:
+        # Просроченные живые сессии засыпают (on_evict), просроченные блобы удаляются
+        return self._cache.expire() + self._hibernated.expire()
+
+    def stats(self) -> dict:
+        stats = self._cache.stats()
+        hibernated = self._hibernated.stats()
+        stats.update({
+            'hibernated': hibernated['size'],
+            'hibernated_bytes': hibernated['bytes'],
+            'hibernated_evictions': hibernated['evictions'],
+            'hibernations': self.hibernations,
+            'revivals': self.revivals,
+        })
+        return stats
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Хранилище в SQLite: история и модель сериализуются в таблицу chat_sessions,
+    поэтому все воркеры (процессы) видят одно и то же состояние чата.
+
+    Кэша в памяти процесса перед таблицей нет намеренно: другой воркер мог обновить историю.
+    Поэтому get() на каждый запрос читает строку, разбирает JSON истории и заново создает
+    сессию через create_chat(); эта цена растет с длиной истории. stats() - запрос COUNT(*).
+    """
+
+    def __init__(self, db_url: str, timeout: float, busy_timeout: float = 5.0):
+        self.db_url = db_url
+        self.timeout = timeout
+        self.busy_timeout = busy_timeout
+        self._ensure_schema()
+
+    @contextmanager
+    def _connect(self):
+        """Короткоживущее соединение: транзакция фиксируется при выходе, соединение закрывается."""
+        conn = sqlite3.connect(self.db_url, timeout=self.busy_timeout)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _ensure_schema(self):
+        with self._connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS chat_sessions (
+                    chat_id INTEGER PRIMARY KEY,
+                    model_name TEXT NOT NULL,
+                    history TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_chat_sessions_updated_at ON chat_sessions (updated_at)')
+        logger.info(f"Хранилище сессий SQLite готово: {self.db_url}")
+
+    def get(self, chat_id: int):
+        with self._connect() as conn:
+            row = conn.execute('SELECT model_name, history FROM chat_sessions WHERE chat_id = ?',
+                               (chat_id,)).fetchone()
+        if row is None:
+            return None
+        model_name, history_json = row
+        try:
+            history = json.loads(history_json)
+        except json.JSONDecodeError as e:
+            logger.error(f"Поврежденная история сессии chat_id {chat_id}, сессия будет пересоздана: {e}")
+            self.delete(chat_id)
+            return None
+        return create_chat(model_name=model_name, history=history)
+
+    def save(self, chat_id: int, instance: ChatBackend):
+        history_json = json.dumps(instance.get_history(), ensure_ascii=False)
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO chat_sessions (chat_id, model_name, history, updated_at) VALUES (?, ?, ?, ?)',
+                (chat_id, instance.model_name, history_json, time())
+            )
+
+    def delete(self, chat_id: int):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM chat_sessions WHERE chat_id = ?', (chat_id,))
+
+    def cleanup(self) -> int:
+        with self._connect() as conn:
+            cursor = conn.execute('DELETE FROM chat_sessions WHERE updated_at < ?', (time() - self.timeout,))
+            return cursor.rowcount
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM chat_sessions').fetchone()[0]
+
+
+def create_session_store(config) -> SessionStore:
+    """Создает хранилище сессий согласно config.SESSION_STORE ('memory' или 'sqlite')."""
+    kind = (getattr(config, 'SESSION_STORE', 'memory') or 'memory').lower()
+    timeout = getattr(config, 'CHAT_INSTANCE_TIMEOUT', 3600)
+    if kind == 'memory':
+        return MemorySessionStore(timeout=timeout,
+                                  max_entries=getattr(config, 'SESSION_CACHE_MAX_ENTRIES', 10000),
+                                  max_bytes=getattr(config, 'SESSION_CACHE_MAX_BYTES', 0),
+                                  hibernate_after=getattr(config, 'SESSION_HIBERNATE_AFTER', 0),
+                                  hibernated_max_entries=getattr(config, 'SESSION_HIBERNATED_MAX_ENTRIES', 100000),
+                                  hibernated_max_bytes=getattr(config, 'SESSION_HIBERNATED_MAX_BYTES', 0))
+    if kind == 'sqlite':
+        db_url = getattr(config, 'SESSION_STORE_PATH', None) or config.DATABASE_URL
+        return SQLiteSessionStore(db_url, timeout=timeout)
+    raise ValueError(f"Неизвестный тип хранилища сессий: {kind}")
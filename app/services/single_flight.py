@@ -0,0 +1,223 @@
+# app/services/single_flight.py
+"""
+Объединение одновременных одинаковых запросов к модели (single-flight).
+
+Первое сообщение новой сессии не зависит от ее истории, поэтому одинаковые такие запросы
+(ключ response_cache.request_key: модель, хеш системного промпта, текст) можно обслужить одной
+генерацией. Первый запрос открывает "полет": ответ генерирует отдельная сессия модели в фоновом
+потоке (WSGI) или задаче event loop (ASGI), чанки складываются в общий буфер. Каждый подписчик,
+включая инициатора, читает буфер со своей позиции и после успешного ответа добавляет реплику в
+историю своей сессии; сохранение в БД у каждого свое. Если все подписчики отключились, генерация
+прерывается.
+"""
+import asyncio
+import logging
+from threading import Condition, Lock, Thread
+from ..config import Config
+from ..external.llm_backend import ChunkKind, StreamChunk, create_chat
+from ..utils import metrics
+
+logger = logging.getLogger(__name__)
+
+_flights = {} # key -> _Flight (только незавершенные)
+_flights_lock = Lock()
+_stats = {'flights': 0, 'joined': 0, 'abandoned': 0}
+
+
+class _Flight:
+    """Общий буфер ответа одной генерации и его подписчики (потоки WSGI и задачи ASGI)."""
+
+    def __init__(self, key):
+        self.key = key
+        self.chunks = []
+        self.done = False
+        self.abandoned = False
+        self.subscribers = 1 # Инициатор
+        self.driver = None # Фоновая задача asyncio (держим ссылку, чтобы ее не собрал GC)
+        self._cond = Condition()
+        self._async_waiters = set() # (loop, asyncio.Event) асинхронных подписчиков
+
+    @property
+    def succeeded(self) -> bool:
+        return self.done and all(chunk.kind is ChunkKind.TEXT for chunk in self.chunks)
+
+    def text(self) -> str:
+        return ''.join(chunk.text for chunk in self.chunks)
+
+    def publish(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+        self._wake_async()
+
+    def finish(self):
+        with self._cond:
+            self.done = True
+            self._cond.notify_all()
+        self._wake_async()
+
+    def _wake_async(self):
+        for loop, event in list(self._async_waiters):
+            loop.call_soon_threadsafe(event.set)
+
+    def read(self):
+        """Синхронное чтение буфера с начала: выдает чанки по мере поступления до конца генерации."""
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self.chunks) and not self.done:
+                    self._cond.wait()
+                pending, done = self.chunks[index:], self.done
+            index += len(pending)
+            yield from pending
+            if done and index >= len(self.chunks):
+                return
+
+    async def read_async(self):
+        """Асинхронный вариант read(): ожидание не занимает поток."""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        self._async_waiters.add(waiter)
+        try:
+            index = 0
+            while True:
+                waiter[1].clear() # До чтения буфера: publish после этой строки снова выставит событие
+                with self._cond:
+                    pending, done = self.chunks[index:], self.done
+                index += len(pending)
+                for chunk in pending:
+                    yield chunk
+                if done and index >= len(self.chunks):
+                    return
+                if not pending:
+                    await waiter[1].wait()
+        finally:
+            self._async_waiters.discard(waiter)
+
+
+def enabled() -> bool:
+    return getattr(Config, 'SINGLE_FLIGHT_ENABLED', False)
+
+
+def _join(key):
+    """Присоединяет подписчика к полету по ключу. Возвращает (полет, True для инициатора)."""
+    with _flights_lock:
+        flight = _flights.get(key)
+        if flight is not None:
+            flight.subscribers += 1
+            _stats['joined'] += 1
+            return flight, False
+        flight = _flights[key] = _Flight(key)
+        _stats['flights'] += 1
+        return flight, True
+
+
+def _leave(flight):
+    """Отключает подписчика; последний отключившийся до конца генерации прерывает ее."""
+    with _flights_lock:
+        flight.subscribers -= 1
+        if flight.subscribers > 0 or flight.done:
+            return
+        flight.abandoned = True
+        _stats['abandoned'] += 1
+        if _flights.get(flight.key) is flight:
+            del _flights[flight.key] # Новые запросы откроют новый полет
+    logger.info(f"Все подписчики общего запроса к {flight.key[0]} отключились, генерация прерывается")
+
+
+def _complete(flight, chunk=None):
+    """Завершает полет (chunk - итоговая ошибка). Из реестра он удаляется до пометки done."""
+    with _flights_lock:
+        if _flights.get(flight.key) is flight:
+            del _flights[flight.key]
+    if chunk is not None:
+        flight.publish(chunk)
+    flight.finish()
+
+
+def _drive(flight, message):
+    """Генерация ответа в фоновом потоке (WSGI)."""
+    stream = None
+    failure = None
+    try:
+        stream = create_chat(flight.key[0]).get_streaming_response(message)
+        for chunk in stream:
+            flight.publish(chunk)
+            if chunk.kind is not ChunkKind.TEXT or flight.abandoned:
+                break
+    except Exception as e:
+        logger.error(f"Ошибка общей генерации ответа модели {flight.key[0]}: {e}", exc_info=True)
+        failure = StreamChunk(ChunkKind.ERROR, f'Критическая ошибка сервера: {e}')
+    finally:
+        if stream is not None:
+            stream.close()
+        _complete(flight, failure)
+
+
+async def _drive_async(flight, message):
+    """Генерация ответа в задаче event loop (ASGI)."""
+    stream = None
+    failure = None
+    try:
+        # Создание сессии Gemini может обращаться к API (кэш контекста) - в пуле потоков
+        chat = await asyncio.get_running_loop().run_in_executor(None, create_chat, flight.key[0])
+        stream = chat.get_streaming_response_async(message)
+        async for chunk in stream:
+            flight.publish(chunk)
+            if chunk.kind is not ChunkKind.TEXT or flight.abandoned:
+                break
+    except Exception as e:
+        logger.error(f"Ошибка общей генерации ответа модели {flight.key[0]}: {e}", exc_info=True)
+        failure = StreamChunk(ChunkKind.ERROR, f'Критическая ошибка сервера: {e}')
+    finally:
+        if stream is not None:
+            await stream.aclose()
+        _complete(flight, failure)
+
+
+def subscribe(key, chat_instance, message: str):
+    """
+    Поток StreamChunk ответа на сообщение через общую генерацию по ключу key.
+    После успешного ответа реплика добавляется в историю chat_instance (как при обычном запросе).
+    """
+    flight, leader = _join(key)
+    if leader:
+        Thread(target=_drive, args=(flight, message), name='llm-single-flight', daemon=True).start()
+    else:
+        logger.info(f"Запрос к {key[0]} присоединен к уже идущей генерации (подписчиков: {flight.subscribers})")
+    try:
+        yield from flight.read()
+    finally:
+        _leave(flight)
+    if flight.succeeded:
+        chat_instance.append_turn(message, flight.text())
+
+
+async def subscribe_async(key, chat_instance, message: str):
+    """Асинхронный вариант subscribe()."""
+    flight, leader = _join(key)
+    if leader:
+        flight.driver = asyncio.ensure_future(_drive_async(flight, message))
+    else:
+        logger.info(f"Запрос к {key[0]} присоединен к уже идущей генерации (подписчиков: {flight.subscribers})")
+    try:
+        async for chunk in flight.read_async():
+            yield chunk
+    finally:
+        _leave(flight)
+    if flight.succeeded:
+        chat_instance.append_turn(message, flight.text())
+
+
+def get_single_flight_stats() -> dict:
+    with _flights_lock:
+        return dict(_stats, in_flight=len(_flights))
+
+
+metrics.CallbackMetric('llm_single_flight_in_flight', 'Идущие общие генерации ответа',
+                       lambda: get_single_flight_stats()['in_flight'])
+metrics.CallbackMetric('llm_single_flight_started_total', 'Общие генерации, открытые первым запросом',
+                       lambda: _stats['flights'], kind='counter')
+metrics.CallbackMetric('llm_single_flight_joined_total', 'Запросы, присоединенные к уже идущей генерации',
+                       lambda: _stats['joined'], kind='counter')
+metrics.CallbackMetric('llm_single_flight_abandoned_total', 'Генерации, прерванные после отключения всех подписчиков',
+                       lambda: _stats['abandoned'], kind='counter')
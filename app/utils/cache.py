@@ -0,0 +1,156 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class TTLCache:
+    """
+    Потокобезопасный LRU-кэш с ограничением числа записей и скользящим TTL.
+
+    Записи хранятся в OrderedDict в порядке последнего обращения. Так как TTL
+    отсчитывается от последнего обращения и одинаков для всех записей, этот же
+    порядок совпадает с порядком истечения: обращение - O(1) (move_to_end),
+    а устаревшие записи всегда лежат в начале и удаляются без обхода всего кэша.
+
+    sliding=False - TTL отсчитывается от записи и не продлевается при чтении (для данных,
+    которые нужно периодически перепроверять). Порядок тогда - порядок записи, а при
+    переполнении вытесняются самые давно записанные.
+
+    max_bytes - дополнительное ограничение суммарного размера записей; размер записи
+    вычисляет sizeof(value) при каждом set() (обновление записи пересчитывает ее размер).
+    Только что записанное значение не вытесняется, даже если оно одно больше max_bytes.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, on_evict=None, sliding: bool = True,
+                 max_bytes: int = None, sizeof=None):
+        if max_entries <= 0:
+            raise ValueError("max_entries должен быть положительным")
+        if max_bytes and sizeof is None:
+            raise ValueError("Для max_bytes нужна функция sizeof")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sliding = sliding
+        self.max_bytes = max_bytes or None
+        self.sizeof = sizeof
+        # on_evict(key, value, reason) вызывается вне блокировки; reason: 'capacity' | 'expired'
+        self.on_evict = on_evict
+        self._data = OrderedDict() # key -> (value, expires_at, size)
+        self._lock = Lock()
+        self.bytes = 0 # Суммарный размер записей (0, если sizeof не задан)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """Возвращает значение и продлевает его TTL; устаревшая запись считается промахом."""
+        expired = None
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            now = monotonic()
+            if entry[1] <= now:
+                del self._data[key]
+                self.bytes -= entry[2]
+                self.misses += 1
+                self.expirations += 1
+                expired = entry[0]
+            else:
+                if self.sliding:
+                    self._data[key] = (entry[0], now + self.ttl, entry[2])
+                    self._data.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        self._notify(key, expired, 'expired')
+        return default
+
+    def set(self, key, value):
+        """Добавляет или обновляет запись, вытесняя самые старые при превышении max_entries или max_bytes."""
+        expired, evicted = [], []
+        size = self.sizeof(value) if self.sizeof is not None else 0 # Вне блокировки
+        with self._lock:
+            now = monotonic()
+            previous = self._data.get(key)
+            if previous is not None:
+                self.bytes -= previous[2]
+            self._data[key] = (value, now + self.ttl, size)
+            self._data.move_to_end(key)
+            self.bytes += size
+            if self._over_limit():
+                # Сначала освобождаем место за счет устаревших записей, затем вытесняем LRU
+                expired = self._pop_expired(now)
+            while self._over_limit() and len(self._data) > 1:
+                evicted_key, (evicted_value, _, evicted_size) = self._data.popitem(last=False)
+                self.bytes -= evicted_size
+                evicted.append((evicted_key, evicted_value))
+                self.evictions += 1
+        for expired_key, expired_value in expired:
+            self._notify(expired_key, expired_value, 'expired')
+        for evicted_key, evicted_value in evicted:
+            self._notify(evicted_key, evicted_value, 'capacity')
+
+    def _over_limit(self) -> bool:
+        return len(self._data) > self.max_entries or (self.max_bytes is not None and self.bytes > self.max_bytes)
+
+    def pop(self, key, default=None):
+        """Удаляет запись без вызова on_evict и возвращает ее значение."""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[2]
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        """Удаляет все записи без вызова on_evict."""
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def expire(self) -> int:
+        """Удаляет все устаревшие записи. Возвращает их количество."""
+        with self._lock:
+            expired = self._pop_expired(monotonic())
+        for key, value in expired:
+            self._notify(key, value, 'expired')
+        return len(expired)
+
+    def _pop_expired(self, now):
+        """Снимает устаревшие записи с начала очереди. Вызывается под блокировкой."""
+        expired = []
+        while self._data:
+            key, (value, expires_at, size) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            del self._data[key]
+            self.bytes -= size
+            expired.append((key, value))
+        self.expirations += len(expired)
+        return expired
+
+    def _notify(self, key, value, reason):
+        if self.on_evict is not None:
+            self.on_evict(key, value, reason)
+
+    def stats(self) -> dict:
+        """Счетчики кэша для логов и метрик."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'max_entries': self.max_entries,
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,72 @@
+# app/utils/markdown_render.py
+"""
+Рендеринг Markdown ответов модели в безопасный HTML.
+
+HTML ответа бота строится один раз - при сохранении сообщения (messages.content_html) - и отдается
+клиенту вместе с историей, чтобы он не разбирал Markdown всей истории при каждой загрузке.
+При изменении правил рендеринга нужно увеличить RENDERER_VERSION: сообщения со старой версией
+пересобираются командой `flask backfill-html`, а до этого клиент рендерит их сам.
+"""
+import html
+import logging
+import re
+import threading
+import bleach
+import markdown
+
+logger = logging.getLogger(__name__)
+
+RENDERER_VERSION = 2 # 2: экранирование HTML внутри блоков кода
+
+_CODE_BLOCK_RE = re.compile(r'```(\w+)?\s*\n(.*?)\n```', re.DOTALL)
+
+MARKDOWN_EXTENSIONS = ['fenced_code', 'tables', 'nl2br'] # nl2br для переносов строк
+ALLOWED_TAGS = frozenset([
+    'p', 'br', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'strong', 'em', 'b', 'i',
+    'ul', 'ol', 'li',
+    'code', 'pre',
+    'blockquote', 'a',
+    'table', 'thead', 'tbody', 'tr', 'th', 'td'
+])
+ALLOWED_ATTRIBUTES = {
+    'a': ['href', 'title'],
+    'pre': [],
+    'code': ['class'], # Для 'language-...' (подсветка на клиенте)
+}
+
+# markdown.Markdown и bleach.Cleaner хранят состояние разбора и не потокобезопасны -
+# по одному набору на поток, переиспользуется между вызовами
+_local = threading.local()
+
+
+def _renderers():
+    renderers = getattr(_local, 'renderers', None)
+    if renderers is None:
+        renderers = _local.renderers = (
+            markdown.Markdown(extensions=MARKDOWN_EXTENSIONS),
+            bleach.Cleaner(tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES, strip=True),
+            bleach.Cleaner(tags=[], strip=True), # Для резервного вывода при ошибке рендеринга
+        )
+    return renderers
+
+
+def _replace_code_block(match):
+    # Содержимое экранируется: иначе bleach (strip=True) удалит из кода все, что похоже на теги
+    # (#include <iostream>, std::vector<int>)
+    lang = match.group(1) or ''
+    return f'<pre><code class="language-{lang}">{html.escape(match.group(2), quote=False)}</code></pre>'
+
+
+def render_markdown(text: str) -> str:
+    """Форматирует текст в безопасный HTML с поддержкой Markdown."""
+    md, cleaner, plain_cleaner = _renderers()
+    try:
+        # Блоки кода - заранее, как раньше на клиенте; `код` в строке разбирает сам markdown
+        # (он экранирует содержимое и не трогает код внутри блоков)
+        text = _CODE_BLOCK_RE.sub(_replace_code_block, text)
+        return cleaner.clean(md.reset().convert(text))
+    except Exception as e:
+        logger.error(f"Ошибка форматирования Markdown: {str(e)}")
+        # В случае ошибки вернуть текст, обернутый в <pre> для сохранения форматирования
+        return f"<pre>{plain_cleaner.clean(text)}</pre>"
@@ -0,0 +1,257 @@
+# app/utils/metrics.py
+"""
+Метрики приложения в текстовом формате Prometheus (GET /metrics).
+
+Счетчики рассчитаны на постоянную работу в production: дочерний счетчик для набора меток
+создается один раз, дальше поиск по dict идет без блокировки, а изменение значения держит
+собственную блокировку дочернего счетчика на время одного сложения. Значения, которые уже
+считаются в других модулях (хранилище сессий, очередь записи и т. п.), не дублируются -
+они читаются функциями обратного вызова в момент запроса /metrics.
+"""
+import logging
+import math
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+from flask import g, request
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм по умолчанию (секунды)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []
+_registry_lock = Lock()
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    """Базовый класс метрики с метками. Дочерние значения - по одному на набор значений меток."""
+
+    kind = None
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def labels(self, *values):
+        """Возвращает дочернее значение для набора меток (создается при первом обращении)."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"Метрика {self.name} ожидает метки {self.labelnames}, получено {values}")
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        """Строки значений метрики (без HELP/TYPE)."""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class _Value:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик."""
+
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        return [f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}'
+                for values, child in list(self._children.items())]
+
+
+class Gauge(Counter):
+    """Значение, которое может как расти, так и уменьшаться."""
+
+    kind = 'gauge'
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum', '_lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Последняя корзина - +Inf
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+class Histogram(_Metric):
+    """Гистограмма: число наблюдений по корзинам (le), их сумма и количество."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self):
+        lines = []
+        for values, child in list(self._children.items()):
+            counts, total = child.snapshot()
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, values, [('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class CallbackMetric(_Metric):
+    """
+    Метрика, значение которой вычисляется при запросе /metrics: func() возвращает число
+    (None - значения нет) или dict {кортеж значений меток: число}.
+    """
+
+    def __init__(self, name: str, help_text: str, func, kind: str = 'gauge', labelnames=()):
+        self.kind = kind
+        self.func = func
+        super().__init__(name, help_text, labelnames)
+
+    def _samples(self):
+        try:
+            result = self.func()
+        except Exception as e:
+            logger.error(f"Ошибка вычисления метрики {self.name}: {e}")
+            return []
+        if result is None:
+            return []
+        if not isinstance(result, dict):
+            result = {(): result}
+        return [f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(value)}'
+                for values, value in result.items() if value is not None]
+
+
+def render() -> str:
+    """Все зарегистрированные метрики в текстовом формате Prometheus 0.0.4."""
+    with _registry_lock:
+        metrics = list(_registry)
+    return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+# --- Метрики приложения ---
+
+HTTP_REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds',
+    'Время обработки HTTP-запроса до отправки заголовков ответа (для SSE - до начала потока)',
+    ('method', 'route', 'status'))
+LLM_STREAMS_ACTIVE = Gauge('llm_streams_active', 'Открытые потоки ответа модели')
+LLM_TIME_TO_FIRST_TOKEN = Histogram(
+    'llm_time_to_first_token_seconds', 'Время от запроса к модели до первого фрагмента ответа',
+    ('backend', 'model'))
+LLM_TOKENS_PER_SECOND = Histogram(
+    'llm_output_tokens_per_second', 'Скорость генерации после первого фрагмента (оценка числа токенов)',
+    ('backend', 'model'), buckets=(5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500, 1000))
+LLM_REQUESTS = Counter(
+    'llm_requests_total', 'Запросы к модели по исходу: ok, error, blocked, cancelled (клиент отключился), cached (ответ из кэша)',
+    ('backend', 'model', 'outcome'))
+LLM_CONTEXT_TOKENS = Histogram(
+    'llm_context_tokens', 'Размер контекста сессии после реплики: системный промпт + история (оценка токенов)',
+    ('model',), buckets=(500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000, 256000))
+LLM_CONTEXT_TRIMS = Counter('llm_context_trims_total', 'Сокращения истории под бюджет токенов', ('model',))
+LLM_CONTEXT_DROPPED_TURNS = Counter('llm_context_dropped_turns_total', 'Реплики, отброшенные из истории', ('model',))
+DB_QUERY_DURATION = Histogram(
+    'db_query_duration_seconds', 'Время выполнения запроса SQLite (execute, без чтения строк)',
+    ('operation',), buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0))
+
+
+def observe_request(method: str, route: str, status, seconds: float):
+    HTTP_REQUEST_DURATION.labels(method, route, str(status)).observe(seconds)
+
+
+def init_app(app):
+    """Включает замер времени обработки запросов Flask по маршрутам (шаблон маршрута, а не путь)."""
+
+    @app.before_request
+    def _start_request_timer():
+        g._metrics_start = perf_counter()
+
+    @app.after_request
+    def _observe_request(response):
+        start = g.pop('_metrics_start', None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            observe_request(request.method, route, response.status_code, perf_counter() - start)
+        return response
+
+    logger.info("Метрики запросов включены (GET /metrics)")
@@ -0,0 +1,104 @@
+import hashlib
+import logging
+import os
+from collections import namedtuple
+from threading import Lock
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+# Итоговый системный промпт модели и хеш его содержимого (для ключей кэшей)
+Prompt = namedtuple('Prompt', ['text', 'hash'])
+
+
+class PromptRegistry:
+    """
+    Реестр системных промптов: общий default.txt + файл конкретной модели.
+
+    Итоговые промпты собираются один раз для всех моделей и отдаются из памяти.
+    Изменение файлов подхватывается без перезапуска: не чаще раза в check_interval
+    секунд сравниваются mtime файлов (os.stat, без чтения), и только при изменении
+    промпты пересобираются.
+    """
+
+    DEFAULT_FILE = 'default.txt'
+
+    def __init__(self, prompts_dir: str, model_files: dict, check_interval: float = 2.0):
+        self.prompts_dir = prompts_dir
+        self.model_files = dict(model_files) # model_name -> имя файла промпта модели
+        self.check_interval = check_interval
+        self._lock = Lock()
+        self._mtimes = {}
+        self._prompts = {}
+        self._fallback = None
+        self._next_check = 0.0
+        self.reloads = 0
+        self._reload()
+
+    def get(self, model_name: str) -> Prompt:
+        """Возвращает собранный промпт модели (для неизвестной модели - только общий промпт)."""
+        now = monotonic()
+        if now >= self._next_check:
+            with self._lock:
+                if now >= self._next_check:
+                    self._next_check = now + self.check_interval
+                    if self._current_mtimes() != self._mtimes:
+                        logger.info(f"Файлы промптов в {self.prompts_dir} изменились, промпты пересобираются")
+                        self._reload()
+        return self._prompts.get(model_name) or self._fallback
+
+    def _paths(self):
+        files = [self.DEFAULT_FILE] + sorted(set(self.model_files.values()))
+        return [os.path.join(self.prompts_dir, name) for name in files]
+
+    def _current_mtimes(self) -> dict:
+        mtimes = {}
+        for path in self._paths():
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def _read(self, name: str) -> str:
+        path = os.path.join(self.prompts_dir, name)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            logger.warning(f"Файл промпта {name} не найден в {self.prompts_dir}")
+        except OSError as e:
+            logger.error(f"Ошибка чтения файла промпта {path}: {e}")
+        return ""
+
+    @staticmethod
+    def _compose(default_prompt: str, model_prompt: str) -> str:
+        # Комбинируем промпты: специфичный для модели важнее, если он есть
+        if default_prompt and model_prompt:
+            return f"{default_prompt}\n\n{model_prompt}"
+        if model_prompt or default_prompt:
+            return model_prompt or default_prompt
+        return "You are a helpful AI assistant. [Error: No prompt files loaded]"
+
+    @staticmethod
+    def _make_prompt(text: str) -> Prompt:
+        return Prompt(text, hashlib.sha256(text.encode('utf-8')).hexdigest())
+
+    def _reload(self):
+        """Перечитывает файлы и пересобирает промпты всех моделей. Вызывается под блокировкой."""
+        mtimes = self._current_mtimes()
+        if not os.path.isdir(self.prompts_dir):
+            logger.error(f"Директория промптов не найдена: {self.prompts_dir}")
+            fallback = self._make_prompt("You are a helpful AI assistant. [Error: Prompts directory not found]")
+            self._prompts, self._fallback, self._mtimes = {}, fallback, mtimes
+            return
+        default_prompt = self._read(self.DEFAULT_FILE)
+        prompts = {}
+        for model_name, file_name in self.model_files.items():
+            prompts[model_name] = self._make_prompt(self._compose(default_prompt, self._read(file_name)))
+        # Присваивания атомарны: читатели без блокировки видят либо старый, либо новый набор
+        self._prompts = prompts
+        self._fallback = self._make_prompt(self._compose(default_prompt, ""))
+        self._mtimes = mtimes
+        self.reloads += 1
+        logger.debug(f"Промпты собраны для моделей: {', '.join(prompts)}")
@@ -0,0 +1,225 @@
+import asyncio
+import json
+import logging
+from contextlib import nullcontext
+from queue import Queue, Empty
+from threading import Event, Lock, Thread
+from time import monotonic
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Суммарные счетчики объединения событий по всем потокам процесса (для логов и метрик)
+_totals = {'streams': 0, 'events': 0, 'frames': 0}
+_totals_lock = Lock()
+
+
+def format_sse(payload: dict) -> str:
+    """Кодирует событие для клиента в формат Server-Sent Events: data: {json}\\n\\n."""
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+def error_payload(message: str) -> dict:
+    """Событие с ошибкой в формате, который ожидает фронтенд."""
+    return {'content': None, 'thoughts': None, 'error': message}
+
+
+def sse_stream(payloads):
+    """Оборачивает генератор событий (dict) в генератор SSE-строк."""
+    for payload in payloads:
+        yield format_sse(payload)
+
+
+class EventCoalescer:
+    """
+    Объединяет мелкие события потока ({content, thoughts, error}) в более крупные кадры SSE.
+
+    Первое событие и первый видимый текст (content) отдаются сразу: время до первого токена
+    не растет, даже если ответ начинается с размышлений. Дальше content и thoughts накапливаются
+    и отдаются одним кадром, когда с последней отправки прошло window_ms миллисекунд или
+    накоплено max_bytes байт (UTF-8). Фронтенд склеивает content и thoughts из последовательных
+    кадров, поэтому объединение не меняет итоговый текст. Событие с ошибкой отдается сразу,
+    после накопленного текста.
+
+    Читающий код ждет следующее событие не дольше deadline(): если модель замолчала,
+    накопленный текст отдается по истечении окна (poll()).
+    """
+
+    def __init__(self, window_ms: float, max_bytes: int, clock=monotonic):
+        self.window = window_ms / 1000.0
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self._content = []
+        self._thoughts = []
+        self._size = 0
+        self._last_flush = clock()
+        self._content_sent = False
+        self.events_in = 0
+        self.frames_out = 0
+
+    def push(self, payload: dict) -> list:
+        """Принимает событие и возвращает список кадров, которые нужно отправить сейчас."""
+        self.events_in += 1
+        if payload.get('error'):
+            frames = self._drain()
+            frames.append(payload)
+            self.frames_out += 1
+            return frames
+        content, thoughts = payload.get('content'), payload.get('thoughts')
+        if content:
+            self._content.append(content)
+            self._size += len(content.encode('utf-8'))
+        if thoughts:
+            self._thoughts.append(thoughts)
+            self._size += len(thoughts.encode('utf-8'))
+        if content and not self._content_sent:
+            # Первый видимый текст - без задержки (вместе с накопленными до него размышлениями)
+            self._content_sent = True
+            return self._drain()
+        if self.frames_out == 0 or self._size >= self.max_bytes or self.clock() - self._last_flush >= self.window:
+            return self._drain()
+        return []
+
+    def deadline(self):
+        """Секунды до отправки накопленного текста по окну или None, если накопленного нет."""
+        if not self._size:
+            return None
+        return max(0.0, self._last_flush + self.window - self.clock())
+
+    def poll(self) -> list:
+        """Отдает накопленное, если окно истекло (вызывается по таймеру без нового события)."""
+        if self._size and self.clock() - self._last_flush >= self.window:
+            return self._drain()
+        return []
+
+    def flush(self) -> list:
+        """Отдает все накопленное (вызывается в конце потока)."""
+        return self._drain()
+
+    def _drain(self) -> list:
+        if not self._size:
+            return []
+        frame = {'content': "".join(self._content) or None,
+                 'thoughts': "".join(self._thoughts) or None,
+                 'error': None}
+        self._content, self._thoughts, self._size = [], [], 0
+        self._last_flush = self.clock()
+        self.frames_out += 1
+        return [frame]
+
+    def _record(self):
+        """Добавляет счетчики потока к суммарным и пишет их в лог."""
+        with _totals_lock:
+            _totals['streams'] += 1
+            _totals['events'] += self.events_in
+            _totals['frames'] += self.frames_out
+        logger.debug(f"SSE-поток завершен: событий {self.events_in}, кадров {self.frames_out}")
+
+
+_PUMP_END = object() # Маркер конца источника в очереди _pump
+
+
+def _pump(payloads, queue: Queue, stop: Event, context):
+    """Читает источник событий в отдельном потоке и передает их в очередь (с исключением в конце)."""
+    try:
+        with context() if context is not None else nullcontext():
+            try:
+                for payload in payloads:
+                    queue.put(payload)
+                    if stop.is_set():
+                        break # Клиент отключился - прерываем генерацию
+            finally:
+                payloads.close() # В этом же потоке: генератор нельзя закрыть из другого, пока он выполняется
+        queue.put(_PUMP_END)
+    except BaseException as e:
+        queue.put(e)
+
+
+def coalesce_events(payloads, window_ms: float, max_bytes: int, context=None):
+    """
+    Генератор кадров поверх генератора событий. window_ms <= 0 отключает объединение.
+
+    Источник читается в отдельном потоке: пока модель молчит, накопленный текст отправляется
+    по истечении окна, а не при следующем событии. context - фабрика контекста (например,
+    app.app_context), в котором поток читает источник: контекст запроса в него не переходит.
+    """
+    if window_ms <= 0:
+        yield from payloads
+        return
+    coalescer = EventCoalescer(window_ms, max_bytes)
+    queue, stop = Queue(), Event()
+    Thread(target=_pump, args=(payloads, queue, stop, context), name='sse-coalesce', daemon=True).start()
+    try:
+        while True:
+            try:
+                item = queue.get(timeout=coalescer.deadline())
+            except Empty:
+                yield from coalescer.poll()
+                continue
+            if item is _PUMP_END:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield from coalescer.push(item)
+        yield from coalescer.flush()
+    finally:
+        stop.set()
+        coalescer._record()
+
+
+async def coalesce_events_async(payloads, window_ms: float, max_bytes: int):
+    """
+    Асинхронный вариант coalesce_events для ASGI-пути. Ожидание следующего события ограничено
+    окном: накопленный текст отправляется вовремя, даже если модель надолго замолчала.
+    """
+    if window_ms <= 0:
+        async for payload in payloads:
+            yield payload
+        return
+    coalescer = EventCoalescer(window_ms, max_bytes)
+    upstream = payloads.__aiter__()
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                # Ожидание события - отдельной задачей: таймаут окна не должен ее отменять
+                pending = asyncio.ensure_future(upstream.__anext__())
+            await asyncio.wait({pending}, timeout=coalescer.deadline())
+            if not pending.done():
+                for frame in coalescer.poll():
+                    yield frame
+                continue
+            done, pending = pending, None
+            try:
+                payload = done.result()
+            except StopAsyncIteration:
+                break
+            for frame in coalescer.push(payload):
+                yield frame
+        for frame in coalescer.flush():
+            yield frame
+    finally:
+        if pending is not None:
+            # Поток закрыт во время ожидания события: отменяем ожидание и дожидаемся отмены,
+            # иначе исходный генератор останется занятым и его нельзя будет закрыть
+            pending.cancel()
+            await asyncio.wait({pending})
+            if not pending.cancelled():
+                pending.exception()
+        coalescer._record()
+
+
+def get_coalescing_stats() -> dict:
+    """Суммарные счетчики объединения: число потоков, событий от модели и отправленных кадров."""
+    with _totals_lock:
+        stats = dict(_totals)
+    stats['events_per_frame'] = round(stats['events'] / stats['frames'], 2) if stats['frames'] else None
+    return stats
+
+
+metrics.CallbackMetric('sse_streams_total', 'Завершенные потоки SSE с объединением событий',
+                       lambda: _totals['streams'], kind='counter')
+metrics.CallbackMetric('sse_events_total', 'События от модели, поступившие в потоки SSE',
+                       lambda: _totals['events'], kind='counter')
+metrics.CallbackMetric('sse_frames_total', 'Кадры SSE, отправленные клиентам после объединения',
+                       lambda: _totals['frames'], kind='counter')
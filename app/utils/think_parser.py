@@ -0,0 +1,143 @@
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+
+# Типы сегментов, которые выдает парсер
+VISIBLE = 'visible'
+THOUGHT = 'thought'
+
+
+class ThinkTagParser:
+    """
+    Инкрементальный парсер тегов <think>...</think> в потоке текстовых чанков.
+
+    feed() принимает очередной чанк и возвращает список сегментов (kind, text), где
+    kind - VISIBLE или THOUGHT. Тег, разрезанный границей чанков ("<thi" + "nk>"),
+    распознается корректно: хвост чанка, который может оказаться началом тега,
+    придерживается в небольшом буфере (не длиннее самого тега) до следующего чанка.
+
+    Сегмент THOUGHT с флагом конца блока выдается при закрытии тега, поэтому
+    вызывающий код может накапливать текущий блок размышлений и отправлять его целиком.
+
+    Это исправление корректности, а не ускорение: прежний разбор в gemini_service не видел
+    тегов на границе чанков и выводил размышления как видимый текст. На чанк парсер тратит
+    больше прежнего алгоритма (см. benchmarks/think_parser_bench.py), но эта цена -
+    сотни наносекунд на чанк, что несопоставимо с сетевой задержкой самого потока.
+    """
+
+    __slots__ = ('inside_think', '_carry', '_thought_parts', 'visible_parts', 'thought_blocks')
+
+    def __init__(self):
+        self.inside_think = False
+        self._carry = "" # Хвост предыдущего чанка, который может быть началом тега
+        self._thought_parts = [] # Части текущего (незакрытого) блока размышлений
+        self.visible_parts = [] # Весь видимый текст (для сохранения в БД)
+        self.thought_blocks = [] # Завершенные блоки размышлений
+
+    def feed(self, chunk: str):
+        """
+        Обрабатывает очередной чанк. Возвращает список событий:
+        (VISIBLE, text) - видимый текст; (THOUGHT, block) - завершенный блок размышлений.
+        """
+        carry = self._carry
+        if not carry:
+            # Быстрый путь для большинства чанков: в чанке нет ни тега, ни начала тега в конце.
+            # Оба тега содержат '<' только в начале, поэтому начало тега может быть только после
+            # последнего '<'
+            tag = THINK_CLOSE if self.inside_think else THINK_OPEN
+            lt = chunk.rfind('<')
+            if lt == -1 or (tag not in chunk and not tag.startswith(chunk[lt:])):
+                if not chunk:
+                    return []
+                if self.inside_think:
+                    self._thought_parts.append(chunk)
+                    return []
+                self.visible_parts.append(chunk)
+                return [(VISIBLE, chunk)]
+
+        events = []
+        pos = 0
+        if carry:
+            # Придержанное начало тега дополняем только началом чанка (не длиннее тега),
+            # а не склеиваем и не просматриваем заново весь чанк
+            self._carry = ""
+            tag = THINK_CLOSE if self.inside_think else THINK_OPEN
+            need = len(tag) - len(carry)
+            head = carry + chunk[:need]
+            if head == tag:
+                pos = need
+                self._toggle(events)
+            elif tag.startswith(head):
+                self._carry = head # Чанк целиком - продолжение начала тега
+                return events
+            else:
+                self._emit(carry, events)
+
+        length = len(chunk)
+        while pos < length:
+            tag = THINK_CLOSE if self.inside_think else THINK_OPEN
+            tag_pos = chunk.find(tag, pos)
+            if tag_pos == -1:
+                # Тег не найден: все, кроме возможного начала тега в конце чанка, можно отдать.
+                # Оба тега содержат '<' только в начале, поэтому достаточно проверить последний '<'
+                end = length
+                lt = chunk.rfind('<', max(pos, length - len(tag) + 1))
+                if lt != -1 and tag.startswith(chunk[lt:]):
+                    end = lt
+                    self._carry = chunk[lt:]
+                if end > pos:
+                    self._emit(chunk[pos:end] if pos or end < length else chunk, events)
+                break
+            if tag_pos > pos:
+                self._emit(chunk[pos:tag_pos], events)
+            pos = tag_pos + len(tag)
+            self._toggle(events)
+        return events
+
+    def _toggle(self, events):
+        if self.inside_think:
+            self._close_block(events)
+        self.inside_think = not self.inside_think
+
+    def _emit(self, part: str, events):
+        if self.inside_think:
+            self._thought_parts.append(part)
+        else:
+            self.visible_parts.append(part)
+            events.append((VISIBLE, part))
+
+    def _close_block(self, events):
+        block = "".join(self._thought_parts)
+        self._thought_parts = []
+        if block.strip():
+            self.thought_blocks.append(block.strip())
+        events.append((THOUGHT, block))
+
+    def close(self):
+        """
+        Завершает поток: отдает придержанный хвост и незакрытый блок размышлений.
+        Возвращает список событий в том же формате, что и feed().
+        """
+        events = []
+        if self._carry:
+            carry, self._carry = self._carry, ""
+            self._emit(carry, events)
+        if self.inside_think and self._thought_parts:
+            block = "".join(self._thought_parts).strip()
+            self._thought_parts = []
+            if block:
+                self.thought_blocks.append(block)
+        return events
+
+    @property
+    def unclosed(self) -> bool:
+        """True, если поток оборвался внутри тега <think>."""
+        return self.inside_think
+
+    @property
+    def visible_text(self) -> str:
+        return "".join(self.visible_parts)
+
+    @property
+    def thoughts_text(self):
+        """Все размышления, разделенные пустой строкой, или None, если их нет."""
+        return "\n\n".join(self.thought_blocks) or None
@@ -0,0 +1,5 @@
+from app.asgi import create_asgi_app
+
+# ASGI-точка входа: SSE-стриминг ответов без удержания потока на каждый открытый поток.
+# Запуск: uvicorn asgi:app --host 0.0.0.0 --port 8000 --workers 4
+app = create_asgi_app()
@@ -0,0 +1,201 @@
+# benchmarks/load_test.py
+"""
+Нагрузочный тест API чата: пропускная способность и задержки по маршрутам.
+
+По умолчанию поднимает create_app() на временной БД с фейковой моделью (LLM_BACKEND=fake,
+без обращений к API и без GOOGLE_API_KEY) во встроенном многопоточном сервере werkzeug.
+С --url нагружает уже запущенный сервер (например, uvicorn asgi:app с LLM_BACKEND=fake).
+
+Каждый виртуальный пользователь регистрируется, входит, создает чат и затем --iterations раз
+читает список чатов и историю сообщений и отправляет сообщение, дочитывая поток SSE до конца.
+Для каждого маршрута печатаются число запросов, ошибки, запросов/с, время до первого байта
+тела (TTFB; для SSE - до первого события) и до последнего байта (TTLB) - p50/p95/p99 в мс.
+--json сохраняет результат для сравнения между прогонами.
+
+Запуск: python benchmarks/load_test.py [--users 20] [--iterations 5] [--first-token-ms 300]
+        [--chunk-delay-ms 20] [--password-iterations 1000] [--url http://127.0.0.1:8000] [--json out.json]
+"""
+import argparse
+import http.client
+import json
+import os
+import sys
+import tempfile
+import threading
+from collections import defaultdict
+from time import perf_counter
+from urllib.parse import urlsplit
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(__file__), '..'))
+PERCENTILES = (50, 95, 99)
+
+
+class Recorder:
+    """Собирает задержки и статусы ответов по маршрутам (потокобезопасно)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list) # route -> [(ttfb, ttlb)]
+        self.errors = defaultdict(int)
+
+    def add(self, route, ttfb, ttlb, ok):
+        with self._lock:
+            self.samples[route].append((ttfb, ttlb))
+            if not ok:
+                self.errors[route] += 1
+
+
+class Client:
+    """HTTP-клиент одного виртуального пользователя (новое соединение на запрос, как у браузера без keep-alive)."""
+
+    def __init__(self, base_url, recorder):
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.recorder = recorder
+        self.token = None
+
+    def request(self, method, path, route, body=None):
+        headers = {'Content-Type': 'application/json'}
+        if self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        start = perf_counter()
+        try:
+            conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+            response = conn.getresponse()
+            first = response.read(1)
+            ttfb = perf_counter() - start
+            data = first + response.read()
+            ttlb = perf_counter() - start
+        except OSError:
+            elapsed = perf_counter() - start
+            self.recorder.add(route, elapsed, elapsed, False)
+            return None, b''
+        finally:
+            conn.close()
+        # Ошибка внутри потока SSE приходит со статусом 200 в поле error события
+        ok = response.status < 400 and b'"error": "' not in data and b'"error":"' not in data
+        self.recorder.add(route, ttfb, ttlb, ok)
+        return response.status, data
+
+
+def _virtual_user(index, base_url, recorder, iterations, run_id):
+    client = Client(base_url, recorder)
+    email = f'load-{run_id}-{index}@example.com'
+    credentials = {'name': f'load{index}', 'email': email, 'password': 'load-test-password'}
+    client.request('POST', '/api/register', 'POST /api/register', credentials)
+    status, data = client.request('POST', '/api/login', 'POST /api/login', credentials)
+    if status != 200:
+        return
+    client.token = json.loads(data)['token']
+    status, data = client.request('POST', '/api/chats', 'POST /api/chats', {'title': f'load {index}'})
+    if status != 201:
+        return
+    chat_id = json.loads(data)['id']
+    for i in range(iterations):
+        client.request('GET', '/api/chats', 'GET /api/chats')
+        client.request('GET', f'/api/chats/{chat_id}/messages', 'GET /api/chats/<id>/messages')
+        client.request('POST', f'/api/chats/{chat_id}/messages', 'POST /api/chats/<id>/messages (SSE)',
+                       {'content': f'Сообщение {i} от пользователя {index}'})
+
+
+def _percentile(sorted_values, p):
+    """Процентиль методом ближайшего ранга."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-p * len(sorted_values) // 100)) # ceil(p * n / 100)
+    return sorted_values[rank - 1]
+
+
+def _summarize(recorder, elapsed):
+    report = {}
+    for route, samples in recorder.samples.items():
+        ttfb = sorted(s[0] for s in samples)
+        ttlb = sorted(s[1] for s in samples)
+        report[route] = {
+            'requests': len(samples),
+            'errors': recorder.errors[route],
+            'rps': round(len(samples) / elapsed, 2),
+            'ttfb_ms': {f'p{p}': round(_percentile(ttfb, p) * 1000, 1) for p in PERCENTILES},
+            'ttlb_ms': {f'p{p}': round(_percentile(ttlb, p) * 1000, 1) for p in PERCENTILES},
+        }
+    return report
+
+
+def _start_local_server(args):
+    """Запускает create_app() с фейковой моделью на временной БД. Возвращает (base_url, server)."""
+    db_dir = tempfile.mkdtemp(prefix='beykus-load-')
+    # Config читает окружение при импорте - задаем его до импорта app
+    os.environ['LLM_BACKEND'] = 'fake'
+    os.environ['DATABASE_URL'] = os.path.join(db_dir, 'load.db')
+    os.environ['FAKE_LLM_FIRST_TOKEN_MS'] = str(args.first_token_ms)
+    os.environ['FAKE_LLM_CHUNK_DELAY_MS'] = str(args.chunk_delay_ms)
+    os.environ['FAKE_LLM_RESPONSE_REPEAT'] = str(args.response_repeat)
+    if args.password_iterations:
+        os.environ['PASSWORD_HASH_ITERATIONS'] = str(args.password_iterations)
+    sys.path.insert(0, ROOT)
+
+    import logging
+    from werkzeug.serving import make_server
+    from app import create_app
+
+    app = create_app()
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING) # Лог каждого запроса искажает замеры
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='load-test-server', daemon=True).start()
+    print(f"Локальный сервер: http://127.0.0.1:{server.server_port}, БД {os.environ['DATABASE_URL']}")
+    return f'http://127.0.0.1:{server.server_port}', server
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--users', type=int, default=20, help='одновременных виртуальных пользователей')
+    arg_parser.add_argument('--iterations', type=int, default=5, help='циклов (список, история, сообщение) на пользователя')
+    arg_parser.add_argument('--url', help='нагружать запущенный сервер вместо локального')
+    arg_parser.add_argument('--first-token-ms', type=float, default=300, help='задержка фейковой модели до первого чанка')
+    arg_parser.add_argument('--chunk-delay-ms', type=float, default=20, help='задержка фейковой модели между чанками')
+    arg_parser.add_argument('--response-repeat', type=int, default=4, help='длина ответа фейковой модели (повторов шаблона)')
+    arg_parser.add_argument('--password-iterations', type=int, default=None,
+                            help='стоимость pbkdf2 для локального сервера (по умолчанию - из конфигурации)')
+    arg_parser.add_argument('--json', help='сохранить результат в JSON-файл')
+    arg_parser.add_argument('--verbose', action='store_true', help='не приглушать логи приложения')
+    args = arg_parser.parse_args()
+
+    server = None
+    base_url = args.url
+    if not base_url:
+        base_url, server = _start_local_server(args)
+
+    recorder = Recorder()
+    run_id = f'{os.getpid()}-{int(perf_counter() * 1000)}'
+    threads = [threading.Thread(target=_virtual_user, args=(i, base_url, recorder, args.iterations, run_id))
+               for i in range(args.users)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+    if server is not None:
+        server.shutdown()
+
+    report = _summarize(recorder, elapsed)
+    total = sum(r['requests'] for r in report.values())
+    print(f"Пользователей: {args.users}, циклов: {args.iterations}, запросов: {total} за {elapsed:.2f} с "
+          f"({total / elapsed:.1f} запросов/с)")
+    print(f"{'маршрут':<40} {'запр.':>6} {'ошиб.':>6} {'запр/с':>7}  "
+          f"{'TTFB p50/p95/p99, мс':>24}  {'TTLB p50/p95/p99, мс':>24}")
+    for route, r in report.items():
+        ttfb = '/'.join(f"{v:.0f}" for v in r['ttfb_ms'].values())
+        ttlb = '/'.join(f"{v:.0f}" for v in r['ttlb_ms'].values())
+        print(f"{route:<40} {r['requests']:>6} {r['errors']:>6} {r['rps']:>7.1f}  {ttfb:>24}  {ttlb:>24}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'users': args.users, 'iterations': args.iterations, 'elapsed_s': round(elapsed, 3),
+                       'routes': report}, f, ensure_ascii=False, indent=2)
+        print(f"Результат сохранен в {args.json}")
+
+
+if __name__ == '__main__':
+    main()
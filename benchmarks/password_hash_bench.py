@@ -0,0 +1,59 @@
+# benchmarks/password_hash_bench.py
+"""
+Бенчмарк проверки паролей: сколько входов в секунду выдерживает одно ядро и пул процессов.
+
+Для каждой стоимости (числа итераций pbkdf2) измеряет check_password_hash в текущем
+процессе (так работал вход до пула) и в пуле из --workers процессов, как в
+app/services/password_hasher.py. Нужен только werkzeug.
+
+Запуск: python benchmarks/password_hash_bench.py [--method pbkdf2:sha256] [--iterations 260000 600000]
+        [--workers 2] [--logins 40]
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from werkzeug.security import generate_password_hash, check_password_hash
+
+PASSWORD = 'correct horse battery staple'
+
+
+def _inline(password_hash, logins):
+    start = perf_counter()
+    for _ in range(logins):
+        assert check_password_hash(password_hash, PASSWORD)
+    return logins / (perf_counter() - start)
+
+
+def _pooled(pool, password_hash, logins):
+    start = perf_counter()
+    futures = [pool.submit(check_password_hash, password_hash, PASSWORD) for _ in range(logins)]
+    assert all(f.result() for f in futures)
+    return logins / (perf_counter() - start)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--method', default='pbkdf2:sha256', help='метод werkzeug без числа итераций')
+    arg_parser.add_argument('--iterations', type=int, nargs='+', default=[100000, 260000, 600000],
+                            help='проверяемые стоимости (число итераций)')
+    arg_parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1), help='процессов в пуле')
+    arg_parser.add_argument('--logins', type=int, default=40, help='входов на одно измерение')
+    args = arg_parser.parse_args()
+
+    cores = min(args.workers, os.cpu_count() or 1) # Сколько ядер реально может занять пул
+    print(f"Ядер: {os.cpu_count()}, процессов в пуле: {args.workers}, входов на измерение: {args.logins}")
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for iterations in args.iterations:
+            method = f"{args.method}:{iterations}"
+            password_hash = generate_password_hash(PASSWORD, method)
+            _pooled(pool, password_hash, args.workers) # Прогрев: запуск процессов пула
+            inline_rate = _inline(password_hash, args.logins)
+            pooled_rate = _pooled(pool, password_hash, args.logins)
+            print(f"{method:>24}: в потоке {inline_rate:7.1f} входов/с (на ядро), "
+                  f"пул {pooled_rate:7.1f} входов/с ({pooled_rate / cores:6.1f} на ядро), "
+                  f"{1000 / inline_rate:6.1f} мс на вход")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# benchmarks/prompt_tokens_bench.py
+"""
+Офлайн-проверка: сколько входных токенов уходит в модель на каждой реплике диалога.
+
+Вместо google.generativeai подставляется заглушка, которая считает входные токены каждого
+запроса (условно - слова, разделенные пробелами) и возвращает фиксированный ответ.
+Сравниваются три режима:
+  legacy  - промпт передается фиктивной парой реплик в начале истории (как было раньше);
+  system  - промпт передается как system_instruction (текущий GeminiChat);
+  cached  - system_instruction из кэша контекста (GEMINI_CONTEXT_CACHE_MODELS):
+            токены промпта не обрабатываются заново и показаны отдельно как cached.
+
+Запуск: python benchmarks/prompt_tokens_bench.py [--turns 10] [--model gemini-2.0-flash]
+"""
+import argparse
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('GOOGLE_API_KEY', 'offline-benchmark') # Запросы к API не выполняются
+
+from app.config import Config # noqa: E402
+from app.external import gemini_api # noqa: E402
+
+REPLY = "Это ответ модели фиксированной длины для подсчета токенов в истории диалога."
+
+
+def count_tokens(text: str) -> int:
+    return len(text.split())
+
+
+def _content(role, text):
+    return SimpleNamespace(role=role, parts=[SimpleNamespace(text=text)])
+
+
+class _FakeChat:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = [_content(h['role'], ' '.join(h['parts'])) for h in history]
+
+    def send_message(self, message, stream=False, generation_config=None):
+        history_tokens = sum(count_tokens(p.text) for c in self.history for p in c.parts)
+        system_tokens = count_tokens(self.model.system_instruction or '')
+        self.model.log.append({
+            'input': history_tokens + count_tokens(message) + (0 if self.model.cached else system_tokens),
+            'cached': system_tokens if self.model.cached else 0,
+        })
+        self.history += [_content('user', message), _content('model', REPLY)]
+        return [SimpleNamespace(parts=[SimpleNamespace(text=REPLY)], prompt_feedback=None)]
+
+
+class _FakeModel:
+    log = [] # Общий журнал запросов: [{'input': ..., 'cached': ...}]
+
+    def __init__(self, model_name, system_instruction=None, cached=False):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.cached = cached
+
+    @classmethod
+    def from_cached_content(cls, cached_content):
+        return cls(cached_content.model, cached_content.system_instruction, cached=True)
+
+    def start_chat(self, history=None):
+        return _FakeChat(self, history or [])
+
+
+class _FakeCachedContent:
+    @staticmethod
+    def create(model, system_instruction, ttl):
+        return SimpleNamespace(model=model, system_instruction=system_instruction)
+
+
+gemini_api.genai = SimpleNamespace(GenerativeModel=_FakeModel,
+                                   caching=SimpleNamespace(CachedContent=_FakeCachedContent))
+
+
+def run(mode: str, model_name: str, turns: int):
+    _FakeModel.log = []
+    Config.GEMINI_CONTEXT_CACHE_MODELS = [model_name] if mode == 'cached' else []
+    gemini_api._context_caches.clear()
+    if mode == 'legacy':
+        prompt = gemini_api.prompt_registry.get(model_name).text
+        chat = _FakeModel(model_name).start_chat(history=[
+            {'role': 'user', 'parts': [f'System: {prompt}']},
+            {'role': 'model', 'parts': ['Understood. I will follow these instructions.']},
+        ])
+        for i in range(turns):
+            chat.send_message(f"Вопрос пользователя номер {i}")
+    else:
+        chat = gemini_api.GeminiChat(model_name=model_name)
+        for i in range(turns):
+            for _ in chat.get_streaming_response(f"Вопрос пользователя номер {i}"):
+                pass
+    return _FakeModel.log
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--turns', type=int, default=10, help='число реплик пользователя')
+    arg_parser.add_argument('--model', default=gemini_api.GeminiModel.BEYKUS_SMALL.value)
+    args = arg_parser.parse_args()
+
+    results = {mode: run(mode, args.model, args.turns) for mode in ('legacy', 'system', 'cached')}
+    print(f"Модель: {args.model}, входные токены (условные) по репликам:")
+    print(f"{'реплика':>8} {'legacy':>8} {'system':>8} {'cached':>8} {'(из кэша)':>10}")
+    for i in range(args.turns):
+        print(f"{i + 1:>8} {results['legacy'][i]['input']:>8} {results['system'][i]['input']:>8} "
+              f"{results['cached'][i]['input']:>8} {results['cached'][i]['cached']:>10}")
+    print(f"{'всего':>8} " + " ".join(f"{sum(r['input'] for r in results[m]):>8}" for m in ('legacy', 'system', 'cached')))
+
+
+if __name__ == '__main__':
+    main()
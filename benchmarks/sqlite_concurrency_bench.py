@@ -0,0 +1,122 @@
+# benchmarks/sqlite_concurrency_bench.py
+"""
+Бенчмарк конкурентного доступа к SQLite: смешанные чтения и записи из нескольких потоков.
+
+Сравнивает прежнюю схему (новое соединение на каждый запрос, настройки по умолчанию,
+журнал DELETE) с пулом соединений потока и PRAGMA-настройками из app/database.py (WAL).
+Печатает пропускную способность, задержки p50/p99 и число ошибок "database is locked".
+
+Запуск: python benchmarks/sqlite_concurrency_bench.py [--threads 8] [--ops 500] [--write-ratio 0.3]
+"""
+import argparse
+import importlib.util
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+from time import perf_counter
+
+_DATABASE_PATH = os.path.join(os.path.dirname(__file__), '..', 'app', 'database.py')
+
+
+def _load_database_module():
+    # Загружаем модуль по пути, чтобы не импортировать пакет app (он требует GOOGLE_API_KEY)
+    spec = importlib.util.spec_from_file_location('database', os.path.normpath(_DATABASE_PATH))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+database = _load_database_module()
+
+CHATS = 20
+
+
+def _seed(db_url):
+    database.init_db(db_url)
+    with sqlite3.connect(db_url) as conn:
+        conn.execute("INSERT INTO users (name, email, password) VALUES ('bench', 'bench@example.com', 'x')")
+        for i in range(CHATS):
+            conn.execute("INSERT INTO chats (user_id, title) VALUES (1, ?)", (f'chat {i}',))
+        conn.executemany(
+            "INSERT INTO messages (chat_id, user_id, content, is_bot) VALUES (?, 1, ?, ?)",
+            [(i % CHATS + 1, f'message {i}', i % 2) for i in range(2000)]
+        )
+
+
+def _legacy_connect(db_url):
+    conn = sqlite3.connect(db_url, detect_types=sqlite3.PARSE_DECLTYPES)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _operation(conn, rng, write_ratio):
+    chat_id = rng.randint(1, CHATS)
+    if rng.random() < write_ratio:
+        conn.execute("INSERT INTO messages (chat_id, user_id, content, is_bot) VALUES (?, 1, ?, 0)",
+                     (chat_id, 'x' * rng.randint(20, 400)))
+        conn.commit()
+    else:
+        conn.execute("SELECT id, content, is_bot, created_at, thoughts FROM messages "
+                     "WHERE chat_id = ? ORDER BY id DESC LIMIT 50", (chat_id,)).fetchall()
+
+
+def _worker(mode, db_url, ops, write_ratio, seed, latencies, errors):
+    rng = random.Random(seed)
+    pooled = database.create_connection(db_url) if mode == 'pooled' else None
+    for _ in range(ops):
+        start = perf_counter()
+        conn = pooled or _legacy_connect(db_url)
+        try:
+            _operation(conn, rng, write_ratio)
+        except sqlite3.OperationalError:
+            errors.append(1)
+            if conn.in_transaction:
+                conn.rollback()
+        finally:
+            if pooled is None:
+                conn.close()
+        latencies.append(perf_counter() - start)
+    if pooled is not None:
+        pooled.close()
+
+
+def run(mode, threads, ops, write_ratio):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_url = os.path.join(tmp, f'{mode}.db')
+        _seed(db_url)
+        if mode == 'legacy':
+            with sqlite3.connect(db_url) as conn:
+                conn.execute("PRAGMA journal_mode = DELETE")
+        latencies, errors = [], []
+        workers = [threading.Thread(target=_worker, args=(mode, db_url, ops, write_ratio, i, latencies, errors))
+                   for i in range(threads)]
+        start = perf_counter()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = perf_counter() - start
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(f"{mode:>7}: {len(latencies) / elapsed:8.0f} оп/с, p50 {p50:6.2f} мс, p99 {p99:7.2f} мс, "
+          f"ошибок блокировки: {len(errors)}")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--threads', type=int, default=8, help='число конкурентных потоков')
+    arg_parser.add_argument('--ops', type=int, default=500, help='операций на поток')
+    arg_parser.add_argument('--write-ratio', type=float, default=0.3, help='доля операций записи')
+    args = arg_parser.parse_args()
+
+    print(f"Потоков: {args.threads}, операций на поток: {args.ops}, доля записей: {args.write_ratio}")
+    print(f"PRAGMA пула: {database.PRAGMAS}")
+    for mode in ('legacy', 'pooled'):
+        run(mode, args.threads, args.ops, args.write_ratio)
+
+
+if __name__ == '__main__':
+    main()
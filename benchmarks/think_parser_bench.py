@@ -0,0 +1,126 @@
+# benchmarks/think_parser_bench.py
+"""
+Микро-бенчмарк разбора тегов <think> в потоке ответа.
+
+Сравнивает ThinkTagParser с прежним алгоритмом (срезы строк и += на каждом чанке)
+на длинных синтетических потоках и печатает стоимость обработки одного чанка.
+Прежний алгоритм быстрее, но не распознает теги, разрезанные границей чанков, -
+бенчмарк показывает цену корректного разбора и число "утекших" в видимый текст тегов.
+Зависимости приложения (Flask, Gemini SDK) не нужны.
+
+Запуск: python benchmarks/think_parser_bench.py [--chunks 20000] [--repeat 5]
+"""
+import argparse
+import importlib.util
+import os
+import random
+from time import perf_counter
+
+_PARSER_PATH = os.path.join(os.path.dirname(__file__), '..', 'app', 'utils', 'think_parser.py')
+
+
+def _load_parser_module():
+    # Загружаем модуль по пути, чтобы не импортировать пакет app (он требует Flask и GOOGLE_API_KEY)
+    spec = importlib.util.spec_from_file_location('think_parser', os.path.normpath(_PARSER_PATH))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+think_parser = _load_parser_module()
+
+
+def legacy_parse(chunks):
+    """Прежний алгоритм из gemini_service (до ThinkTagParser) - для сравнения."""
+    visible, thoughts, buffer, inside = "", "", "", False
+    for raw in chunks:
+        temp = raw
+        while temp:
+            if not inside:
+                pos = temp.find("<think>")
+                if pos != -1:
+                    visible += temp[:pos]
+                    temp = temp[pos + len("<think>"):]
+                    inside = True
+                else:
+                    visible += temp
+                    temp = ""
+            else:
+                pos = temp.find("</think>")
+                if pos != -1:
+                    buffer += temp[:pos]
+                    if buffer.strip():
+                        thoughts += buffer.strip() + "\n\n"
+                    temp = temp[pos + len("</think>"):]
+                    inside = False
+                    buffer = ""
+                else:
+                    buffer += temp
+                    temp = ""
+    return visible, thoughts
+
+
+def parser_parse(chunks):
+    parser = think_parser.ThinkTagParser()
+    for raw in chunks:
+        parser.feed(raw)
+    parser.close()
+    return parser.visible_text, parser.thoughts_text
+
+
+def make_stream(n_chunks: int, seed: int = 42):
+    """
+    Синтетический поток, похожий на ответ модели R: блоки <think> вперемешку с видимым
+    текстом, нарезанный на чанки случайной длины (теги часто попадают на границу чанков).
+    """
+    rng = random.Random(seed)
+    words = ["модель", "ответ", "поток", "token", "chunk", "данные", "Gemini", "think", "<", ">", "\n"]
+    parts = []
+    total = 0
+    target = n_chunks * 24
+    while total < target:
+        visible = " ".join(rng.choice(words) for _ in range(rng.randint(20, 80)))
+        thought = " ".join(rng.choice(words) for _ in range(rng.randint(10, 60)))
+        block = f"{visible}<think>{thought}</think>"
+        parts.append(block)
+        total += len(block)
+    text = "".join(parts)
+    chunks, pos = [], 0
+    while pos < len(text):
+        size = rng.randint(1, 48)
+        chunks.append(text[pos:pos + size])
+        pos += size
+    return chunks
+
+
+def bench(func, chunks, repeat: int):
+    best = float('inf')
+    for _ in range(repeat):
+        start = perf_counter()
+        func(chunks)
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('--chunks', type=int, default=20000, help='примерное число чанков в потоке')
+    arg_parser.add_argument('--repeat', type=int, default=5, help='число прогонов (берется лучший)')
+    args = arg_parser.parse_args()
+
+    chunks = make_stream(args.chunks)
+    print(f"Поток: {len(chunks)} чанков, {sum(map(len, chunks))} символов")
+    for name, func in (('legacy', legacy_parse), ('ThinkTagParser', parser_parse)):
+        elapsed = bench(func, chunks, args.repeat)
+        print(f"{name:>15}: {elapsed * 1000:8.2f} мс, {elapsed / len(chunks) * 1e9:8.0f} нс/чанк")
+
+    # Прежний алгоритм не видит тегов на границе чанков - показываем, сколько размышлений "утекло"
+    legacy_visible, _ = legacy_parse(chunks)
+    parser_visible, _ = parser_parse(chunks)
+    leaked = legacy_visible.count("<think>") + legacy_visible.count("</think>")
+    print(f"Тегов в видимом тексте: legacy={leaked}, "
+          f"ThinkTagParser={parser_visible.count('<think>') + parser_visible.count('</think>')}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 // src/pages/ChatPage/ChatPage.tsx
 
-import React, { useState, useEffect, useRef, useCallback } from 'react';
+import React, { useState, useEffect, useLayoutEffect, useRef, useCallback } from 'react';
 import { useNavigate } from 'react-router-dom';
 import styles from './ChatPage.module.css';
 // Marked и hljs используются внутри MessageItem
@@ -49,6 +49,9 @@ function ChatPage() {
     const [newMessageContent, setNewMessageContent] = useState('');
     const [isLoadingChats, setIsLoadingChats] = useState(false);
     const [isLoadingMessages, setIsLoadingMessages] = useState(false);
+    // Курсор предыдущей страницы истории (заголовок X-Next-Cursor); null - старых сообщений больше нет
+    const [olderCursor, setOlderCursor] = useState<string | null>(null);
+    const [isLoadingOlder, setIsLoadingOlder] = useState(false);
     const [isLoadingModels, setIsLoadingModels] = useState(false);
     const [isSendingMessage, setIsSendingMessage] = useState(false);
     const [error, setError] = useState<string | null>(null);
@@ -58,6 +61,10 @@ function ChatPage() {
 
     // --- Refs ---
     const messagesEndRef = useRef<HTMLDivElement>(null);
+    const messagesContainerRef = useRef<HTMLDivElement>(null);
+    // Высота списка до добавления старых сообщений сверху: после рендера восстанавливаем позицию прокрутки
+    const restoreScrollRef = useRef<number | null>(null);
+    const currentChatIdRef = useRef<string | null>(null);
     const textareaRef = useRef<HTMLTextAreaElement>(null);
     // Ref для таймеров размышлений (остается здесь)
     const thinkingTimersRef = useRef<{ [id: string]: number }>({});
@@ -67,7 +74,7 @@ function ChatPage() {
     const token = localStorage.getItem('token');
 
     // --- Функция fetch (базовая) ---
-    const baseFetch = useCallback(async (endpoint: string, options: RequestInit = {}) => {
+    const baseFetch = useCallback(async (endpoint: string, options: RequestInit = {}, onResponse?: (response: Response) => void) => {
         const url = `${API_BASE_URL}${endpoint}`;
         // console.log(`Запрос: ${options.method || 'GET'} ${url}`);
         if (!token) { console.error("Нет токена"); navigate('/auth'); throw new Error("Нет токена"); }
@@ -87,6 +94,7 @@ function ChatPage() {
                 const detail = (errorData as any)?.detail || (errorData as any)?.error || JSON.stringify(errorData);
                 throw new Error(`Ошибка: ${detail}`);
             }
+            onResponse?.(response); // Для чтения заголовков (например, курсора пагинации)
             if (response.status === 204 || options.method === 'HEAD') return null;
             return await response.json();
         } catch (err: any) {
@@ -120,17 +128,39 @@ function ChatPage() {
         finally { setIsLoadingChats(false); }
     }, [baseFetch, isLoadingChats]);
 
+    // Страница истории чата: последние сообщения или (beforeId) более старые; курсор следующей - в X-Next-Cursor
+    const fetchMessagesPage = useCallback(async (chatId: string, beforeId?: string) => {
+        let nextCursor: string | null = null;
+        const query = beforeId ? `?before_id=${encodeURIComponent(beforeId)}` : '';
+        const data: Message[] = await baseFetch(`/api/chats/${chatId}/messages${query}`, {},
+            response => { nextCursor = response.headers.get('X-Next-Cursor'); });
+        const messagesWithTime = (data || []).map(msg => ({
+            ...msg, id: String(msg.id), thinkingSeconds: msg.thoughts ? 0 : undefined
+        }));
+        return { messages: messagesWithTime, nextCursor: nextCursor as string | null }; // Присваивается в колбэке - TS сужает тип до null
+    }, [baseFetch]);
+
     const fetchMessages = useCallback(async (chatId: string) => {
-        if (!chatId || isLoadingMessages) return; setIsLoadingMessages(true); setError(null); setMessages([]);
+        if (!chatId || isLoadingMessages) return; setIsLoadingMessages(true); setError(null); setMessages([]); setOlderCursor(null);
         try {
-            const data: Message[] = await baseFetch(`/api/chats/${chatId}/messages`);
-            const messagesWithTime = (data || []).map(msg => ({
-                ...msg, id: String(msg.id), thinkingSeconds: msg.thoughts ? 0 : undefined
-            }));
-            setMessages(messagesWithTime);
+            const page = await fetchMessagesPage(chatId);
+            setMessages(page.messages); setOlderCursor(page.nextCursor);
         } catch (err: any) { setError(err.message); setMessages([]); }
         finally { setIsLoadingMessages(false); }
-    }, [baseFetch, isLoadingMessages]);
+    }, [fetchMessagesPage, isLoadingMessages]);
+
+    // Подгружает предыдущую страницу истории над уже показанными сообщениями
+    const fetchOlderMessages = useCallback(async () => {
+        const chatId = currentChatId;
+        if (!chatId || !olderCursor || isLoadingOlder || isLoadingMessages) return; setIsLoadingOlder(true);
+        try {
+            const page = await fetchMessagesPage(chatId, olderCursor);
+            if (currentChatIdRef.current !== chatId) return; // Пока шел запрос, пользователь открыл другой чат
+            restoreScrollRef.current = messagesContainerRef.current?.scrollHeight ?? 0;
+            setMessages(prev => [...page.messages, ...prev]); setOlderCursor(page.nextCursor);
+        } catch (err: any) { setError(err.message); }
+        finally { setIsLoadingOlder(false); }
+    }, [currentChatId, olderCursor, isLoadingOlder, isLoadingMessages, fetchMessagesPage]);
 
     // --- Эффекты ---
     useEffect(() => { /* Пользователь и токен */
@@ -142,8 +172,19 @@ function ChatPage() {
 
     useEffect(() => { /* Тема */ document.documentElement.setAttribute('data-theme', theme); localStorage.setItem('theme', theme); }, [theme]);
     useEffect(() => { /* Первичная загрузка */ fetchModels(); fetchChats(); }, [fetchModels, fetchChats]);
+    useEffect(() => { currentChatIdRef.current = currentChatId; }, [currentChatId]);
     useEffect(() => { /* Загрузка сообщений */ if (currentChatId) { fetchMessages(currentChatId); setThoughtsVisibility({}); } else { setMessages([]); } }, [currentChatId, fetchMessages]);
-    useEffect(() => { /* Автоскролл */ const t = setTimeout(() => messagesEndRef.current?.scrollIntoView({ behavior: "smooth", block: "end" }), 100); return () => clearTimeout(t); }, [messages]);
+    useLayoutEffect(() => { /* Старые сообщения добавлены сверху - на экране остаются те же сообщения */
+        const container = messagesContainerRef.current;
+        if (container && restoreScrollRef.current !== null) {
+            container.scrollTo({ top: container.scrollTop + container.scrollHeight - restoreScrollRef.current, behavior: 'instant' });
+        }
+    }, [messages]);
+    useEffect(() => { /* Автоскролл */ if (restoreScrollRef.current !== null) { restoreScrollRef.current = null; return; } const t = setTimeout(() => messagesEndRef.current?.scrollIntoView({ behavior: "smooth", block: "end" }), 100); return () => clearTimeout(t); }, [messages]);
+    useEffect(() => { /* Страница не заполнила окно - прокрутки не будет, подгружаем предыдущую сразу */
+        const container = messagesContainerRef.current;
+        if (container && olderCursor && !isLoadingMessages && container.scrollHeight <= container.clientHeight) fetchOlderMessages();
+    }, [messages, olderCursor, isLoadingMessages, fetchOlderMessages]);
     useEffect(() => { /* Авторесайз */ const ta = textareaRef.current; if (ta) { ta.style.height = 'auto'; ta.style.height = `${Math.min(ta.scrollHeight, 150)}px`; } }, [newMessageContent]);
 
     // Эффект для таймера размышлений (остается здесь)
@@ -172,6 +213,7 @@ function ChatPage() {
     const handleThemeToggle = () => setTheme(prev => prev === 'light' ? 'dark' : 'light');
     const handleSelectChat = (chatId: string) => { if (chatId !== currentChatId) setCurrentChatId(chatId); setIsSidebarOpen(false); };
     const handleLogout = () => { localStorage.clear(); navigate('/auth'); };
+    const handleMessagesScroll = (event: React.UIEvent<HTMLDivElement>) => { if (event.currentTarget.scrollTop < 100) fetchOlderMessages(); };
     const handleToggleThoughts = (messageId: string) => setThoughtsVisibility(prev => ({ ...prev, [messageId]: !prev[messageId] }));
 
     const handleNewChat = useCallback(async () => {
@@ -332,7 +374,8 @@ function ChatPage() {
                 </div>
 
                 {/* Сообщения */}
-                <div className={styles.messagesContainer}>
+                <div className={styles.messagesContainer} ref={messagesContainerRef} onScroll={handleMessagesScroll}>
+                    {isLoadingOlder && <p className={styles.infoMessage}>Загрузка...</p>}
                     {error && <div className={styles.errorMessage}>{error}</div>}
                     {!currentChatId && !isLoadingChats && chats.length > 0 && <p className={styles.infoMessage}>Выберите чат.</p>}
                     {isLoadingMessages && <p className={styles.infoMessage}>Загрузка...</p>}
@@ -1,13 +1,29 @@
 import os
-from app import create_app, Config # Импортируем фабрику и базу данных
 import logging
 
 logger = logging.getLogger(__name__)
 
-# Создаем экземпляр приложения с использованием фабрики
-app = create_app()
+# Приложение создается при первом обращении к run.app (gunicorn run:app, FLASK_APP=run), а не
+# при импорте: процессы пула хеширования паролей запускаются через spawn и заново импортируют
+# главный модуль - иначе каждый из них создавал бы свое приложение (миграции, фоновые потоки).
+# По той же причине пакет app импортируется только при создании приложения
+_app = None
+
+
+def __getattr__(name):
+    global _app
+    if name == 'app':
+        if _app is None:
+            from app import create_app
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 if __name__ == '__main__':
+    from app import create_app, Config # Импортируем фабрику и конфигурацию
+    app = create_app()
+
     # Убедимся, что директория для БД существует (если это файл)
     db_path = Config.DATABASE_URL
     if '/' in db_path:
@@ -31,10 +31,14 @@ function escapeHtml(text) {
  * @param {string} [message.id] - ID для обновления существующего сообщения.
  * @param {string} message.content - Основной текст сообщения.
  * @param {string|null} [message.thoughts] - Текст размышлений ИИ (если бэкенд их отправляет).
+ * @param {string|null} [message.content_html] - Готовый HTML ответа бота из истории (если сервер его собрал).
  * @param {boolean} message.is_bot - True, если сообщение от бота.
  * @param {string} message.created_at - ISO строка времени создания.
+ * @param {object} [options]
+ * @param {Node|null} [options.before] - Вставить новое сообщение перед этим элементом (подгрузка
+ *   более старой истории) без прокрутки к нему.
  */
-function addMessage(message) {
+function addMessage(message, options = {}) {
     const messagesContainer = document.querySelector('.messages-container');
     if (!messagesContainer) return;
 
@@ -75,7 +79,10 @@ function addMessage(message) {
 
         const messageTextElement = messageElement.querySelector('.message-text');
         if (messageTextElement) {
-             if (message.is_bot) {
+             if (message.is_bot && message.content_html) {
+                 // HTML ответа уже собран и очищен сервером при сохранении
+                 messageTextElement.innerHTML = message.content_html;
+             } else if (message.is_bot) {
                  // Сразу парсим Markdown для сообщений, загруженных из истории
                  messageTextElement.innerHTML = marked.parse(visibleContent || '');
              } else {
@@ -115,6 +122,10 @@ function addMessage(message) {
     }
 
     // Добавляем в DOM, если элемент новый
+    if (isNewMessage && options.before) {
+        messagesContainer.insertBefore(messageElement, options.before);
+        return; // Позицию прокрутки сохраняет вызывающий код
+    }
     if (isNewMessage) {
         messagesContainer.appendChild(messageElement);
     }
@@ -261,6 +272,9 @@ document.addEventListener('DOMContentLoaded', async () => {
     }
 
     let currentChatId = null;
+    // Курсор более старых сообщений текущего чата (заголовок X-Next-Cursor), null - история загружена полностью
+    let olderMessagesCursor = null;
+    let loadingOlderMessages = false;
     let currentModel = null;
     // Объект для хранения таймеров размышлений
     window.thinkingTimers = {};
@@ -325,9 +339,58 @@ document.addEventListener('DOMContentLoaded', async () => {
         }
     }
 
+    function fetchMessagesPage(chatId, beforeId) {
+        const query = beforeId ? `?before_id=${encodeURIComponent(beforeId)}` : '';
+        return fetch(`${BASE_URL}/api/chats/${chatId}/messages${query}`, {
+            headers: { 'Authorization': `Bearer ${token}` }
+        });
+    }
+
+    function addMessageWithTimer(message, options) {
+        // Вызываем addMessage, который сам парсит Markdown для ботов
+        addMessage(message, options);
+        // Запускаем таймер, если нужно
+        if (message.is_bot && message.id && message.thoughts) {
+            const messageElement = document.getElementById(message.id);
+            if (messageElement?.querySelector('.thoughts-container')) {
+               startThinkingTimer(message.id);
+            }
+        }
+    }
+
+    // Подгружает предыдущую страницу истории (по прокрутке к началу) над уже показанными сообщениями
+    async function loadOlderMessages() {
+        const messagesContainer = document.querySelector('.messages-container');
+        if (!messagesContainer || !olderMessagesCursor || loadingOlderMessages) return;
+        const chatId = currentChatId;
+        loadingOlderMessages = true;
+        try {
+            const response = await fetchMessagesPage(chatId, olderMessagesCursor);
+            if (!response.ok) {
+                if (response.status === 401) { window.location.href = '/auth.html'; return; }
+                throw new Error(`Ошибка ${response.status}: ${response.statusText}`);
+            }
+            const messages = await response.json();
+            if (chatId !== currentChatId) return; // Пока шел запрос, пользователь открыл другой чат
+            olderMessagesCursor = response.headers.get('X-Next-Cursor');
+
+            const anchor = messagesContainer.firstChild;
+            const previousHeight = messagesContainer.scrollHeight;
+            messages.forEach(message => addMessageWithTimer(message, { before: anchor }));
+            applySyntaxHighlighting(messagesContainer);
+            // Оставляем на экране те же сообщения, что были до подгрузки
+            messagesContainer.scrollTop += messagesContainer.scrollHeight - previousHeight;
+        } catch (error) {
+            console.error('Ошибка загрузки более старых сообщений:', error);
+        } finally {
+            loadingOlderMessages = false;
+        }
+    }
+
     async function loadMessages(chatId) {
         if (!chatId) return;
         currentChatId = chatId;
+        olderMessagesCursor = null;
         Object.values(window.thinkingTimers || {}).forEach(timer => clearInterval(timer.intervalId));
         window.thinkingTimers = {};
 
@@ -336,37 +399,32 @@ document.addEventListener('DOMContentLoaded', async () => {
         messagesContainer.innerHTML = '<p>Загрузка сообщений...</p>';
 
         try {
-            const response = await fetch(`${BASE_URL}/api/chats/${chatId}/messages`, {
-                headers: { 'Authorization': `Bearer ${token}` }
-            });
+            // Сервер отдает последнюю страницу истории, более старые подгружаются по прокрутке вверх
+            const response = await fetchMessagesPage(chatId);
             if (!response.ok) {
                  if (response.status === 401) { window.location.href = '/auth.html'; return; }
                  if (response.status === 404) { throw new Error('Чат не найден.'); }
                 throw new Error(`Ошибка ${response.status}: ${response.statusText}`);
             }
             const messages = await response.json();
+            if (chatId !== currentChatId) return;
+            olderMessagesCursor = response.headers.get('X-Next-Cursor');
             messagesContainer.innerHTML = '';
 
             if (messages.length === 0) {
                 messagesContainer.innerHTML = '<p>В этом чате пока нет сообщений.</p>';
             } else {
-                messages.forEach(message => {
-                    // Вызываем addMessage, который теперь сам парсит Markdown для ботов
-                    addMessage(message);
-                    // Запускаем таймер, если нужно
-                    if (message.is_bot && message.id && message.thoughts) {
-                        const messageElement = document.getElementById(message.id);
-                        if (messageElement?.querySelector('.thoughts-container')) {
-                           startThinkingTimer(message.id);
-                        }
-                    }
-                });
+                messages.forEach(message => addMessageWithTimer(message));
                 // Применяем подсветку ко всему контейнеру ПОСЛЕ добавления всех
                 applySyntaxHighlighting(messagesContainer);
             }
             // Прокрутка в конец
             requestAnimationFrame(() => {
                messagesContainer.scrollTop = messagesContainer.scrollHeight;
+               // Если страница не заполнила окно, прокрутки не будет - подгружаем предыдущую сразу
+               if (messagesContainer.scrollHeight <= messagesContainer.clientHeight) {
+                   loadOlderMessages();
+               }
             });
         } catch (error) {
             console.error('Ошибка загрузки сообщений:', error);
@@ -400,6 +458,15 @@ document.addEventListener('DOMContentLoaded', async () => {
     }
 
     // --- Обработчики событий ---
+    const messagesScrollContainer = document.querySelector('.messages-container');
+    if (messagesScrollContainer) {
+        messagesScrollContainer.addEventListener('scroll', () => {
+            if (messagesScrollContainer.scrollTop < 100) {
+                loadOlderMessages();
+            }
+        });
+    }
+
     const newChatBtn = document.querySelector('.new-chat-btn');
     if (newChatBtn) {
         newChatBtn.addEventListener('click', async () => {
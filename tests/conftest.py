@@ -0,0 +1,6 @@
+import os
+import sys
+
+# app.config требует ключ API при импорте; тестам он не нужен
+os.environ.setdefault('GOOGLE_API_KEY', 'test-key')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
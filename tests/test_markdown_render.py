@@ -0,0 +1,21 @@
+from app.utils.markdown_render import render_markdown
+
+
+def test_code_block_keeps_angle_brackets_and_ampersands():
+    html = render_markdown('```cpp\n#include <iostream>\nstd::vector<int> v; if (a && b) {}\n```')
+    assert '<pre><code class="language-cpp">' in html
+    assert '#include &lt;iostream&gt;' in html
+    assert 'std::vector&lt;int&gt; v;' in html
+    assert 'a &amp;&amp; b' in html
+
+
+def test_inline_code_keeps_angle_brackets_and_ampersands():
+    html = render_markdown('Тип `List<String>` и `a & b`')
+    assert '<code>List&lt;String&gt;</code>' in html
+    assert '<code>a &amp; b</code>' in html
+
+
+def test_tags_outside_code_are_stripped():
+    html = render_markdown('текст <script>alert(1)</script> **жирный**')
+    assert '<script>' not in html
+    assert '<strong>жирный</strong>' in html
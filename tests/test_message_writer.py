@@ -0,0 +1,76 @@
+import sqlite3
+
+import pytest
+
+from app import database
+from app.config import Config
+from app.services import message_writer
+from app.services.message_writer import MessageWriter
+
+INSERT = 'INSERT INTO messages (chat_id, content) VALUES (?, ?)'
+
+
+@pytest.fixture
+def db_url(tmp_path):
+    url = str(tmp_path / 'writer.db')
+    conn = sqlite3.connect(url)
+    conn.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY, chat_id INTEGER, content TEXT NOT NULL)')
+    conn.close()
+    return url
+
+
+class BadParam:
+    def __conform__(self, protocol):
+        raise ValueError("не сериализуется")
+
+
+def test_non_sqlite_error_fails_only_its_item(db_url):
+    writer = MessageWriter(db_url, max_queue=10, max_batch=10, flush_interval_ms=50)
+    try:
+        good = writer.submit(INSERT, (1, 'a'), chat_id=1, user_id=1)
+        bad = writer.submit(INSERT, (1, BadParam()), chat_id=1, user_id=1)
+        assert good.wait(5)
+        with pytest.raises(sqlite3.Error):
+            bad.wait(5)
+        assert writer._thread.is_alive()
+        assert writer.submit(INSERT, (1, 'b'), chat_id=1, user_id=1).wait(5)
+    finally:
+        writer.close()
+
+
+def test_writer_thread_survives_unexpected_batch_error(db_url, monkeypatch):
+    writer = MessageWriter(db_url, max_queue=10, max_batch=10, flush_interval_ms=1)
+    try:
+        original = writer._write_batch
+        monkeypatch.setattr(writer, '_write_batch', lambda conn, batch: 1 / 0)
+        with pytest.raises(sqlite3.Error):
+            writer.submit(INSERT, (1, 'a'), chat_id=1, user_id=1).wait(5)
+        assert writer.wait_for_chat(1, 5)
+        monkeypatch.setattr(writer, '_write_batch', original)
+        assert writer.submit(INSERT, (1, 'b'), chat_id=1, user_id=1).wait(5)
+    finally:
+        writer.close()
+
+
+def test_get_writer_restarts_dead_thread(db_url, monkeypatch):
+    monkeypatch.setattr(Config, 'WRITE_BEHIND_ENABLED', True, raising=False)
+    monkeypatch.setattr(database, 'DATABASE_URL', db_url)
+    monkeypatch.setattr(message_writer, '_writer', None)
+    create_connection = database.create_connection
+
+    def broken_connection(url, pragmas=None):
+        raise sqlite3.OperationalError("нет доступа к БД")
+
+    monkeypatch.setattr(database, 'create_connection', broken_connection)
+    dead = message_writer.get_writer()
+    dead._thread.join(5)
+    with pytest.raises(message_writer.WriteBehindError):
+        dead.submit(INSERT, (1, 'a'), chat_id=1, user_id=1)
+
+    monkeypatch.setattr(database, 'create_connection', create_connection)
+    writer = message_writer.get_writer()
+    try:
+        assert writer is not dead and writer._thread.is_alive()
+        assert writer.submit(INSERT, (1, 'a'), chat_id=1, user_id=1).wait(5)
+    finally:
+        writer.close()
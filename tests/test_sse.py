@@ -0,0 +1,78 @@
+import asyncio
+import time
+
+from app.utils.sse import EventCoalescer, coalesce_events, coalesce_events_async
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_first_content_after_thoughts_is_sent_immediately():
+    clock = FakeClock()
+    coalescer = EventCoalescer(window_ms=1000, max_bytes=10_000, clock=clock)
+    assert coalescer.push({'content': None, 'thoughts': 'думаю'})  # Первое событие - сразу
+    assert coalescer.push({'content': None, 'thoughts': ' еще'}) == []
+    frames = coalescer.push({'content': 'Ответ', 'thoughts': None})
+    assert frames == [{'content': 'Ответ', 'thoughts': ' еще', 'error': None}]
+    assert coalescer.push({'content': ' дальше', 'thoughts': None}) == []
+
+
+def test_size_limit_counts_utf8_bytes():
+    clock = FakeClock()
+    coalescer = EventCoalescer(window_ms=1000, max_bytes=8, clock=clock)
+    coalescer.push({'content': 'a'})
+    assert coalescer.push({'content': 'яяя'}) == []  # 6 байт
+    assert coalescer.push({'content': 'я'})  # 8 байт - кадр
+
+
+def _paused_source(pause):
+    yield {'content': 'a', 'thoughts': None}
+    yield {'content': 'b', 'thoughts': None}
+    time.sleep(pause)  # Модель замолчала
+    yield {'content': 'c', 'thoughts': None}
+
+
+def test_sync_coalescer_flushes_on_deadline_during_pause():
+    start = time.monotonic()
+    arrivals = [(frame['content'], time.monotonic() - start)
+                for frame in coalesce_events(_paused_source(0.5), window_ms=50, max_bytes=2048)]
+    assert [content for content, _ in arrivals] == ['a', 'b', 'c']
+    assert arrivals[1][1] < 0.3  # 'b' отправлен по окну, а не вместе с 'c' после паузы
+
+
+def test_sync_coalescer_propagates_source_errors():
+    def failing():
+        yield {'content': 'a', 'thoughts': None}
+        raise RuntimeError('boom')
+
+    frames = coalesce_events(failing(), window_ms=50, max_bytes=2048)
+    assert next(frames)['content'] == 'a'
+    try:
+        next(frames)
+    except RuntimeError as e:
+        assert str(e) == 'boom'
+    else:
+        raise AssertionError('ошибка источника потеряна')
+
+
+def test_async_coalescer_flushes_on_deadline_during_pause():
+    async def source():
+        yield {'content': 'a', 'thoughts': None}
+        yield {'content': 'b', 'thoughts': None}
+        await asyncio.sleep(0.5)
+        yield {'content': 'c', 'thoughts': None}
+
+    async def collect():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        return [(frame['content'], loop.time() - start)
+                async for frame in coalesce_events_async(source(), window_ms=50, max_bytes=2048)]
+
+    arrivals = asyncio.run(collect())
+    assert [content for content, _ in arrivals] == ['a', 'b', 'c']
+    assert arrivals[1][1] < 0.3
@@ -0,0 +1,21 @@
+from app.utils.think_parser import ThinkTagParser
+
+
+def _parse(chunks):
+    parser = ThinkTagParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    parser.close()
+    return parser.visible_text, parser.thoughts_text
+
+
+def test_tags_split_across_chunks():
+    text = 'до <think>мысль a < b</think> после'
+    expected = ('до  после', 'мысль a < b')
+    for size in range(1, len(text) + 1):
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        assert _parse(chunks) == expected, chunks
+
+
+def test_tag_prefix_that_is_not_a_tag_stays_visible():
+    assert _parse(['a <thi', 'ng>', ' b <']) == ('a <thing> b <', None)